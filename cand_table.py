@@ -0,0 +1,185 @@
+"""
+Binary copies of the peasoup candidate tables (used by
+fold_cands.py and gcpsr_search2.py)
+
+Reading a big overview.xml takes a while, so the first time
+fold_cands.py reads one it saves the candidates next to it as
+a table (overview_cands.parquet, or overview_cands.npz if
+pyarrow is not installed) along with the header, search, and
+segment blocks.  The table remembers the size, mtime, and md5
+of the xml it came from, and is only used if they still match
+(if just the mtime changed, eg from a copy, the md5 decides).
+
+The tables keep the full float precision, so the candidates
+selected for folding are saved the same way
+(filtered_df_for_folding.parquet/npz).
+
+    df, meta = load_table("overview_cands.parquet")
+"""
+import os
+import json
+import logging
+import hashlib
+import numpy as np
+import xml.etree.ElementTree as ET
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+
+TABLE_EXTS = [".parquet", ".npz"]
+
+
+def table_path(base):
+    """
+    File name for a table with this base name (no extension)
+    """
+    return base + (".parquet" if HAVE_PYARROW else ".npz")
+
+
+def find_table(base):
+    """
+    Existing table with this base name (the kind we would 
+    write first), or None
+    """
+    first = table_path(base)
+    for path in [first] + [ base + ext for ext in TABLE_EXTS ]:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def sidecar_base(xml_file):
+    return f"{os.path.splitext(xml_file)[0]}_cands"
+
+
+def xml_md5(xml_file, blocksize=2**22):
+    md5 = hashlib.md5()
+    with open(xml_file, 'rb') as fin:
+        for buf in iter(lambda: fin.read(blocksize), b''):
+            md5.update(buf)
+    return md5.hexdigest()
+
+
+def missing(vals):
+    """
+    Where an object column has no value (None or NaN)
+    """
+    return np.array([ vv is None or (isinstance(vv, float) and np.isnan(vv))
+                      for vv in vals ], dtype=bool)
+
+
+def save_table(df, path, meta=None):
+    """
+    Save a DataFrame (and a dict of extra info) to a parquet
+    or npz file, depending on the extension of path
+    """
+    meta_str = json.dumps(meta or {})
+    tmp = f"{path}.tmp"
+    if path.endswith(".parquet"):
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        smeta = dict(table.schema.metadata or {})
+        smeta[b"gc_peasy"] = meta_str.encode()
+        pq.write_table(table.replace_schema_metadata(smeta), tmp)
+    else:
+        cols = {}
+        for ii, col in enumerate(df.columns):
+            vals = df[col].to_numpy()
+            if vals.dtype == object:
+                # npz has no None, so keep where they were
+                none = missing(vals)
+                if none.any():
+                    cols[f"n{ii:03d}"] = none
+                vals = np.where(none, "", vals).astype(str)
+            cols[f"c{ii:03d}"] = vals
+        with open(tmp, 'wb') as fout:
+            np.savez(fout, __meta__=np.array(meta_str),
+                     __columns__=np.array(list(df.columns), dtype=str), **cols)
+    os.replace(tmp, path)
+    return path
+
+
+def load_table(path):
+    """
+    Read a table written by save_table.  Returns (df, meta)
+    """
+    # pandas is only needed to read tables, not to find them
+    import pandas as pd
+
+    if path.endswith(".parquet"):
+        table = pq.read_table(path)
+        meta = json.loads((table.schema.metadata or {}).get(b"gc_peasy", b"{}"))
+        return table.to_pandas(), meta
+
+    with np.load(path, allow_pickle=False) as npz:
+        meta = json.loads(str(npz["__meta__"]))
+        names = list(npz["__columns__"])
+        cols = {}
+        for ii, nn in enumerate(names):
+            vals = npz[f"c{ii:03d}"]
+            if f"n{ii:03d}" in npz.files:
+                vals = vals.astype(object)
+                vals[npz[f"n{ii:03d}"]] = None
+            cols[str(nn)] = vals
+        df = pd.DataFrame(cols)
+    return df, meta
+
+
+def sections_to_dict(sections):
+    return { name : { child.tag : child.text for child in elem }
+             for name, elem in sections.items() }
+
+
+def dict_to_sections(sdict):
+    sections = {}
+    for name, vals in sdict.items():
+        elem = ET.Element(name)
+        for tag, text in vals.items():
+            ET.SubElement(elem, tag).text = text
+        sections[name] = elem
+    return sections
+
+
+def read_xml_cands(xml_file, reader):
+    """
+    Get (sections, df) for a peasoup xml file from its
+    table if it is up to date, otherwise with reader
+    (eg, fold_cands.read_peasoup_xml), saving the table
+    for next time.
+    """
+    st = os.stat(xml_file)
+    base = sidecar_base(xml_file)
+    md5 = None
+
+    path = find_table(base)
+    if path is not None:
+        try:
+            df, meta = load_table(path)
+            ok = meta.get("xml_size") == st.st_size
+            if ok and meta.get("xml_mtime") != st.st_mtime:
+                md5 = xml_md5(xml_file)
+                ok = meta.get("xml_md5") == md5
+            if ok:
+                logging.info(f"Read {len(df)} candidates from {path}")
+                return dict_to_sections(meta["sections"]), df
+        except Exception as err:
+            logging.warning(f"Could not read {path}: {err}")
+
+    sections, df = reader(xml_file)
+
+    if md5 is None:
+        md5 = xml_md5(xml_file)
+    meta = {"xml_md5" : md5, "xml_mtime" : st.st_mtime,
+            "xml_size" : st.st_size,
+            "sections" : sections_to_dict(sections)}
+    try:
+        path = save_table(df, table_path(base), meta)
+        logging.info(f"Saved {len(df)} candidates to {path}")
+    except OSError as err:
+        logging.warning(f"Could not save candidate table: {err}")
+
+    return sections, df
@@ -0,0 +1,110 @@
+"""
+Ways of running commands from the singularity images
+(used by gcpsr_search2.py)
+
+  "exec"     : a fresh `singularity exec` for every command
+  "instance" : one `singularity instance start` per image for
+               the whole job, with every command sent through
+               `singularity exec instance://...`
+  "local"    : run the commands directly (no container), which
+               is handy for testing with the tools (or stand-ins)
+               on the PATH
+"""
+import os
+import threading
+import subprocess as sp
+
+
+BACKEND_MODES = ["exec", "instance", "local"]
+
+
+class ContainerBackend:
+    """
+    Build the shell command that runs cmd from a sif file
+
+    For "instance" mode, binds is the list of paths bound
+    when each instance is started (eg, the top of the work
+    directory).  Since binds can not be added to a running
+    instance, a command that needs a path outside of these
+    is run with a plain `singularity exec` instead.
+    """
+    def __init__(self, mode="exec", binds=None, name="gcpsr"):
+        if mode not in BACKEND_MODES:
+            raise ValueError(f"Unknown container mode {mode}, " +\
+                             f"must be one of {BACKEND_MODES}")
+        self.mode      = mode
+        self.binds     = [ bb.rstrip('/') for bb in (binds or []) ]
+        self.name      = f"{name}_{os.getpid()}"
+        self.instances = {}
+        self.lock      = threading.Lock()
+
+    def exec_command(self, sif, cmd, bstr, nv=False):
+        """
+        Plain singularity exec
+        """
+        nv_str = "--nv " if nv else ""
+        return f"singularity exec {nv_str}-B {bstr} {sif} {cmd}"
+
+    def covered(self, bstr):
+        """
+        Check if all the paths in a bind string are
+        under the paths bound to the instances
+        """
+        for bpath in bstr.split(','):
+            bpath = bpath.split(':')[0].rstrip('/')
+            if not any([ bpath == bb or bpath.startswith(bb + '/')
+                         for bb in self.binds ]):
+                return False
+        return True
+
+    def start_instance(self, sif, nv=False):
+        """
+        Start an instance for (sif, nv) if we have not
+        already and return its name
+        """
+        with self.lock:
+            key = (sif, nv)
+            if key in self.instances:
+                return self.instances[key]
+
+            iname = f"{self.name}_{len(self.instances)}"
+            nv_str = "--nv " if nv else ""
+            bstr = ",".join(self.binds)
+            start_cmd = f"singularity instance start {nv_str}" +\
+                        f"-B {bstr} {sif} {iname}"
+            print(f"\n\n {start_cmd} \n\n")
+            ret = sp.run(start_cmd, shell=True)
+            if ret.returncode != 0:
+                print(f"Could not start instance of {sif}")
+                return None
+
+            self.instances[key] = iname
+            return iname
+
+    def command(self, sif, cmd, bstr, nv=False):
+        """
+        Get the shell command that runs cmd from sif
+        with the paths in bstr bound (and GPU support if
+        nv is True)
+        """
+        if self.mode == "local":
+            return cmd
+
+        if self.mode == "instance" and self.covered(bstr):
+            iname = self.start_instance(sif, nv)
+            if iname is not None:
+                return f"singularity exec instance://{iname} {cmd}"
+
+        return self.exec_command(sif, cmd, bstr, nv)
+
+    def stop_all(self):
+        """
+        Stop all the instances we started
+        """
+        with self.lock:
+            for iname in self.instances.values():
+                stop_cmd = f"singularity instance stop {iname}"
+                print(f"\n\n {stop_cmd} \n\n")
+                sp.run(stop_cmd, shell=True)
+            self.instances = {}
+        return
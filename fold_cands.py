@@ -14,6 +14,13 @@ import threading
 from multiprocessing import Pool, cpu_count
 import re
 import json
+import glob
+import heapq
+import hashlib
+import shutil
+from fractions import Fraction
+
+import cand_table
 
 ###############################################################################
 # Logging Setup
@@ -75,14 +82,177 @@ def immediate_stream_output(pipe, logger, log_level=logging.INFO):
     finally:
         pipe.close()
 
+class PrefixLogger(logging.LoggerAdapter):
+    """
+    Tag each line with the process it came from, for when
+    several processes are logging at the same time.
+    """
+    def process(self, msg, kwargs):
+        return f"[{self.extra['prefix']}] {msg}", kwargs
+
+###############################################################################
+# Reading the Peasoup XML
+###############################################################################
+
+# Types of the candidate columns, anything else is kept as a string
+CAND_DTYPES = {
+    'period': np.float64, 'dm': np.float64, 'acc': np.float64, 'jerk': np.float64,
+    'pb': np.float64, 'a1': np.float64, 'phi': np.float64, 't0': np.float64,
+    'omega': np.float64, 'ecc': np.float64, 'snr': np.float64, 'nh': np.int64,
+    'nassoc': np.int64, 'segment_start_sample': np.int64, 'segment_nsamples': np.int64,
+    'segment_pepoch': np.float64, 'segment_fft_size': np.int64,
+}
+
+IGNORED_ENTRIES = [
+    'opt_period', 'folded_snr', 'byte_offset', 'is_adjacent',
+    'is_physical', 'ddm_count_ratio', 'ddm_snr_ratio'
+]
+
+XML_SECTIONS = ['header_parameters', 'search_parameters', 'segment_parameters']
+
+# Value for a candidate that does not have a tag (so it is not mistaken for 0)
+MISSING_INT = -1
+
+def missing_column(dtype, nrows):
+    if dtype == np.float64:
+        return np.full(nrows, np.nan)
+    if dtype == np.int64:
+        return np.full(nrows, MISSING_INT, dtype=np.int64)
+    return np.full(nrows, None, dtype=object)
+
+def read_peasoup_xml(xml_file, chunk=4096):
+    """
+    Stream a peasoup overview.xml with iterparse. The header, search, and
+    segment blocks are kept (by tag) and returned in a dict, and the
+    candidates go straight into typed numpy columns (grown chunk rows at a
+    time) with each element cleared once it is read, so the whole tree is
+    never held in memory. A candidate without one of the tags gets NaN
+    (or MISSING_INT for integer columns, None for text) there.
+    Returns (sections, df) with one row per candidate and a
+    'cand_id_in_file' column.
+    """
+    sections = {}
+    columns = {}
+    ids = np.zeros(chunk, dtype=np.int64)
+    nrows = 0
+    cand_block = None
+
+    for event, elem in ET.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'candidates':
+                cand_block = elem
+            continue
+
+        if elem.tag in XML_SECTIONS:
+            sections[elem.tag] = elem
+
+        elif elem.tag == 'candidate' and cand_block is not None:
+            if nrows == len(ids):
+                ids = np.concatenate([ids, np.zeros(chunk, dtype=ids.dtype)])
+                for tag, col in columns.items():
+                    columns[tag] = np.concatenate([col, missing_column(col.dtype, chunk)])
+            ids[nrows] = int(elem.attrib.get("id"))
+            for child in elem:
+                tag = child.tag
+                if tag in IGNORED_ENTRIES:
+                    continue
+                if tag not in columns:
+                    columns[tag] = missing_column(CAND_DTYPES.get(tag, object), len(ids))
+                dtype = columns[tag].dtype
+                if dtype == np.int64:
+                    columns[tag][nrows] = int(float(child.text))
+                elif dtype == np.float64:
+                    columns[tag][nrows] = float(child.text)
+                else:
+                    columns[tag][nrows] = child.text
+            nrows += 1
+            elem.clear()
+            cand_block.clear()
+
+    if nrows == 0:
+        columns = {tag: np.zeros(0, dtype=dtype) for tag, dtype in CAND_DTYPES.items()
+                   if not tag.startswith('segment_')}
+    df = pd.DataFrame({tag: col[:nrows] for tag, col in columns.items()})
+    df['cand_id_in_file'] = ids[:nrows]
+    return sections, df
+
 ###############################################################################
 # Avoid candidates based on avoid candidate file & Pre-Select Candidates based on JSON Configuration
 ###############################################################################
 
+def parse_harmonics(harmonics):
+    """
+    Parse a comma separated list of harmonic ratios (eg "1,2,3,1/2,3/2")
+    into floats. The fundamental (1) is always included.
+    """
+    ratios = [1.0]
+    if harmonics:
+        for hh in str(harmonics).split(','):
+            hh = hh.strip()
+            if hh:
+                ratios.append(float(Fraction(hh)))
+    return [float(hh) for hh in np.unique(ratios)]
+
+def match_avoid_windows(periods, dms, avoid_df, harmonics=(1.0,)):
+    """
+    Find the candidates that fall in an avoid window. For each avoid source
+    and harmonic ratio h the window is h * (period +/- period_tol) and
+    dm +/- dm_tol. The windows are matched against the sorted candidate
+    periods with np.searchsorted, so only the candidates inside a period
+    window are checked in DM.
+
+    Returns (mask, avoid_row, harmonic) per candidate, with avoid_row = -1
+    (and harmonic = 0) for candidates that are not avoided.
+    """
+    periods = np.asarray(periods, dtype=float)
+    dms = np.asarray(dms, dtype=float)
+    ncands = len(periods)
+
+    harmonics = np.asarray(harmonics, dtype=float)
+    p0 = avoid_df['period_sec'].to_numpy(dtype=float)
+    ptol = avoid_df['period_tol_sec'].to_numpy(dtype=float)
+    dm0 = avoid_df['dm'].to_numpy(dtype=float)
+    dmtol = avoid_df['dm_tolerance'].to_numpy(dtype=float)
+
+    # One window per (avoid row, harmonic)
+    row = np.repeat(np.arange(len(avoid_df)), len(harmonics))
+    harm = np.tile(harmonics, len(avoid_df))
+    p_lo = harm * (p0[row] - ptol[row])
+    p_hi = harm * (p0[row] + ptol[row])
+
+    order = np.argsort(periods, kind='stable')
+    sorted_p = periods[order]
+    lo = np.searchsorted(sorted_p, p_lo, side='left')
+    hi = np.searchsorted(sorted_p, p_hi, side='right')
+
+    # Expand to (window, candidate) pairs in period, then check DM
+    counts = np.maximum(hi - lo, 0)
+    win = np.repeat(np.arange(len(row)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cand = order[np.repeat(lo, counts) + offsets]
+    in_dm = np.abs(dms[cand] - dm0[row[win]]) <= dmtol[row[win]]
+    win, cand = win[in_dm], cand[in_dm]
+
+    avoid_row = np.full(ncands, -1, dtype=int)
+    avoid_harm = np.zeros(ncands, dtype=float)
+    # If a candidate is in several windows, the one closest to the
+    # fundamental wins
+    first = np.lexsort((np.abs(np.log(harm[win])), cand))
+    cand, win = cand[first], win[first]
+    keep = np.ones(len(cand), dtype=bool)
+    keep[1:] = cand[1:] != cand[:-1]
+    avoid_row[cand[keep]] = row[win[keep]]
+    avoid_harm[cand[keep]] = harm[win[keep]]
+
+    return avoid_row >= 0, avoid_row, avoid_harm
+
 def apply_folding_configuration(
     df: pd.DataFrame,
     config_file: str = None,
-    avoid_folding_file: str = None) -> pd.DataFrame:
+    avoid_folding_file: str = None,
+    avoid_harmonics: str = None,
+    rank_weights: dict = None,
+    sift=None) -> pd.DataFrame:
     """
     Filter candidates from the dataframe based on the folding configuration
     specified in the JSON config file.
@@ -118,16 +288,25 @@ def apply_folding_configuration(
     - For each filter block, only rows satisfying *all* parameter constraints are selected.
     - Each parameter filter must have a 'min' and 'max' key.
     - Any number of parameters can be specified in a single block, and any number of independent blocks can be defined.
-    - After filtering, up to 'total_cands_limit' candidates are kept per filter block.
+    - After filtering, up to 'total_cands_limit' candidates are kept per filter block, the best first by
+      the score from rank_weights (see candidate_score, default S/N).
+    - If sift is given (a function that takes the candidates and returns the ones to keep, eg the
+      brightest of each cluster, see sift_candidates), it is run on everything the blocks selected
+      before any block is cut to its limit, so the limit counts distinct signals and the cluster
+      columns can be used in rank_weights.
     - Multiple blocks: intersection within each block, union across blocks. Drops duplicates using 'cand_id_in_file'.
 
     If 'avoid_folding_file' is provided, candidates with periods in that file will be excluded from folding.
-    This is useful to avoid folding bright known pulsars/rfi sources.
+    This is useful to avoid folding bright known pulsars/rfi sources. With 'avoid_harmonics' (eg "2,3,1/2"),
+    the harmonics of those periods are excluded too (see match_avoid_windows).
 
     Args:
         df: DataFrame containing candidate data.
         config_file: Path to JSON configuration file (optional).
         avoid_folding_file: Path to CSV file with periods to avoid (optional).
+        avoid_harmonics: Comma separated harmonic ratios to avoid as well (optional).
+        rank_weights: Score weights (see parse_rank_by) for picking candidates over the limit (optional).
+        sift: Function to run on the selected candidates before the limits (optional).
 
     Returns:
         A DataFrame with pre-selected candidates for folding.
@@ -143,21 +322,19 @@ def apply_folding_configuration(
         avoid_df['period_tol_sec'] = avoid_df['period_tolerance_ms'] / 1000.0
 
         initial_count = len(df_filtered)
-        avoid_mask = pd.Series(False, index=df_filtered.index)
-
-
-        for _, row in avoid_df.iterrows():
-            p_min = row['period_sec'] - row['period_tol_sec']
-            p_max = row['period_sec'] + row['period_tol_sec']
-            dm_min = row['dm'] - row['dm_tolerance']
-            dm_max = row['dm'] + row['dm_tolerance']
-            logging.info(f"Avoid window: {p_min:.8f} - {p_max:.8f} s | DM window: {dm_min:.4f} - {dm_max:.4f}")
+        harmonics = parse_harmonics(avoid_harmonics)
+        logging.info(f"Avoiding {len(avoid_df)} sources at harmonics {harmonics}")
+        for _, row in avoid_df.iterrows() if logging.getLogger().isEnabledFor(logging.DEBUG) else []:
+            logging.debug(f"Avoid window: {row['period_sec'] - row['period_tol_sec']:.8f} - "
+                          f"{row['period_sec'] + row['period_tol_sec']:.8f} s | DM window: "
+                          f"{row['dm'] - row['dm_tolerance']:.4f} - {row['dm'] + row['dm_tolerance']:.4f}")
 
-
-            condition = df_filtered['period'].between(p_min, p_max) & df_filtered['dm'].between(dm_min, dm_max)
-            avoid_mask |= condition
+        avoid_mask, avoid_row, avoid_harm = match_avoid_windows(
+            df_filtered['period'].values, df_filtered['dm'].values, avoid_df, harmonics)
 
         avoided = df_filtered.loc[avoid_mask].copy()
+        avoided['avoid_row'] = avoid_row[avoid_mask]
+        avoided['avoid_harmonic'] = avoid_harm[avoid_mask]
         avoided.to_csv("avoided_candidates_to_fold.csv", index=False)
         logging.info("Saved avoided candidates to 'avoided_candidates_to_fold.csv'.")
         # Keep only candidates that do not match the avoid periods
@@ -173,7 +350,7 @@ def apply_folding_configuration(
         group_key = list(config.keys())[0]
         filters = config[group_key]
 
-        filtered_blocks = []
+        block_masks = []
 
         for idx, filter_def in enumerate(filters):
             mask = pd.Series(True, index=df_filtered.index)
@@ -189,21 +366,30 @@ def apply_folding_configuration(
                 mask &= df_filtered[param].between(bounds['min'], bounds['max'])
                 # When you repeat mask &= <condition> you are effectively keeping only the rows that satisfy this condition and also the previous conditions
 
-            sel = df_filtered.loc[mask]
+            logging.info(f"Filter block {idx+1} {filter_def} selected {mask.sum()} candidates.")
+            block_masks.append(mask)
 
-            logging.info(f"Filter block {idx+1} {filter_def} selected {len(sel)} candidates.")
+        if block_masks:
+            # Sift everything selected before cutting the blocks to their limits
+            selected = df_filtered.loc[np.logical_or.reduce(block_masks)]
+            if sift is not None:
+                selected = sift(selected)
+            selected_ids = selected['cand_id_in_file']
 
-            limit = filter_def.get('total_cands_limit', None)
-            if limit is not None and len(sel) > limit:
-                logging.info(
-                    f"Filter block {idx+1} returned {len(sel)} candidates, "
-                    f"exceeding limit {limit}. Truncating."
-                )
-                sel = sel.head(limit)
+            filtered_blocks = []
+            for idx, (filter_def, mask) in enumerate(zip(filters, block_masks)):
+                sel = selected.loc[selected_ids.isin(df_filtered.loc[mask, 'cand_id_in_file']).values]
+
+                limit = filter_def.get('total_cands_limit', None)
+                if limit is not None and len(sel) > limit:
+                    logging.info(
+                        f"Filter block {idx+1} returned {len(sel)} candidates, "
+                        f"exceeding limit {limit}. Truncating."
+                    )
+                    sel = rank_candidates(sel, rank_weights or {"snr": 1.0}).head(limit)
 
-            filtered_blocks.append(sel)
+                filtered_blocks.append(sel)
 
-        if filtered_blocks:
             df_filtered = pd.concat(filtered_blocks, ignore_index=True)
             logging.info(f"Total candidates after concatenation: {len(df_filtered)}")
 
@@ -213,30 +399,168 @@ def apply_folding_configuration(
             df_filtered = df_filtered.sort_values(by='cand_id_in_file').reset_index(drop=True)
         else:
             logging.info("No candidates matched any filter block. Returning original DataFrame.")
+            if sift is not None:
+                df_filtered = sift(df_filtered)
+
+    elif sift is not None:
+        df_filtered = sift(df_filtered)
 
     return df_filtered
 
 
 
+###############################################################################
+# Clustering candidates (same signal at nearby DM/acc or at a harmonic)
+###############################################################################
+
+def parse_rank_by(rank_by):
+    """
+    Parse a score definition like "snr:1,nassoc:0.1,cluster_size:0.5"
+    (a column with no weight gets 1) into a dict of weights
+    """
+    weights = {}
+    for item in str(rank_by or "snr").split(','):
+        item = item.strip()
+        if not item:
+            continue
+        col, _, weight = item.partition(':')
+        weights[col.strip()] = float(weight) if weight else 1.0
+    return weights
+
+def candidate_score(df, weights):
+    """
+    Weighted sum of candidate columns, used to decide which candidates
+    to fold first. Columns that are missing are skipped (with a warning,
+    eg cluster_size without --cluster), and so are values missing from
+    the xml for a candidate (see read_peasoup_xml).
+    """
+    score = pd.Series(0.0, index=df.index)
+    for col, weight in weights.items():
+        if col in df.columns:
+            vals = df[col].astype(float)
+            if df[col].dtype == np.int64:
+                vals = vals.mask(df[col] == MISSING_INT)
+            score += weight * vals.fillna(0.0)
+        else:
+            logging.warning(f"Score column {col} not in the candidates, skipping it")
+    return score
+
+def rank_candidates(df, weights):
+    """
+    The candidates sorted by score, best first (ties keep their order)
+    """
+    score = candidate_score(df, weights)
+    return df.loc[score.sort_values(ascending=False, kind='stable').index]
+
+def select_within_budget(df, costs, budget, weights):
+    """
+    Go down the candidates from the best score, keeping each one whose
+    estimated fold cost (in the same units as budget) still fits in what
+    is left of the budget.
+    """
+    costs = pd.Series(np.asarray(costs, dtype=float), index=df.index)
+    ranked = rank_candidates(df, weights)
+    keep = []
+    left = budget
+    for idx, cost in costs.loc[ranked.index].items():
+        if cost <= left:
+            keep.append(idx)
+            left -= cost
+    sel = df.loc[keep]
+    logging.info(f"Fold budget {budget:.0f} core-s: folding {len(sel)} of {len(df)} candidates "
+                 f"(estimated {costs.loc[sel.index].sum():.0f} core-s, "
+                 f"all would take {costs.sum():.0f} core-s)")
+    return sel.sort_values(by='cand_id_in_file').reset_index(drop=True)
+
+def cluster_candidates(df, period_tol=5e-4, dm_tol=10.0, acc_tol=5.0, harmonics=(1.0,)):
+    """
+    Group candidates that are the same signal. Going from the highest S/N
+    down, each candidate not yet in a cluster starts one, and takes in
+    every unclustered candidate with a period within a fraction period_tol
+    of h times its period (for each harmonic ratio h), a DM within dm_tol,
+    and an acceleration within acc_tol. The period windows are found with
+    np.searchsorted on the sorted periods.
+
+    Returns (cluster_id, cluster_size) per candidate, where the cluster_id
+    is the cand_id_in_file of the brightest member.
+    """
+    periods = df['period'].to_numpy(dtype=float)
+    dms = df['dm'].to_numpy(dtype=float)
+    accs = df['acc'].to_numpy(dtype=float)
+    ids = df['cand_id_in_file'].to_numpy()
+    harmonics = np.asarray(harmonics, dtype=float)
+
+    order = np.argsort(periods, kind='stable')
+    sorted_p = periods[order]
+    cluster = np.full(len(df), -1, dtype=int)
+
+    for ii in np.argsort(-df['snr'].to_numpy(dtype=float), kind='stable'):
+        if cluster[ii] >= 0:
+            continue
+        cluster[ii] = ii
+        lo = np.searchsorted(sorted_p, harmonics * periods[ii] * (1 - period_tol), side='left')
+        hi = np.searchsorted(sorted_p, harmonics * periods[ii] * (1 + period_tol), side='right')
+        for jlo, jhi in zip(lo, hi):
+            jj = order[jlo:jhi]
+            jj = jj[(cluster[jj] < 0) &
+                    (np.abs(dms[jj] - dms[ii]) <= dm_tol) &
+                    (np.abs(accs[jj] - accs[ii]) <= acc_tol)]
+            cluster[jj] = ii
+
+    sizes = np.bincount(cluster, minlength=len(df))
+    return ids[cluster], sizes[cluster]
+
+def sift_candidates(df, period_tol=5e-4, dm_tol=10.0, acc_tol=5.0, harmonics=(1.0,)):
+    """
+    Cluster the candidates (separately for each segment of a segmented
+    search) and keep the brightest of each cluster. Returns (kept, all),
+    where both have the cluster_id and cluster_size of each candidate.
+    """
+    df = df.copy()
+    df['cluster_id'] = -1
+    df['cluster_size'] = 0
+    if len(df) == 0:
+        return df, df
+
+    if all(col in df.columns for col in SEGMENT_COLS):
+        groups = [gdf.index for _, gdf in df.groupby(SEGMENT_COLS)]
+    else:
+        groups = [df.index]
+
+    for gidx in groups:
+        cid, size = cluster_candidates(df.loc[gidx], period_tol, dm_tol, acc_tol, harmonics)
+        df.loc[gidx, 'cluster_id'] = cid
+        df.loc[gidx, 'cluster_size'] = size
+
+    kept = df.loc[df['cluster_id'] == df['cand_id_in_file']].reset_index(drop=True)
+    logging.info(f"Clustered {len(df)} candidates into {len(kept)} "
+                 f"(period tol {period_tol}, DM tol {dm_tol}, acc tol {acc_tol}, "
+                 f"harmonics {[float(hh) for hh in harmonics]})")
+    return kept, df
+
 ###############################################################################
 # PulsarX Candidate File
 ###############################################################################
 
-def generate_pulsarX_cand_file_accel_search(cand_freqs, cand_dms, cand_accs, cand_snrs):
-    cand_file_path = 'pulsarx.candfile'
+def generate_pulsarX_cand_file_accel_search(cand_freqs, cand_dms, cand_accs, cand_snrs,
+                                            cand_file_path='pulsarx.candfile', cand_ids=None):
+    if cand_ids is None:
+        cand_ids = range(len(cand_freqs))
     with open(cand_file_path, 'w') as f:
         f.write("#id DM accel F0 F1 F2 S/N\n")
         for i in range(len(cand_freqs)):
-            f.write(f"{i} {cand_dms[i]} {cand_accs[i]} {cand_freqs[i]} 0 0 {cand_snrs[i]}\n")
+            f.write(f"{cand_ids[i]} {cand_dms[i]} {cand_accs[i]} {cand_freqs[i]} 0 0 {cand_snrs[i]}\n")
     logging.info(f"Generated Accel Search PulsarX candidate file: {cand_file_path}")
     return cand_file_path
 
-def generate_pulsarX_cand_file_keplerian_search(cand_freqs, cand_dms, cand_pb, cand_a1, cand_t0, cand_omega, cand_ecc, cand_snrs):
-    cand_file_path = 'pulsarx.candfile'
+def generate_pulsarX_cand_file_keplerian_search(cand_freqs, cand_dms, cand_pb, cand_a1, cand_t0, cand_omega, cand_ecc, cand_snrs,
+                                                cand_file_path='pulsarx.candfile', cand_ids=None):
+    if cand_ids is None:
+        cand_ids = range(len(cand_freqs))
     with open(cand_file_path, 'w') as f:
         f.write("#id DM accel F0 F1 F2 PB A1 T0 OM ECC S/N\n")
         for i in range(len(cand_freqs)):
-            f.write(f"{i} {cand_dms[i]} 0 {cand_freqs[i]} 0 0 {cand_pb[i]} {cand_a1[i]} {cand_t0[i]} {cand_omega[i]} {cand_ecc[i]} {cand_snrs[i]}\n")
+            f.write(f"{cand_ids[i]} {cand_dms[i]} 0 {cand_freqs[i]} 0 0 {cand_pb[i]} {cand_a1[i]} {cand_t0[i]} {cand_omega[i]} {cand_ecc[i]} {cand_snrs[i]}\n")
     logging.info(f"Generated Keplerian PulsarX candidate file: {cand_file_path}")
     return cand_file_path
 
@@ -258,22 +582,32 @@ def a_to_pdot(P_s, acc_ms2):
 # Folding with Presto
 ###############################################################################
 
+# prepfold does a much bigger search with -slow
+PREPFOLD_SLOW_PERIOD = 0.1
+
 def run_prepfold(args):
     """
     args is a tuple:
-      (row, filterbank_file, tsamp, fft_size, source_name_prefix, rfifind_mask, extra_args)
+      (row, filterbank_file, tsamp, fft_size, source_name_prefix, rfifind_mask, extra_args,
+       timeout, retries)
+
+    Returns (success, cand_id, error, seconds, attempts). A prepfold that fails
+    or takes longer than timeout seconds (if not None) is tried again up to
+    retries times.
     """
-    row, filterbank_file, tsamp, fft_size, source_name_prefix, rfifind_mask, extra_args = args
+    row, filterbank_file, tsamp, fft_size, source_name_prefix, rfifind_mask, extra_args, \
+        timeout, retries = args
     fold_period, pdot, cand_id, dm = row
     output_filename = source_name_prefix + '_Peasoup_fold_candidate_id_' + str(int(cand_id) + 1)
 
     cmd = "prepfold -fixchi -noxwin -topo"
 
     # Slow search if period > 0.1s
-    if fold_period > 0.1:
+    if fold_period > PREPFOLD_SLOW_PERIOD:
         cmd += " -slow"
 
-    if rfifind_mask:
+    # The mask is applied when dedispersing, so only raw data need it
+    if rfifind_mask and not filterbank_file.endswith('.dat'):
         cmd += f" -mask {rfifind_mask}"
 
     # Add the fundamental folding parameters
@@ -283,16 +617,40 @@ def run_prepfold(args):
     if extra_args:
         cmd += f" {extra_args}"
 
-    try:
-        logging.debug(f"Running Presto command: {cmd}")
-        subprocess.check_output(cmd, shell=True)
-        return (True, cand_id)
-    except subprocess.CalledProcessError as e:
-        return (False, cand_id, str(e))
+    t_start = time.time()
+    error = None
+    for attempt in range(1, retries + 2):
+        try:
+            logging.debug(f"Running Presto command: {cmd}")
+            subprocess.run(shlex.split(cmd), stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, check=True, timeout=timeout)
+            return (True, cand_id, None, time.time() - t_start, attempt)
+        except subprocess.TimeoutExpired:
+            error = f"prepfold timed out after {timeout} s (attempt {attempt})"
+        except (subprocess.CalledProcessError, OSError) as e:
+            stderr = getattr(e, 'stderr', None)
+            error = f"{e} (attempt {attempt})"
+            if stderr:
+                error += ": " + stderr.decode(errors='replace').strip().splitlines()[-1]
+    return (False, cand_id, error, time.time() - t_start, retries + 1)
 
 def fold_with_presto(df, filterbank_file, tsamp, fft_size, source_name_prefix,
-                     prepfold_threads, rfifind_mask=None, extra_args=None):
-    num_cores = min(prepfold_threads, len(df))
+                     prepfold_threads, rfifind_mask=None, extra_args=None,
+                     timeout=None, retries=1, progress_interval=30.0):
+    """
+    Fold each candidate with prepfold, prepfold_threads at a time. The
+    slow (-slow, long period) candidates go first so that the end of the
+    run is not one long fold, and progress is logged as folds finish.
+
+    filterbank_file is either one file for all the candidates, or a list
+    with a file for each (eg, the dedispersed time series from
+    dedisperse_dm_groups).
+    """
+    if len(df) == 0:
+        logging.info("No candidates to fold with Presto")
+        return
+
+    num_cores = max(1, min(prepfold_threads, len(df)))
 
     period = df['period'].values
     acc = df['acc'].values
@@ -300,24 +658,393 @@ def fold_with_presto(df, filterbank_file, tsamp, fft_size, source_name_prefix,
     fold_period = period_correction_for_prepfold(period, pdot, tsamp, fft_size)
 
     merged_data = np.column_stack((fold_period, pdot, df['cand_id_in_file'].values, df['dm'].values))
+    if isinstance(filterbank_file, str):
+        input_files = [filterbank_file] * len(df)
+    else:
+        input_files = list(filterbank_file)
+
+    # Longest expected folds first
+    order = np.lexsort((-fold_period, fold_period <= PREPFOLD_SLOW_PERIOD))
     args_list = [
-        (row, filterbank_file, tsamp, fft_size, source_name_prefix, rfifind_mask, extra_args)
-        for row in merged_data
+        (merged_data[ii], input_files[ii], tsamp, fft_size, source_name_prefix, rfifind_mask,
+         extra_args, timeout, retries)
+        for ii in order
     ]
+    logging.info(f"Folding {len(args_list)} candidates with prepfold, {num_cores} at a time "
+                 f"({int((fold_period > PREPFOLD_SLOW_PERIOD).sum())} with -slow)")
+
+    t_start = time.time()
+    last_log = t_start
+    ndone = 0
+    failed = []
+    with Pool(num_cores) as pool:
+        for result in pool.imap_unordered(run_prepfold, args_list, chunksize=1):
+            ndone += 1
+            if not result[0]:  # If success is False
+                logging.error(f"Error with candidate ID {int(result[1])}: {result[2]}")
+                failed.append(int(result[1]))
+            elif result[4] > 1:
+                logging.info(f"Candidate ID {int(result[1])} folded on attempt {result[4]}")
+
+            now = time.time()
+            if now - last_log >= progress_interval or ndone == len(args_list):
+                rate = ndone / max(now - t_start, 1e-6)
+                eta = (len(args_list) - ndone) / rate
+                logging.info(f"prepfold: {ndone}/{len(args_list)} done, {len(failed)} failed, "
+                             f"{60 * rate:.1f} folds/min, about {eta / 60:.1f} min left")
+                last_log = now
+
+    if failed:
+        logging.error(f"{len(failed)} of {len(args_list)} prepfolds failed: {failed}")
 
-    pool = Pool(num_cores)
-    results = pool.map(run_prepfold, args_list)
-    pool.close()
-    pool.join()
+###############################################################################
+# Dedisperse once for Presto
+###############################################################################
 
-    for result in results:
-        if not result[0]:  # If success is False
-            logging.error(f"Error with candidate ID {result[1]}: {result[2]}")
+def group_by_dm(dms, dm_tol):
+    """
+    Group DMs so that every DM in a group is within dm_tol of the
+    middle of the group. Returns (group of each DM, DM of each group).
+    """
+    dms = np.asarray(dms, dtype=float)
+    order = np.argsort(dms, kind='stable')
+    groups = np.zeros(len(dms), dtype=int)
+    group_dms = []
+    start = None
+    for ii in order:
+        if start is None or dms[ii] > start + 2 * dm_tol:
+            if start is not None:
+                group_dms.append(0.5 * (start + last))
+            start = dms[ii]
+        last = dms[ii]
+        groups[ii] = len(group_dms)
+    if start is not None:
+        group_dms.append(0.5 * (start + last))
+    return groups, np.array(group_dms)
+
+def run_prepsubband(args):
+    """
+    args is a tuple: (dm, filterbank_file, outbase, nsub, rfifind_mask, timeout)
+    Makes one dedispersed time series. Returns (success, dm, datfile, error).
+    """
+    dm, filterbank_file, outbase, nsub, rfifind_mask, timeout = args
+    cmd = f"prepsubband -nobary -nsub {nsub} -lodm {dm:.2f} -dmstep 1 -numdms 1 -o {outbase}"
+    if rfifind_mask:
+        cmd += f" -mask {rfifind_mask}"
+    cmd += f" {filterbank_file}"
+    datfile = f"{outbase}_DM{dm:.2f}.dat"
+    try:
+        logging.debug(f"Running Presto command: {cmd}")
+        subprocess.run(shlex.split(cmd), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       check=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return (False, dm, datfile, f"prepsubband timed out after {timeout} s")
+    except (subprocess.CalledProcessError, OSError) as e:
+        return (False, dm, datfile, str(e))
+    if not os.path.exists(datfile):
+        return (False, dm, datfile, f"{datfile} was not made")
+    return (True, dm, datfile, None)
+
+def dedisperse_dm_groups(dms, dm_tol, filterbank_file, outbase, nsub, nproc,
+                         rfifind_mask=None, timeout=None, dat_files=None):
+    """
+    Make one dedispersed time series (with prepsubband) for each group of
+    DMs (see group_by_dm), nproc at a time, and return the .dat file to
+    fold for each DM (or the filterbank file if its prepsubband failed).
+    dat_files is a dict of {dm: datfile} already made, which is updated.
+    """
+    if dat_files is None:
+        dat_files = {}
+    groups, group_dms = group_by_dm(dms, dm_tol)
+    group_dms = np.round(group_dms, 2)
+    todo = [dm for dm in np.unique(group_dms) if dm not in dat_files]
+    logging.info(f"{len(dms)} candidates in {len(group_dms)} DM groups (tolerance {dm_tol}), "
+                 f"dedispersing {len(todo)}")
+
+    if todo:
+        args_list = [(dm, filterbank_file, outbase, nsub, rfifind_mask, timeout) for dm in todo]
+        with Pool(max(1, min(nproc, len(todo)))) as pool:
+            for ok, dm, datfile, error in pool.imap_unordered(run_prepsubband, args_list):
+                if ok:
+                    dat_files[dm] = datfile
+                else:
+                    logging.error(f"Dedispersing DM {dm:.2f} failed, folding the filterbank "
+                                  f"for those candidates: {error}")
+                    dat_files[dm] = filterbank_file
+
+    return [dat_files[group_dms[gg]] for gg in groups]
+
+def remove_dat_files(dat_files):
+    for datfile in set(dat_files.values()):
+        if datfile.endswith('.dat'):
+            for ff in [datfile, datfile[:-4] + '.inf']:
+                if os.path.exists(ff):
+                    os.remove(ff)
 
 ###############################################################################
 # Folding with PulsarX
 ###############################################################################
 
+def pulsarx_fold_cost(periods, nbins_low, nbins_high, nbin_period=0.01, nsubband=64):
+    """
+    Rough relative cost of folding each candidate with psrfold_fil2. Every
+    candidate pays for a pass over the data (taken as nbins_low), plus the
+    profile bins it is folded into (nbins_high above nbin_period, the
+    --nbinplan cut, nbins_low below) for each of nsubband subbands
+    (relative to 64).
+    """
+    periods = np.asarray(periods, dtype=float)
+    nbins = np.where(periods > nbin_period, nbins_high, nbins_low)
+    return nbins_low + nbins * nsubband / 64.
+
+def fold_core_seconds(df, total_nsamples, nbins_low, nbins_high, nsubband, fold_core_sec):
+    """
+    Estimated core-seconds to fold each candidate, where fold_core_sec is
+    the time for one candidate with 64 bins and 64 subbands (at nbins_low
+    = 64) over the whole observation. Candidates from a segment only fold
+    that part of the data.
+    """
+    ref = pulsarx_fold_cost([1.0], 64, 64, nsubband=64)[0]
+    cost = pulsarx_fold_cost(df['period'].values, nbins_low, nbins_high, nsubband=nsubband) / ref
+    if 'segment_nsamples' in df.columns and total_nsamples > 0:
+        cost = cost * df['segment_nsamples'].values / float(total_nsamples)
+    return fold_core_sec * cost
+
+###############################################################################
+# Incremental folding
+###############################################################################
+
+FOLD_INDEX = "fold_index.json"
+
+# Output files are named <rootname>..._<id>.<ext> with the id from the candfile
+PULSARX_ID_DIGITS = 5
+
+KEY_COLS = ['period', 'dm', 'acc', 'pb', 'a1', 't0', 'omega', 'ecc']
+
+def load_fold_index(path=FOLD_INDEX):
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_fold_index(index, path=FOLD_INDEX):
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+def file_hash(path):
+    if path is None or not os.path.exists(path):
+        return str(path)
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def fold_keys(df, settings):
+    """
+    Key for each candidate from its fold parameters (F0, DM, acc, orbit)
+    and the settings string (bins, template, cdm, fractions, ...), so a
+    candidate is only folded again if something that changes its fold
+    has changed.
+    """
+    cols = [col for col in KEY_COLS if col in df.columns]
+    vals = df[cols].to_numpy(dtype=float)
+    keys = []
+    for row in vals:
+        text = settings + "|" + "|".join(f"{vv:.12g}" for vv in row)
+        keys.append(hashlib.sha1(text.encode()).hexdigest()[:16])
+    return keys
+
+def list_fold_outputs(output_rootname):
+    """
+    Plots and archives ({id: [files]}) and .cands files psrfold_fil2 made
+    for output_rootname, from one listing of its directory. Only names of
+    the form <rootname>[_<beam>]_<id>.png/.ar and <rootname>[_<beam>].cands
+    count, so other rootnames that start the same way are not picked up.
+    """
+    dirname, base = os.path.split(output_rootname)
+    stem = re.escape(base) + r"(?:_\d+)?"
+    plot_re = re.compile(stem + rf"_(\d{{{PULSARX_ID_DIGITS},}})\.(?:png|ar)$")
+    cands_re = re.compile(stem + r"\.cands$")
+    outputs, cands_files = {}, []
+    for name in sorted(os.listdir(dirname or '.')):
+        path = os.path.join(dirname, name)
+        match = plot_re.match(name)
+        if match:
+            outputs.setdefault(int(match.group(1)), []).append(path)
+        elif cands_re.match(name):
+            cands_files.append(path)
+    return outputs, cands_files
+
+def read_pulsarx_cands(cands_file):
+    """
+    Header lines and {id: line} of a psrfold_fil2 .cands file
+    """
+    header, rows = [], {}
+    with open(cands_file, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                header.append(line)
+            elif line.strip():
+                try:
+                    rows[int(line.split()[0])] = line
+                except ValueError:
+                    continue
+    return header, rows
+
+def update_fold_index(index, keys, cand_ids, output_rootname):
+    """
+    Add the candidates that were just folded to the index, with their
+    output files and their row of the .cands file
+    """
+    outputs, cands_files = list_fold_outputs(output_rootname)
+    cands_rows = {}
+    for cfile in cands_files:
+        header, rows = read_pulsarx_cands(cfile)
+        for cid, line in rows.items():
+            cands_rows[cid] = (cfile, header, line)
+
+    # Which entry each file belongs to now
+    owners = {ff: kk for kk, ee in index.items() for ff in ee['files']}
+
+    for key, cid in zip(keys, cand_ids):
+        files = outputs.get(int(cid), [])
+        if not files:
+            logging.warning(f"No fold outputs found for candidate {cid}")
+            continue
+        # Older entries for the same files were overwritten
+        for old in set(owners[ff] for ff in files if ff in owners):
+            for ff in index.pop(old, {}).get('files', []):
+                owners.pop(ff, None)
+        entry = {"cand_id": int(cid), "files": files}
+        if int(cid) in cands_rows:
+            cfile, header, line = cands_rows[int(cid)]
+            entry.update({"cands_file": cfile, "cands_header": header, "cands_row": line})
+        index[key] = entry
+        for ff in files:
+            owners[ff] = key
+    return index
+
+def write_cands_from_index(index, keys):
+    """
+    Rewrite the .cands files to hold all the candidates in keys (folded
+    now or before)
+    """
+    files = {}
+    for key in keys:
+        entry = index.get(key, {})
+        if "cands_file" in entry:
+            header, rows = files.setdefault(entry["cands_file"], (entry["cands_header"], []))
+            rows.append(entry["cands_row"])
+    for cfile, (header, rows) in files.items():
+        rows.sort(key=lambda line: int(line.split()[0]))
+        with open(cfile, 'w') as f:
+            f.writelines(header + rows)
+
+###############################################################################
+# Two pass folding
+###############################################################################
+
+def coarse_fold_snr(output_rootname, cand_ids):
+    """
+    Folded S/N of each candidate (by its id in the candfile, see cand_ids)
+    from the .cands files psrfold_fil2 wrote for output_rootname, taken
+    from the S/N_new column (or S/N if there is none). Candidates that are
+    missing get NaN.
+    """
+    found = {}
+    for cfile in list_fold_outputs(output_rootname)[1]:
+        header, rows = read_pulsarx_cands(cfile)
+        names = header[-1].lstrip('#').split() if header else []
+        col = None
+        for name in ['S/N_new', 'S/N']:
+            if name in names:
+                col = names.index(name)
+                break
+        if col is None:
+            logging.warning(f"No S/N column in {cfile}")
+            continue
+        for cid, line in rows.items():
+            vals = line.split()
+            if col < len(vals):
+                try:
+                    found[cid] = float(vals[col])
+                except ValueError:
+                    pass
+    return np.array([found.get(int(cid), np.nan) for cid in cand_ids])
+
+def coarse_rootname(output_rootname):
+    """
+    Rootname for the first pass: coarse_<rootname>, so that no name from
+    the first pass starts with the full fold's rootname
+    """
+    dirname, base = os.path.split(output_rootname)
+    return os.path.join(dirname, f"coarse_{base}")
+
+def remove_fold_outputs(output_rootname):
+    for files in list_fold_outputs(output_rootname)[0].values():
+        for ff in files:
+            os.remove(ff)
+
+def select_refold(df, refold_top=None, refold_snr=None):
+    """
+    Mark the candidates to fold again at full resolution: the top
+    refold_top by coarse S/N and/or those with coarse S/N >= refold_snr
+    (the top 10% if neither is given).
+    """
+    if refold_top is None and refold_snr is None:
+        refold_top = max(1, int(np.ceil(0.1 * len(df))))
+    order = df['coarse_snr'].fillna(-np.inf).sort_values(ascending=False, kind='stable')
+    refold = pd.Series(False, index=df.index)
+    if refold_top is not None:
+        refold.loc[order.index[:refold_top]] = True
+    if refold_snr is not None:
+        refold |= df['coarse_snr'] >= refold_snr
+    df['refold'] = refold
+    logging.info(f"Refolding {int(refold.sum())} of {len(df)} candidates "
+                 f"(top {refold_top}, S/N >= {refold_snr})")
+    return df
+
+def partition_candidates(costs, nparts):
+    """
+    Split candidates into nparts groups of about the same total cost
+    (largest first, each to the group with the least so far).
+    Returns a list of index arrays, each in the original order.
+    """
+    nparts = max(1, min(int(nparts), len(costs)))
+    heap = [(0.0, kk) for kk in range(nparts)]
+    parts = [[] for _ in range(nparts)]
+    for ii in np.argsort(-np.asarray(costs), kind='stable'):
+        load, kk = heapq.heappop(heap)
+        parts[kk].append(ii)
+        heapq.heappush(heap, (load + costs[ii], kk))
+    return [np.sort(np.array(pp, dtype=int)) for pp in parts if len(pp)]
+
+def merge_pulsarx_cands(cands_files, outfile):
+    """
+    Merge the .cands files written by each psrfold_fil2 process into
+    one, with the header from the first and the rows sorted by id.
+    """
+    header = []
+    rows = []
+    for ii, cfile in enumerate(cands_files):
+        with open(cfile, 'r') as f:
+            for line in f:
+                if line.startswith('#'):
+                    if ii == 0:
+                        header.append(line)
+                elif line.strip():
+                    rows.append(line)
+
+    def row_id(line):
+        try:
+            return int(line.split()[0])
+        except ValueError:
+            return -1
+
+    rows.sort(key=row_id)
+    with open(outfile, 'w') as f:
+        f.writelines(header + rows)
+    return len(rows)
+
 def fold_with_pulsarx(
     df, segment_start_sample, segment_nsamples, pepoch,
     total_nsamples, input_filenames, source_name_prefix,
@@ -325,13 +1052,33 @@ def fold_with_pulsarx(
     beam_name, pulsarx_threads, TEMPLATE, clfd_q_value,
     rfi_filter, cmask=None, start_fraction=None, end_fraction=None,
     extra_args=None, output_rootname=None, coherent_dm=0.0,
-    custom_nbin_plan=None, pulsarx_folding_algorithm="render"
+    custom_nbin_plan=None, pulsarx_folding_algorithm="render",
+    cand_file_path='pulsarx.candfile', nproc=1, fold_index=None,
+    need_outputs=True
 ):
     """
     Fold candidates with pulsarx (psrfold_fil). 
     'pepoch', 'start_fraction', and 'end_fraction' are either user-provided or derived.
+
+    If nproc > 1, the candidates are split into nproc partitions of about the
+    same fold cost (see pulsarx_fold_cost), and each is folded by its own
+    psrfold_fil2 (in its own directory, sharing pulsarx_threads) at the same
+    time. The outputs are moved back here and the .cands files merged, so
+    the file names are the same as for a single process.
+
+    If fold_index is given (a dict, see load_fold_index), the candidates
+    are named by cand_id_in_file, and those already folded with the same
+    parameters (see fold_keys) and whose outputs are still here are skipped.
+    The candfile only has the ones left to fold, and fold_index is updated.
+    With need_outputs=False a candidate in fold_index is skipped even if its
+    outputs were removed since (the first pass of two pass folding only
+    needs the S/N in the .cands file).
     """
 
+    if len(df) == 0:
+        logging.info("No candidates to fold with PulsarX")
+        return
+
     additional_flags = ""
     pulsarx_folding_algorithm = pulsarx_folding_algorithm.strip().lower()
     if pulsarx_folding_algorithm not in ["render", "dspsr", "presto"]:
@@ -340,6 +1087,32 @@ def fold_with_pulsarx(
         sys.exit(1)
     additional_flags += f"--{pulsarx_folding_algorithm} "
 
+    if output_rootname is None:
+        output_rootname = utc_beam
+
+    # Number candidates by their place in df, or by their id in the xml
+    # when folding incrementally (so the names stay the same between runs)
+    out_ids = np.arange(len(df))
+    if fold_index is not None:
+        settings = "|".join(str(xx) for xx in [
+            nbins_high, nbins_low, custom_nbin_plan, file_hash(TEMPLATE), coherent_dm,
+            pepoch, start_fraction, end_fraction, subint_length, nsubband, clfd_q_value,
+            rfi_filter, cmask, pulsarx_folding_algorithm, extra_args, input_filenames,
+            output_rootname, beam_name, source_name_prefix])
+        all_keys = fold_keys(df, settings)
+        done = np.array([key in fold_index and len(fold_index[key]['files']) > 0 and
+                         (not need_outputs or
+                          all(os.path.exists(ff) for ff in fold_index[key]['files']))
+                         for key in all_keys], dtype=bool)
+        logging.info(f"{done.sum()} of {len(df)} candidates were already folded, "
+                     f"folding {(~done).sum()}")
+        todo_keys = [key for key, dd in zip(all_keys, done) if not dd]
+        df = df.loc[~done]
+        out_ids = df['cand_id_in_file'].to_numpy(dtype=int)
+        if len(df) == 0:
+            write_cands_from_index(fold_index, all_keys)
+            return
+
     cand_dms = df['dm'].values
     cand_accs = df['acc'].values
     cand_period = df['period'].values
@@ -351,15 +1124,22 @@ def fold_with_pulsarx(
     cand_omega = df['omega'].values
     cand_ecc = df['ecc'].values
 
-    if cand_pb[0] > 0.0:
-        logging.info("Detected Keplerian candidates, generating PulsarX candidate file for Keplerian search.")
-        pulsarx_predictor = generate_pulsarX_cand_file_keplerian_search(cand_freq,
-            cand_dms, cand_pb, cand_a1, cand_t0,
-            cand_omega, cand_ecc, cand_snrs)
-        
-    else:
-        logging.info("Detected Acceleration search candidates, generating PulsarX candidate file for Acceleration search.")
-        pulsarx_predictor = generate_pulsarX_cand_file_accel_search(cand_freq, cand_dms, cand_accs, cand_snrs)
+    def write_cand_file(path, idx=None):
+        if idx is None:
+            idx = np.arange(len(cand_freq))
+        if cand_pb[0] > 0.0:
+            logging.info("Detected Keplerian candidates, generating PulsarX candidate file for Keplerian search.")
+            return generate_pulsarX_cand_file_keplerian_search(cand_freq[idx],
+                cand_dms[idx], cand_pb[idx], cand_a1[idx], cand_t0[idx],
+                cand_omega[idx], cand_ecc[idx], cand_snrs[idx], cand_file_path=path, cand_ids=out_ids[idx])
+        else:
+            logging.info("Detected Acceleration search candidates, generating PulsarX candidate file for Acceleration search.")
+            return generate_pulsarX_cand_file_accel_search(cand_freq[idx], cand_dms[idx], cand_accs[idx],
+                                                           cand_snrs[idx], cand_file_path=path, cand_ids=out_ids[idx])
+
+    # The full candfile (of what is left to fold) is always written, it
+    # is kept with the results
+    pulsarx_predictor = write_cand_file(cand_file_path)
     
     if custom_nbin_plan is not None:
         #custom_nbin_plan = " ".join(custom_nbin_plan)
@@ -370,9 +1150,6 @@ def fold_with_pulsarx(
             logging.error("Custom nbin plan must start with '-b'. Please provide a valid nbin plan.")
     else:
         nbins_string = "-b {} --nbinplan 0.01 {}".format(nbins_low, nbins_high)
-    
-    if output_rootname is None:
-        output_rootname = utc_beam
 
     if 'ifbf' in beam_name:
         beam_tag = "--incoherent"
@@ -395,69 +1172,188 @@ def fold_with_pulsarx(
     if rfi_filter:
         additional_flags += f"--rfi {rfi_filter} "
     
-    # Build the base command
-    script = (
-        "psrfold_fil2 -v --output_width --cdm {} -t {} --candfile {} -n {} {} {} --template {} "
-        "--clfd {} -L {} -f {} {} -o {} --srcname {} --pepoch {} --frac {} {} {}"
-    ).format(
-        coherent_dm,
-        pulsarx_threads,
-        pulsarx_predictor,
-        nsubband,
-        nbins_string,
-        beam_tag,
-        TEMPLATE,
-        clfd_q_value,
-        subint_length,
-        input_filenames,
-        zap_string,
-        output_rootname,
-        source_name_prefix,
-        pepoch,
-        start_fraction,
-        end_fraction,
-        additional_flags
-    )
-    print(script)
+    if nproc > 1 and len(df) > 1:
+        costs = pulsarx_fold_cost(cand_period, nbins_low, nbins_high)
+        parts = partition_candidates(costs, nproc)
+    else:
+        parts = [None]
+    nthreads = max(1, int(pulsarx_threads) // len(parts))
+
+    # Files given relative to here need to be found from the part dirs
+    def here(path):
+        return os.path.abspath(path) if os.path.exists(path) else path
+
+    procs = []
+    for kk, idx in enumerate(parts):
+        if idx is None:
+            part_dir = None
+            predictor = pulsarx_predictor
+            threads = pulsarx_threads
+            template, filenames = TEMPLATE, input_filenames
+        else:
+            part_dir = f"{os.path.splitext(cand_file_path)[0]}_part{kk:02d}"
+            os.makedirs(part_dir, exist_ok=True)
+            predictor = write_cand_file(f"{part_dir}/pulsarx.candfile", idx)
+            predictor = os.path.abspath(predictor)
+            threads = nthreads
+            template = here(TEMPLATE)
+            filenames = " ".join(here(ff) for ff in input_filenames.split())
+            logging.info(f"Part {kk}: {len(idx)} candidates, cost {costs[idx].sum():.0f}, "
+                         f"{threads} threads")
+
+        # Build the base command
+        script = (
+            "psrfold_fil2 -v --output_width --cdm {} -t {} --candfile {} -n {} {} {} --template {} "
+            "--clfd {} -L {} -f {} {} -o {} --srcname {} --pepoch {} --frac {} {} {}"
+        ).format(
+            coherent_dm,
+            threads,
+            predictor,
+            nsubband,
+            nbins_string,
+            beam_tag,
+            template,
+            clfd_q_value,
+            subint_length,
+            filenames,
+            zap_string,
+            output_rootname,
+            source_name_prefix,
+            pepoch,
+            start_fraction,
+            end_fraction,
+            additional_flags
+        )
+        print(script)
+
+        # Append extra_args if provided
+        if extra_args:
+            script += f" {extra_args}"
+
+        logging.debug(f"Running PulsarX command: {script}")
+
+        # Run the command
+        process = subprocess.Popen(
+            shlex.split(script),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1,  # line-buffered
+            cwd=part_dir
+        )
 
-    # Append extra_args if provided
-    if extra_args:
-        script += f" {extra_args}"
+        logger = logging.getLogger()
+        if part_dir is not None:
+            logger = PrefixLogger(logger, {"prefix": f"part{kk:02d}"})
 
-    logging.debug(f"Running PulsarX command: {script}")
+        # Two threads, one for stdout (INFO level), one for stderr (WARNING level)
+        stdout_thread = threading.Thread(
+            target=buffered_stream_output,
+            args=(process.stdout, logger, logging.INFO, 10.0),
+            daemon=True
+        )
+        stderr_thread = threading.Thread(
+            target=buffered_stream_output,
+            args=(process.stderr, logger, logging.WARNING, 10.0),
+            daemon=True
+        )
 
-    # Run the command
-    process = subprocess.Popen(
-        shlex.split(script),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1  # line-buffered
-    )
+        stdout_thread.start()
+        stderr_thread.start()
+        procs.append((process, stdout_thread, stderr_thread, part_dir))
+
+    failed = 0
+    for process, stdout_thread, stderr_thread, part_dir in procs:
+        stdout_thread.join()
+        stderr_thread.join()
+
+        return_code = process.wait()
+
+        if return_code != 0:
+            logging.error(f"psrfold_fil2 returned non-zero exit status {return_code}"
+                          + (f" in {part_dir}" if part_dir else ""))
+            failed += 1
+
+    # Bring back what each part made (even if some failed) and
+    # merge the .cands files, which have the same name in each
+    if parts[0] is not None:
+        cands_files = {}
+        for process, stdout_thread, stderr_thread, part_dir in procs:
+            for ff in sorted(glob.glob(f"{part_dir}/*")):
+                name = os.path.basename(ff)
+                if name == "pulsarx.candfile":
+                    continue
+                if name.endswith(".cands"):
+                    cands_files.setdefault(name, []).append(ff)
+                else:
+                    shutil.move(ff, name)
+        for name, files in cands_files.items():
+            nrows = merge_pulsarx_cands(files, name)
+            logging.info(f"Merged {len(files)} parts into {name} ({nrows} candidates)")
+        for process, stdout_thread, stderr_thread, part_dir in procs:
+            shutil.rmtree(part_dir)
+
+    # Record what was folded (even if some failed, so it is not redone)
+    if fold_index is not None:
+        update_fold_index(fold_index, todo_keys, out_ids, output_rootname)
+        save_fold_index(fold_index)
+        write_cands_from_index(fold_index, all_keys)
+
+    if failed:
+        logging.error(f"{failed} of {len(procs)} psrfold_fil2 processes failed")
+        sys.exit(1)
 
-    # Two threads, one for stdout (INFO level), one for stderr (WARNING level)
-    stdout_thread = threading.Thread(
-        target=buffered_stream_output,
-        args=(process.stdout, logging.getLogger(), logging.INFO, 10.0),
-        daemon=True
-    )
-    stderr_thread = threading.Thread(
-        target=buffered_stream_output,
-        args=(process.stderr, logging.getLogger(), logging.WARNING, 10.0),
-        daemon=True
-    )
+###############################################################################
+# Segments
+###############################################################################
 
-    stdout_thread.start()
-    stderr_thread.start()
+SEGMENT_COLS = ['segment_start_sample', 'segment_nsamples', 'segment_pepoch']
 
-    stdout_thread.join()
-    stderr_thread.join()
+def segment_fold_params(args, segment_start_sample, segment_nsamples, xml_segment_pepoch,
+                        total_nsamples, tsamp):
+    """
+    Work out the pepoch, start/end fractions and effective tobs for folding
+    a segment, using the user overrides if given.
+    """
+    # Decide which pepoch to use
+    if args.pepoch_override is not None:
+        segment_pepoch = args.pepoch_override
+        logging.info(f"Using user-provided pepoch = {segment_pepoch}")
+    else:
+        segment_pepoch = xml_segment_pepoch
+        logging.info(f"Using pepoch from XML = {segment_pepoch}")
 
-    return_code = process.wait()
+    # If user hasn't supplied explicit start_frac / end_frac, compute from XML data
+    if args.start_frac is not None:
+        user_start_fraction = args.start_frac
+        logging.info(f"Using user-provided start_frac = {user_start_fraction}")
+    else:
+        user_start_fraction = round(segment_start_sample / total_nsamples, 3)
+        logging.info(f"Using start_frac derived from XML = {user_start_fraction}")
 
-    if return_code != 0:
-        logging.error(f"psrfold_fil2 returned non-zero exit status {return_code}")
-        sys.exit(1)
+    if args.end_frac is not None:
+        user_end_fraction = args.end_frac
+        logging.info(f"Using user-provided end_frac = {user_end_fraction}")
+    else:
+        user_end_fraction = round((segment_start_sample + segment_nsamples) / total_nsamples, 3)
+        logging.info(f"Using end_frac derived from XML = {user_end_fraction}")
+
+    effective_tobs = tsamp * segment_nsamples
+
+    return segment_pepoch, user_start_fraction, user_end_fraction, effective_tobs
+
+def segment_groups(df, segment_start_sample, segment_nsamples, xml_segment_pepoch):
+    """
+    Split the candidates by the segment they were found in. Candidates from a
+    segmented search (see peasoup_xml.py) carry their own segment, otherwise
+    everything belongs to the segment in the XML header.
+    Returns a list of ((start, nsamples, pepoch), df).
+    """
+    if all(col in df.columns for col in SEGMENT_COLS) and len(df):
+        groups = [(tuple(key), gdf) for key, gdf in df.groupby(SEGMENT_COLS, sort=True)]
+        logging.info(f"Candidates come from {len(groups)} segments")
+        return groups
+    return [((segment_start_sample, segment_nsamples, xml_segment_pepoch), df)]
 
 ###############################################################################
 # Main
@@ -494,8 +1390,19 @@ def main():
                         type=str, default='')
     parser.add_argument('-threads', '--pulsarx_threads', help='Number of threads to be used for pulsarx',
                         type=int, default=24)
+    parser.add_argument('-nproc', '--pulsarx_nproc', help='Number of psrfold_fil2 processes to split the candidates between (sharing pulsarx_threads)',
+                        type=int, default=1)
     parser.add_argument('-pthreads', '--presto_threads', help='Number of threads to be used for prepfold',
                         type=int, default=12)
+    parser.add_argument('--prepfold_timeout', type=float, default=None,
+                        help='Seconds before a prepfold is stopped (and tried again, see --prepfold_retries).')
+    parser.add_argument('--prepfold_retries', type=int, default=1,
+                        help='Number of times to try a failed or timed out prepfold again (default: 1).')
+    parser.add_argument('--presto_dm_tol', type=float, default=None,
+                        help='Fold with presto from time series made once (with prepsubband) for each group of '
+                             'candidates within this DM of each other, instead of from the filterbank each time.')
+    parser.add_argument('--keep_dat', action='store_true',
+                        help='Keep the dedispersed time series made for --presto_dm_tol.')
     parser.add_argument('-p', '--pulsarx_fold_template', help='Fold template pulsarx',
                         type=str, default='meerkat_fold.template')
     parser.add_argument('-v', '--verbose', action='store_true',
@@ -504,7 +1411,10 @@ def main():
                         type=str, default=None)
     parser.add_argument('--config_file', type=str, help="Path to JSON configuration file to pre-select candidates to fold.", default=None)
     parser.add_argument('--filtered_candidates_file', type=str, default="filtered_df_for_folding.csv",
-                    help="Path to CSV file for pre-selected candidates for folding.")
+                    help="Path to CSV file for pre-selected candidates for folding (see --export_csv). "
+                         "They are always saved as a parquet/npz table with the same base name.")
+    parser.add_argument('--export_csv', action='store_true',
+                        help='Also write the pre-selected candidates to --filtered_candidates_file as CSV.')
     # New arguments for pepoch, start_frac, end_frac overrides, and extra arguments
     parser.add_argument('--pepoch_override', type=float, default=None,
                         help='Override Pepoch value. If not provided, read from XML.')
@@ -521,6 +1431,51 @@ def main():
     parser.add_argument('--pulsarx_folding_algorithm', type=str, default="render",
                     help='Folding algorithm to use for PulsarX. If not provided, default is "render".')
     parser.add_argument('--avoid_folding_file', type=str, help="Path to CSV file with periods to avoid.", default=None)
+    parser.add_argument('--incremental', action='store_true',
+                        help=f'Only fold candidates not already folded with the same parameters (see {FOLD_INDEX}). '
+                             'PulsarX only, candidates are named by their id in the xml.')
+    parser.add_argument('--two_pass', action='store_true',
+                        help='Fold everything quickly first (see the --coarse options), then fold only the best '
+                             '(see --refold_top and --refold_snr) at full resolution. PulsarX only.')
+    parser.add_argument('--coarse_nbins', type=int, default=32,
+                        help='Profile bins for the first pass (default: 32).')
+    parser.add_argument('--coarse_nsubband', type=int, default=16,
+                        help='Subbands for the first pass (default: 16).')
+    parser.add_argument('--coarse_nsubint', type=int, default=16,
+                        help='Number of subints for the first pass (default: 16).')
+    parser.add_argument('--coarse_algorithm', type=str, default=None,
+                        help='PulsarX folding algorithm for the first pass (default: --pulsarx_folding_algorithm).')
+    parser.add_argument('--refold_top', type=int, default=None,
+                        help='Refold the top N candidates by first pass S/N.')
+    parser.add_argument('--refold_snr', type=float, default=None,
+                        help='Refold candidates with a first pass S/N of at least this. If neither this or '
+                             '--refold_top are given, the top 10%% are refolded.')
+    parser.add_argument('--keep_coarse', action='store_true',
+                        help='Keep the plots and archives of the first pass.')
+    parser.add_argument('--rank_by', type=str, default="snr",
+                        help='Score to pick candidates by when there are too many, as weighted columns '
+                             '(eg "snr:1,nassoc:0.1,cluster_size:0.5"). Default is S/N.')
+    parser.add_argument('--fold_budget_sec', type=float, default=None,
+                        help='Wall clock budget (s) for folding. The best scoring candidates that fit are folded.')
+    parser.add_argument('--fold_budget_core_sec', type=float, default=None,
+                        help='Budget for folding in core-seconds (instead of --fold_budget_sec).')
+    parser.add_argument('--fold_core_sec', type=float, default=60.0,
+                        help='Core-seconds to fold one candidate with 64 bins and 64 subbands over the '
+                             'whole observation, for the fold budget (default: 60).')
+    parser.add_argument('--cluster', action='store_true',
+                        help='Cluster candidates by period (and harmonics), DM, and acceleration, and only fold '
+                             'the brightest of each cluster.')
+    parser.add_argument('--cluster_period_tol', type=float, default=5e-4,
+                        help='Fractional period tolerance for clustering (default: 5e-4).')
+    parser.add_argument('--cluster_dm_tol', type=float, default=10.0,
+                        help='DM tolerance for clustering (default: 10).')
+    parser.add_argument('--cluster_acc_tol', type=float, default=5.0,
+                        help='Acceleration tolerance (m/s/s) for clustering (default: 5).')
+    parser.add_argument('--cluster_harmonics', type=str, default="2,3,4,1/2,1/3,1/4,3/2,2/3",
+                        help='Comma separated harmonic ratios to cluster together (default: "2,3,4,1/2,1/3,1/4,3/2,2/3").')
+    parser.add_argument('--avoid_harmonics', type=str, default=None,
+                        help='Comma separated harmonic ratios of the avoid periods to avoid too (eg "2,3,1/2,1/3"). '
+                             'Default is just the fundamental.')
 
     args = parser.parse_args()
     setup_logging(verbose=args.verbose)
@@ -531,13 +1486,12 @@ def main():
     
     os.chdir(args.output_path)
     xml_file = args.input_file
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
+    # Use the saved table of candidates if the xml has not changed
+    sections, df = cand_table.read_xml_cands(xml_file, read_peasoup_xml)
 
-    header_params = root[1]
-    search_params = root[2]
-    segment_params = root[3]
-    candidates = root[7]
+    header_params = sections['header_parameters']
+    search_params = sections['search_parameters']
+    segment_params = sections['segment_parameters']
 
     # Read from XML
     prepfold_threads = args.presto_threads
@@ -545,7 +1499,7 @@ def main():
     filterbank_file = filterbank_file.split('/')[-1]
     tsamp = float(header_params.find("tsamp").text)
     fft_size = int(search_params.find("size").text)
-    total_nsamples = int(root.find("header_parameters/nsamples").text)
+    total_nsamples = int(header_params.find("nsamples").text)
     source_name_prefix = str(header_params.find("source_name").text).strip()
     # Allow only safe characters: letters, numbers, underscores, hyphens
     # If any other character is present, replace with 'random'
@@ -556,45 +1510,6 @@ def main():
     segment_nsamples = int(segment_params.find('segment_nsamples').text)
     xml_segment_pepoch = float(segment_params.find('segment_pepoch').text)
 
-    # Decide which pepoch to use
-    if args.pepoch_override is not None:
-        segment_pepoch = args.pepoch_override
-        logging.info(f"Using user-provided pepoch = {segment_pepoch}")
-    else:
-        segment_pepoch = xml_segment_pepoch
-        logging.info(f"Using pepoch from XML = {segment_pepoch}")
-
-    # If user hasn't supplied explicit start_frac / end_frac, compute from XML data
-    if args.start_frac is not None:
-        user_start_fraction = args.start_frac
-        logging.info(f"Using user-provided start_frac = {user_start_fraction}")
-    else:
-        user_start_fraction = round(segment_start_sample / total_nsamples, 3)
-        logging.info(f"Using start_frac derived from XML = {user_start_fraction}")
-
-    if args.end_frac is not None:
-        user_end_fraction = args.end_frac
-        logging.info(f"Using user-provided end_frac = {user_end_fraction}")
-    else:
-        user_end_fraction = round((segment_start_sample + segment_nsamples) / total_nsamples, 3)
-        logging.info(f"Using end_frac derived from XML = {user_end_fraction}")
-
-    effective_tobs = tsamp * segment_nsamples
-
-    ignored_entries = [
-        'candidate', 'opt_period', 'folded_snr', 'byte_offset', 'is_adjacent',
-        'is_physical', 'ddm_count_ratio', 'ddm_snr_ratio'
-    ]
-    rows = []
-    for candidate in candidates:
-        cand_dict = {}
-        for cand_entry in candidate.iter():
-            if cand_entry.tag not in ignored_entries:
-                cand_dict[cand_entry.tag] = cand_entry.text
-        cand_dict['cand_id_in_file'] = candidate.attrib.get("id")
-        rows.append(cand_dict)
-
-    df = pd.DataFrame(rows)
     if args.filterbank_publish_dir:
         filterbank_publish_dir = args.filterbank_publish_dir
     else:
@@ -602,7 +1517,18 @@ def main():
     
     publish_filterbank_file = os.path.join(filterbank_publish_dir, os.path.basename(filterbank_file))
     df['filterbank_file'] = publish_filterbank_file
-    df = df.astype({"snr": float, "dm": float, "period": float, "nh": int, "acc": float, "jerk": float, "pb": float, "a1": float, "phi": float, "t0": float, "omega": float, "ecc": float, "nassoc": int, "cand_id_in_file": int})
+
+    # Only fold the brightest of each group of the same signal (done
+    # before the filter blocks are cut to their limits)
+    sift = None
+    if args.cluster:
+        def sift(cands):
+            kept, clustered = sift_candidates(cands, args.cluster_period_tol, args.cluster_dm_tol,
+                                              args.cluster_acc_tol, parse_harmonics(args.cluster_harmonics))
+            clustered_table = cand_table.table_path("clustered_candidates")
+            logging.info(f"Saving the cluster of each candidate to {clustered_table}")
+            cand_table.save_table(clustered, clustered_table, {"xml_file": os.path.abspath(xml_file)})
+            return kept
 
     # If a config file is provided, filter the dataframe accordingly
     if args.config_file or args.avoid_folding_file:
@@ -614,15 +1540,33 @@ def main():
         if args.config_file:
             logging.info(f"Applying folding configuration from {args.config_file}")
 
-        df = apply_folding_configuration(df, config_file=args.config_file, avoid_folding_file=args.avoid_folding_file)
+        df = apply_folding_configuration(df, config_file=args.config_file, avoid_folding_file=args.avoid_folding_file,
+                                         avoid_harmonics=args.avoid_harmonics,
+                                         rank_weights=parse_rank_by(args.rank_by), sift=sift)
         logging.info(f"After filtering, {len(df)} candidates remain for folding.")
        
     else:
         logging.info(f"No configuration file provided, folding all {len(df)} candidates.")
-    
-    #Dump the candidates selected for folding to a CSV
-    logging.info(f"Dumping the selected candidates to filtered_df_for_folding.csv")
-    df.to_csv(args.filtered_candidates_file, index=False, float_format='%.18f')
+        if sift is not None:
+            df = sift(df)
+
+    # Fold as many of the best candidates as fit in the time we have
+    fold_threads = args.presto_threads if args.fold_technique == 'presto' else args.pulsarx_threads
+    budget = args.fold_budget_core_sec
+    if budget is None and args.fold_budget_sec is not None:
+        budget = args.fold_budget_sec * fold_threads
+    if budget is not None:
+        costs = fold_core_seconds(df, total_nsamples, args.nbins_low, args.nbins_high,
+                                  args.nsubband, args.fold_core_sec)
+        df = select_within_budget(df, costs, budget, parse_rank_by(args.rank_by))
+
+    # Save the candidates selected for folding
+    filtered_table = cand_table.table_path(os.path.splitext(args.filtered_candidates_file)[0])
+    logging.info(f"Saving the selected candidates to {filtered_table}")
+    cand_table.save_table(df, filtered_table, {"xml_file": os.path.abspath(xml_file)})
+    if args.export_csv:
+        logging.info(f"Dumping the selected candidates to {args.filtered_candidates_file}")
+        df.to_csv(args.filtered_candidates_file, index=False, float_format='%.18f')
 
     
     PulsarX_Template = args.pulsarx_fold_template
@@ -633,52 +1577,145 @@ def main():
         coherent_dm = float(search_params.find('cdm').text)
         logging.info(f"Using coherent DM from XML = {coherent_dm}")
 
-    if args.fold_technique == 'presto':
-        logging.info("Folding with Presto...")
-        fold_with_presto(
-            df,
-            filterbank_file,
-            tsamp,
-            fft_size,
-            source_name_prefix,
-            prepfold_threads,
-            rfifind_mask=args.mask_file,
-            extra_args=args.extra_args
-        )
-    else:
-        logging.info("Folding with PulsarX...")
-        if args.subint_length is None:
-            subint_length = int(effective_tobs / 64)
+    fold_index = None
+    if args.incremental:
+        if args.fold_technique == 'presto':
+            logging.warning("--incremental only works with PulsarX, folding everything")
         else:
-            subint_length = args.subint_length
-
-        fold_with_pulsarx(
-            df,
-            segment_start_sample,
-            segment_nsamples,
-            segment_pepoch,
-            total_nsamples,
-            filterbank_file,
-            source_name_prefix,
-            args.nbins_high,
-            args.nbins_low,
-            subint_length,
-            args.nsubband,
-            args.utc_beam,
-            args.beam_name,
-            args.pulsarx_threads,
-            PulsarX_Template,
-            args.clfd_q_value,
-            args.rfi_filter,
-            cmask=args.chan_mask,
-            start_fraction=user_start_fraction,
-            end_fraction=user_end_fraction,
-            extra_args=args.extra_args,
-            output_rootname=args.output_rootname,
-            coherent_dm=coherent_dm,
-            custom_nbin_plan=args.custom_nbin_plan,
-            pulsarx_folding_algorithm=args.pulsarx_folding_algorithm
-        )
+            fold_index = load_fold_index()
+            logging.info(f"Loaded {len(fold_index)} folded candidates from {FOLD_INDEX}")
+
+    coarse_results = []
+    dat_files = {}
+
+    # Fold the candidates from each segment over that segment
+    groups = segment_groups(df, segment_start_sample, segment_nsamples, xml_segment_pepoch)
+    for iseg, ((seg_start, seg_nsamples, seg_pepoch), seg_df) in enumerate(groups):
+        segment_pepoch, user_start_fraction, user_end_fraction, effective_tobs = \
+            segment_fold_params(args, seg_start, seg_nsamples, seg_pepoch, total_nsamples, tsamp)
+
+        # Keep the usual file names unless there is more than one segment
+        if len(groups) > 1:
+            seg_tag = f"_seg{iseg:02d}"
+            logging.info(f"Folding {len(seg_df)} candidates from segment {iseg}: "
+                         f"start={seg_start}, nsamples={seg_nsamples}")
+        else:
+            seg_tag = ""
+
+        if args.fold_technique == 'presto':
+            logging.info("Folding with Presto...")
+            if args.two_pass:
+                logging.warning("--two_pass only works with PulsarX, folding everything once")
+            extra_args = args.extra_args
+            if len(groups) > 1:
+                seg_args = f"-start {user_start_fraction} -end {user_end_fraction}"
+                extra_args = f"{extra_args} {seg_args}" if extra_args else seg_args
+            seg_fft_size = fft_size
+            if 'segment_fft_size' in seg_df.columns:
+                seg_fft_size = int(seg_df['segment_fft_size'].iloc[0])
+            fold_inputs = filterbank_file
+            if args.presto_dm_tol is not None and len(seg_df):
+                # Fold time series dedispersed once per group of DMs
+                fold_inputs = dedisperse_dm_groups(
+                    seg_df['dm'].values, args.presto_dm_tol, filterbank_file,
+                    f"{source_name_prefix}_presto", args.nsubband, prepfold_threads,
+                    rfifind_mask=args.mask_file, timeout=args.prepfold_timeout,
+                    dat_files=dat_files)
+            fold_with_presto(
+                seg_df,
+                fold_inputs,
+                tsamp,
+                seg_fft_size,
+                source_name_prefix,
+                prepfold_threads,
+                rfifind_mask=args.mask_file,
+                extra_args=extra_args,
+                timeout=args.prepfold_timeout,
+                retries=args.prepfold_retries
+            )
+        else:
+            logging.info("Folding with PulsarX...")
+            if args.subint_length is None:
+                subint_length = int(effective_tobs / 64)
+            else:
+                subint_length = args.subint_length
+
+            output_rootname = args.output_rootname
+            if seg_tag:
+                output_rootname = (output_rootname or args.utc_beam) + seg_tag
+
+            def run_pulsarx(fold_df, nsubband, subint_length, nbin_plan, algorithm,
+                            rootname, cand_file_path, fold_index, need_outputs=True):
+                fold_with_pulsarx(
+                    fold_df,
+                    seg_start,
+                    seg_nsamples,
+                    segment_pepoch,
+                    total_nsamples,
+                    filterbank_file,
+                    source_name_prefix,
+                    args.nbins_high,
+                    args.nbins_low,
+                    subint_length,
+                    nsubband,
+                    args.utc_beam,
+                    args.beam_name,
+                    args.pulsarx_threads,
+                    PulsarX_Template,
+                    args.clfd_q_value,
+                    args.rfi_filter,
+                    cmask=args.chan_mask,
+                    start_fraction=user_start_fraction,
+                    end_fraction=user_end_fraction,
+                    extra_args=args.extra_args,
+                    output_rootname=rootname,
+                    coherent_dm=coherent_dm,
+                    custom_nbin_plan=nbin_plan,
+                    pulsarx_folding_algorithm=algorithm,
+                    cand_file_path=cand_file_path,
+                    nproc=args.pulsarx_nproc,
+                    fold_index=fold_index,
+                    need_outputs=need_outputs
+                )
+
+            if args.two_pass and len(seg_df):
+                # Quick fold of everything, then the full fold of the best.
+                # When folding incrementally the first pass is in the index
+                # too, and its S/N comes back from there for candidates
+                # already done.
+                first_rootname = coarse_rootname(output_rootname or args.utc_beam)
+                run_pulsarx(seg_df, args.coarse_nsubband,
+                            max(1, int(effective_tobs / args.coarse_nsubint)),
+                            f"-b {args.coarse_nbins}",
+                            args.coarse_algorithm or args.pulsarx_folding_algorithm,
+                            first_rootname, f"pulsarx{seg_tag}_coarse.candfile",
+                            fold_index, need_outputs=args.keep_coarse)
+                if fold_index is not None:
+                    cand_ids = seg_df['cand_id_in_file'].to_numpy(dtype=int)
+                else:
+                    cand_ids = np.arange(len(seg_df))
+                seg_df = seg_df.copy()
+                seg_df['coarse_snr'] = coarse_fold_snr(first_rootname, cand_ids)
+                if not args.keep_coarse:
+                    remove_fold_outputs(first_rootname)
+                seg_df = select_refold(seg_df, args.refold_top, args.refold_snr)
+                coarse_results.append(seg_df)
+                seg_df = seg_df.loc[seg_df['refold']]
+
+            run_pulsarx(seg_df, args.nsubband, subint_length, args.custom_nbin_plan,
+                        args.pulsarx_folding_algorithm, output_rootname,
+                        f"pulsarx{seg_tag}.candfile", fold_index)
+
+    if dat_files and not args.keep_dat:
+        remove_dat_files(dat_files)
+
+    # Save the coarse fold S/N with the candidates
+    if coarse_results:
+        coarse_df = pd.concat(coarse_results).sort_values(by='cand_id_in_file')
+        cand_table.save_table(coarse_df.reset_index(drop=True), filtered_table,
+                              {"xml_file": os.path.abspath(xml_file)})
+        logging.info(f"Refolded {int(coarse_df['refold'].sum())} of {len(coarse_df)} candidates, "
+                     f"saved the coarse S/N to {filtered_table}")
 
 if __name__ == "__main__":
     main()
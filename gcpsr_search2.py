@@ -2,15 +2,156 @@ import os
 import sys
 import time
 import json
+import math
 import subprocess as sp
 from glob import glob
 import shutil
+import copy
+import queue
+import hashlib
+import threading
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from argparse import ArgumentParser
 
+import staging
+import containers
+import planner
+import sigproc
+import peasoup_xml
+import tx_cands
+import cand_table
+
+
+class StageError(Exception):
+    """
+    A processing step failed (bad exit status from the 
+    command or missing/bad output files)
+    """
+    pass
+
+
+# How commands are run from the sif files (set in main, 
+# see containers.ContainerBackend)
+container_backend = containers.ContainerBackend("exec")
+
+# Node-local cache for sif and fil files (set in main, 
+# see staging.ArtifactCache)
+artifact_cache = None
+
+
+class GpuPool:
+    """
+    Hand out GPUs to the peasoup runs.  Each device can 
+    have procs_per_gpu runs on it at once (time sliced).
+
+        with gpu_pool.device() as dev:
+            ... CUDA_VISIBLE_DEVICES=dev ...
+    """
+    def __init__(self, devices, procs_per_gpu=1):
+        self.devices = list(devices)
+        self.free = queue.Queue()
+        self.nslots = max(1, procs_per_gpu) * len(self.devices)
+        for ii in range(max(1, procs_per_gpu)):
+            for dev in self.devices:
+                self.free.put(dev)
+
+    @contextmanager
+    def device(self):
+        dev = self.free.get()
+        try:
+            yield dev
+        finally:
+            self.free.put(dev)
+
+
+def get_gpu_devices(ngpus=None):
+    """
+    GPU ids we can use.  Take them from CUDA_VISIBLE_DEVICES 
+    (set by slurm) if it is there, otherwise use ngpus GPUs 
+    (just GPU 0 if ngpus is not given).  If ngpus is given, 
+    we only use that many.
+    """
+    env_str = os.environ.get("CUDA_VISIBLE_DEVICES", "")
+    devices = [ dd.strip() for dd in env_str.split(',') if dd.strip() ]
+    if len(devices) == 0:
+        devices = [ str(ii) for ii in range(ngpus or 1) ]
+    if ngpus is not None:
+        devices = devices[:ngpus]
+    return devices
+
+
+# GPUs for peasoup, shared by all the beams (set in main)
+gpu_pool = GpuPool(["0"])
+
+
+# Stack of stage records for the current thread (see Timer.stage)
+_stage_local = threading.local()
+_usage_lock = threading.Lock()
+
+
+def add_stage_usage(**kwargs):
+    """
+    Add resource usage to the stages that are running in 
+    this thread (see Timer.stage).  maxrss_mb keeps the max, 
+    everything else is added up.
+    """
+    stack = getattr(_stage_local, "stack", [])
+    with _usage_lock:
+        for tt, rec in stack:
+            for key, val in kwargs.items():
+                if key == "maxrss_mb":
+                    rec[key] = max(rec[key], val)
+                else:
+                    rec[key] += val
+    return
+
+
+def in_this_stage(func):
+    """
+    Wrap func so that when it is run in another thread 
+    its usage still counts towards the stages running in 
+    this one
+    """
+    stack = list(getattr(_stage_local, "stack", []))
+    def wrapped(*args, **kwargs):
+        _stage_local.stack = list(stack)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _stage_local.stack = []
+    return wrapped
+
+
+def record_copies(checksums):
+    """
+    Add the files copied by staging.copy_files (which 
+    returns {dst : md5}) to the stage usage
+    """
+    nbytes = sum([ os.path.getsize(ff) for ff in checksums.keys() ])
+    add_stage_usage(nfiles=len(checksums), read_bytes=nbytes, 
+                    write_bytes=nbytes)
+    return
+
+
+@contextmanager
+def sub_stage(name):
+    """
+    Record a stage inside whatever stage is running in 
+    this thread (does nothing if there is none)
+    """
+    stack = getattr(_stage_local, "stack", [])
+    if len(stack) == 0:
+        yield None
+    else:
+        with stack[-1][0].stage(name) as rec:
+            yield rec
+
 
 class Timer:
-    def __init__(self):
+    def __init__(self, beamname=""):
         self.filtool = 0.0
         self.peasoup = 0.0
         self.fold    = 0.0
@@ -18,6 +159,83 @@ class Timer:
         self.total   = 0.0
         self.dstart  = ""
         self.dstop   = ""
+        self.status  = "FAILED"
+        self.beamname = beamname
+        self.records  = []
+        self.lock     = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Record the resources used by a stage:
+
+            with tt.stage("peasoup"):
+                ...
+
+        We keep the wall time, and try_cmd and record_copies 
+        add the child CPU time, max RSS, bytes read and 
+        written, and number of files.  Stages can be nested 
+        (eg, organize_fold_results inside fold), in which 
+        case the usage counts towards all of them.  Use 
+        sub_stage to start a nested stage without the Timer.
+        """
+        stack = getattr(_stage_local, "stack", None)
+        if stack is None:
+            stack = []
+            _stage_local.stack = stack
+
+        if len(stack):
+            parent = stack[-1][1]["stage"]
+        else:
+            parent = None
+
+        rec = {"beam"        : self.beamname, 
+               "stage"       : name, 
+               "parent"      : parent, 
+               "start"       : datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+               "wall_s"      : 0.0, 
+               "utime_s"     : 0.0, 
+               "stime_s"     : 0.0, 
+               "maxrss_mb"   : 0.0, 
+               "read_bytes"  : 0, 
+               "write_bytes" : 0, 
+               "nfiles"      : 0, 
+               "ncmds"       : 0, 
+               "status"      : "ok"}
+
+        stack.append( (self, rec) )
+        t_start = time.time()
+        try:
+            yield rec
+        except BaseException:
+            rec["status"] = "failed"
+            raise
+        finally:
+            rec["wall_s"] = time.time() - t_start
+            stack.pop()
+            with self.lock:
+                self.records.append(rec)
+
+    def write_metrics(self, outfile):
+        """
+        Write one JSON record per stage (plus one for the 
+        whole beam) to outfile
+        """
+        with self.lock:
+            records = list(self.records)
+
+        tot_rec = {"beam"   : self.beamname, 
+                   "stage"  : "total", 
+                   "parent" : None, 
+                   "start"  : self.dstart, 
+                   "stop"   : self.dstop, 
+                   "wall_s" : self.total, 
+                   "status" : self.status}
+
+        with open(outfile, 'w') as fout:
+            for rec in records + [tot_rec]:
+                fout.write(json.dumps(rec) + "\n")
+        return
 
     def print_summary(self):
         print("\n\n")
@@ -27,6 +245,7 @@ class Timer:
         print("\n")
         print("Start Time: %s" %self.dstart)
         print("Stop Time:  %s" %self.dstop)
+        print("Status:     %s" %self.status)
         print("\n")
         print("Program:                         Running Time (min): ")
         print("--------                         -----------------  ")
@@ -45,6 +264,7 @@ class Timer:
         fout.write( "\n"                                                    )
         fout.write( "Start Time: %s\n" %self.dstart)
         fout.write( "Stop Time:  %s\n" %self.dstop)
+        fout.write( "Status:     %s\n" %self.status)
         fout.write( "\n"                                                     )
         fout.write( "Program:                         Running Time (min): \n")
         fout.write( "--------                         -----------------  \n")
@@ -155,6 +375,10 @@ def get_and_check_sif(sif_dict):
     "dir" and "file".  Combines them 
     to a path, make sure it exists 
     and return it
+
+    If we have a node-local cache, the path 
+    of the cached (and checksummed) copy is 
+    returned instead
     """
     sif_dir  = sif_dict.get('dir')
     sif_name = sif_dict.get('file')
@@ -177,6 +401,11 @@ def get_and_check_sif(sif_dict):
     if retval == 0:
         sys.exit(0)
 
+    if artifact_cache is not None:
+        cache_file, md5 = artifact_cache.fetch(sif_file, verify=True)
+        if cache_file is not None:
+            sif_file = cache_file
+
     return sif_file 
 
 
@@ -189,19 +418,48 @@ def format_name(name_dir):
     return(name_dir)
 
 
-def try_cmd(cmd, stdout=None, stderr=None):
+def try_cmd(cmd, stdout=None, stderr=None, cwd=None, check=True, env=None):
     """
-    Run the command in the string cmd using sp.run().  If there
-    is a problem running, a CalledProcessError will occur and the
-    program will quit.
+    Run the command in the string cmd.  If there is a 
+    problem starting it, the program will quit.  If check 
+    is True and the command exits with a non-zero status 
+    (which singularity passes on from the command run 
+    inside the container), a StageError is raised.
+
+    If cwd is given, the command is run from that directory 
+    (we do not os.chdir() since several beams may be running 
+    at once in the same process).  env is a dictionary of 
+    extra environment variables for the command.
+
+    We wait for the command with os.wait4 so we get its 
+    resource usage, which is added to the current stage 
+    (see Timer.stage).  Returns the exit code.
     """
     print("\n\n %s \n\n" %cmd)
+    if env is not None:
+        env = dict(os.environ, **env)
     try:
-        retval = sp.run(cmd, shell=True, stdout=stdout, stderr=stderr)
-    except sp.CalledProcessError:
+        proc = sp.Popen(cmd, shell=True, stdout=stdout, stderr=stderr, 
+                        cwd=cwd, env=env)
+    except OSError:
         print("The command:\n %s \ndid not work, quitting..." %cmd)
         sys.exit(0)
-    return 
+
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    add_stage_usage(utime_s     = rusage.ru_utime, 
+                    stime_s     = rusage.ru_stime, 
+                    maxrss_mb   = rusage.ru_maxrss / 1024., 
+                    read_bytes  = rusage.ru_inblock * 512, 
+                    write_bytes = rusage.ru_oublock * 512, 
+                    ncmds       = 1)
+
+    if check and proc.returncode != 0:
+        raise StageError(f"Command exited with status {proc.returncode}:" +\
+                         f"\n  {cmd}")
+
+    return proc.returncode
 
 
 def run_filtool(beamname, fil_dir, results_dir, jdict):
@@ -242,26 +500,108 @@ def run_filtool(beamname, fil_dir, results_dir, jdict):
     ft_cmd = f"filtool {par_str} -o {outbase} -s {beamname} " +\
              f"-f {fil_list_str}"
     print(f"\n{ft_cmd=}\n")
-    sing_cmd = f"singularity exec --nv -B {bstr} {ft_sif} {ft_cmd}"
+    sing_cmd = container_backend.command(ft_sif, ft_cmd, bstr, nv=True)
     #stderr = open('err.txt', 'a+')
     #stdout = open('out.txt', 'a+')
 
-    #try_cmd(sing_cmd, stderr=stderr, stdout=stdout)
+    # try_cmd checks the exit status, the output 
+    # is checked by check_stage_outputs
     try_cmd(sing_cmd)
 
-    # will not fail properly because the thing INSIDE
-    # singularity failed, not the singularity command
-    # need to check output
-
     t_end = time.time()
     dt = t_end - t_start
 
     return dt
 
 
+def get_dm_shards(filfile, opts, nshards):
+    """
+    Split the DM trials for peasoup into nshards 
+    contiguous pieces of (nearly) the same size.  The 
+    trials come from the dm_file option if there is one, 
+    otherwise we make the same list peasoup would from 
+    dm_start and dm_end (see planner.generate_dm_list).
+    """
+    if opts.get("dm_file"):
+        with open(opts["dm_file"], 'r') as fin:
+            dms = [ float(line) for line in fin if line.strip() ]
+    else:
+        fil = sigproc.FilFile(filfile)
+        dms = planner.generate_dm_list(float(opts.get("dm_start", 0)), 
+                                       float(opts.get("dm_end", 100)), 
+                                       fil.tsamp, fil.nchans, 
+                                       fil.fch1, fil.foff, 
+                    pulse_width=float(opts.get("dm_pulse_width", 
+                                               planner.DM_PULSE_WIDTH)), 
+                    tol=float(opts.get("dm_tol", planner.DM_TOL)))
+
+    nshards = max(1, min(nshards, len(dms)))
+    edges = [ (ii * len(dms)) // nshards for ii in range(nshards + 1) ]
+    return [ dms[edges[ii]:edges[ii+1]] for ii in range(nshards) ]
+
+
+def peasoup_cmd(ps_sif, par_str, out_dir, filfile, bstr):
+    """
+    Run one peasoup search on a GPU from gpu_pool
+    """
+    ps_cmd = f"peasoup {par_str} -o {out_dir} " +\
+             f"-i {filfile}"
+    print(f"\n{ps_cmd=}\n")
+    sing_cmd = container_backend.command(ps_sif, ps_cmd, bstr, nv=True)
+
+    # try_cmd checks the exit status, the output 
+    # is checked by check_stage_outputs
+    with gpu_pool.device() as dev:
+        print(f"Running peasoup on GPU {dev}")
+        try_cmd(sing_cmd, env={"CUDA_VISIBLE_DEVICES" : str(dev)})
+    return
+
+
+def get_segments(filfile, pd):
+    """
+    Get the (start_sample, nsamples, nseg) of each segment to 
+    search from the (optional) "segments" block of the 
+    peasoup args.  nsegments is a list of how many pieces 
+    to cut the observation into, so [1, 2, 4] searches 
+    the full observation, the halves, and the quarters.  
+    The full search is given as None (no segment options).
+    """
+    sd = pd.get("segments", {})
+    nsegs = sorted(set([ int(nn) for nn in sd.get("nsegments", [1]) ]))
+
+    segments = []
+    nsamples = None
+    for nseg in nsegs:
+        if nseg <= 1:
+            segments.append(None)
+            continue
+        if nsamples is None:
+            nsamples = sigproc.FilFile(filfile).nsamples
+        seg_len = nsamples // nseg
+        for ii in range(nseg):
+            segments.append( (ii * seg_len, seg_len, nseg) )
+
+    return segments
+
+
 def run_peasoup(beamname, fil_dir, results_dir, jdict):
     """
     Run peasoup on the fil file
+
+    If "nshards" (in the peasoup block) is more than 1, 
+    the DM trials are split into that many pieces that 
+    are searched at the same time (on different GPUs if 
+    we have them).
+
+    If there is a "segments" block, we also search pieces 
+    of the observation (see get_segments), with the segment 
+    given by the start_flag and nsamples_flag options.
+
+    All the searches are run at the same time (as far as 
+    the GPUs allow, see gpu_pool) and the results are 
+    merged into one overview.xml, keeping the top limit 
+    candidates from each segment and tagging them with 
+    their segment (see peasoup_xml.merge_overviews).
     """
     t_start = time.time()
 
@@ -271,9 +611,6 @@ def run_peasoup(beamname, fil_dir, results_dir, jdict):
     # Get sif file from arg dict
     ps_sif = get_and_check_sif(pd["sif"])
 
-    # Get options from arg dict
-    par_str = dict_to_opts(pd["opts"])
-
     # Set filterbank file name... filtools appends a _01 
     # this is ugly and hard coded
     filfile = f"{fil_dir}/{beamname}_01.fil" 
@@ -286,19 +623,80 @@ def run_peasoup(beamname, fil_dir, results_dir, jdict):
     else:
         bstr = f"{fil_dir},{results_dir}"
     print(f"{bstr=}")
-    
-    ps_cmd = f"peasoup {par_str} -o {results_dir} " +\
-             f"-i {filfile}"
-    print(f"\n{ps_cmd=}\n")
-    sing_cmd = f"singularity exec --nv -B {bstr} {ps_sif} {ps_cmd}"
-    #stderr = open('err.txt', 'a+')
-    #stdout = open('out.txt', 'a+')
 
-    try_cmd(sing_cmd)
+    nshards = int(pd.get("nshards", 1))
+    if nshards > 1:
+        dm_shards = get_dm_shards(filfile, pd["opts"], nshards)
+    else:
+        dm_shards = []
+    if len(dm_shards) < 2:
+        dm_shards = [None]
+
+    segments = get_segments(filfile, pd)
 
-    # will not fail properly because the thing INSIDE
-    # singularity failed, not the singularity command
-    # need to check output
+    if len(dm_shards) == 1 and segments == [None]:
+        # Get options from arg dict
+        par_str = dict_to_opts(pd["opts"])
+        peasoup_cmd(ps_sif, par_str, results_dir, filfile, bstr)
+
+    else:
+        sd = pd.get("segments", {})
+        start_flag = sd.get("start_flag", "start_sample")
+        nsamp_flag = sd.get("nsamples_flag", "nsamples")
+
+        print(f"Running {len(segments) * len(dm_shards)} peasoup " +\
+              f"searches ({len(segments)} segments x " +\
+              f"{len(dm_shards)} DM pieces)")
+        run_top = f"{results_dir}/peasoup_runs"
+        xml_groups = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=len(segments) * 
+                                            len(dm_shards)) as pool:
+            for ii, seg in enumerate(segments):
+                xml_files = []
+                for jj, dms in enumerate(dm_shards):
+                    out_dir = f"{run_top}/seg{ii:02d}_dm{jj:02d}"
+                    if not os.path.exists(out_dir):
+                        os.makedirs(out_dir)
+
+                    opts = dict(pd["opts"])
+                    if dms is not None:
+                        dm_file = f"{out_dir}/dm_list.txt"
+                        with open(dm_file, 'w') as fout:
+                            for dm in dms:
+                                fout.write(f"{dm:.6f}\n")
+                        for key in ["dm_start", "dm_end", "dm_file"]:
+                            opts.pop(key, None)
+                        opts["dm_file"] = dm_file
+
+                    if seg is not None:
+                        opts[start_flag] = seg[0]
+                        opts[nsamp_flag] = seg[1]
+                        if opts.get("fft_size") is not None:
+                            # peasoup needs a power of two
+                            opts["fft_size"] = planner.prev_power_of_two(
+                                                int(opts["fft_size"]) // seg[2])
+                    par_str = dict_to_opts(opts)
+
+                    xml_files.append(f"{out_dir}/overview.xml")
+                    futures.append(pool.submit(in_this_stage(peasoup_cmd), 
+                                               ps_sif, par_str, out_dir, 
+                                               filfile, bstr))
+                xml_groups.append(xml_files)
+
+            for ff in futures:
+                ff.result()
+
+        # The full length search (if any) supplies the header
+        full_group = None
+        if None in segments:
+            full_group = segments.index(None)
+        ncands = peasoup_xml.merge_overviews(xml_groups, 
+                                      f"{results_dir}/overview.xml", 
+                                      limit=pd["opts"].get("limit"), 
+                                      full_group=full_group)
+        print(f"Merged {ncands} candidates into {results_dir}/overview.xml")
+        shutil.rmtree(run_top)
 
     t_end = time.time()
     dt = t_end - t_start
@@ -311,8 +709,9 @@ def organize_fold_results(results_dir):
     organize the output from peasoup folding
     
     pulsarx will produce a bunch of *png files, 
-    corresponding *ar files, a filtered*csv file 
-    and a pulsarx.candfile
+    corresponding *ar files, a table of the folded 
+    candidates (filtered_df_for_folding.parquet or 
+    .npz, and .csv if asked for) and a pulsarx.candfile
 
     we'll make a directory called cand_plots 
     and put things there
@@ -331,10 +730,16 @@ def organize_fold_results(results_dir):
     for aa in ar_files:
         shutil.move(aa, out_dir)
 
-    # move cand file
+    add_stage_usage(nfiles=len(png_files) + len(ar_files))
+
+    # move cand file(s) (one per segment for a segmented search)
     cc_files =  glob(f"{results_dir}/*.cands") 
-    cc_files.append(f"{results_dir}/pulsarx.candfile")
-    cc_files.append(f"{results_dir}/filtered_df_for_folding.csv")
+    cc_files += glob(f"{results_dir}/pulsarx*.candfile")
+    cc_files += glob(f"{results_dir}/filtered_df_for_folding.csv")
+    cc_files += glob(f"{results_dir}/clustered_candidates.*")
+    cc_files += glob(f"{results_dir}/fold_index.json")
+    ff_table = cand_table.find_table(f"{results_dir}/filtered_df_for_folding")
+    cc_files.append(ff_table or f"{results_dir}/filtered_df_for_folding.npz")
 
     for cc in cc_files:
         if os.path.exists(cc):
@@ -378,6 +783,14 @@ def run_psrX_fold(beamname, fil_dir, results_dir, jdict):
     if not check_file_exists(temp_file):
         sys.exit(0)
 
+    # Nothing to do if peasoup found no candidates
+    xml_file = f"{results_dir}/overview.xml"
+    ncands = count_xml_candidates(xml_file)
+    if ncands == 0:
+        print(f"No candidates in {xml_file}, nothing to fold")
+        organize_fold_results(results_dir)
+        return time.time() - t_start
+
     # Set binds
     if fil_dir == results_dir:
         bstr = f"{results_dir}"
@@ -390,17 +803,17 @@ def run_psrX_fold(beamname, fil_dir, results_dir, jdict):
                f"{par_str} " +\
                f"-p {temp_file}"  
     print(f"\n{fold_cmd=}\n")
-    sing_cmd = f"singularity exec -B {bstr} {fold_sif} {fold_cmd}"
+    sing_cmd = container_backend.command(fold_sif, fold_cmd, bstr)
     #stderr = open('err.txt', 'a+')
     #stdout = open('out.txt', 'a+')
 
-    # will not fail properly because the thing INSIDE
-    # singularity failed, not the singularity command
-    # need to check output
-    try_cmd(sing_cmd)
+    # try_cmd checks the exit status, the output 
+    # is checked by check_stage_outputs
+    try_cmd(sing_cmd, cwd=results_dir)
 
     # Make cands directory and move results there
-    organize_fold_results(results_dir)
+    with sub_stage("organize_fold_results"):
+        organize_fold_results(results_dir)
     
 
     t_end = time.time()
@@ -409,15 +822,18 @@ def run_psrX_fold(beamname, fil_dir, results_dir, jdict):
     return dt
 
 
-def organize_sp_results(results_dir):
+def make_sp_dirs(results_dir):
     """
-    organize the output from TransientX SP search
-    
-    pulsarx will produce a bunch of *png files and 
-    a cands file
+    Make the directories for the TransientX SP search
 
-    we'll make a directory called sp_plots 
-    and put things there
+    transientx_fil is run from sp_plots/all, so the 
+    pngs and cands file before sifting end up there.  
+    replot_fil is run from sp_plots/sifted, so the 
+    results after sifting end up there.
+
+    Keeping the single pulse products out of results_dir 
+    means they can not be confused with the fold products 
+    when both are running at once.
     """
     out_dir = f"{results_dir}/sp_plots"
     if not os.path.exists(out_dir):
@@ -433,35 +849,64 @@ def organize_sp_results(results_dir):
     if not os.path.exists(sift_dir):
         os.mkdir(sift_dir)
 
-    # Move over replot files first since they 
-    # will all have "replot" in the name
-    replot_files = glob(f"{results_dir}/*replot*")
-    for rr in replot_files:
-        shutil.move(rr, sift_dir)
+    return all_dir, sift_dir
+        
 
-    # everything else will be from before sifting
-    # move pngs
-    png_files = glob(f"{results_dir}/*.png")
-    for pp in png_files:
-        shutil.move(pp, all_dir)
+def get_tx_shards(filfile, s_pd):
+    """
+    Split the TransientX search into pieces by DM and time 
+    using "ndm_shards" and "ntime_shards" in the search 
+    block.  Returns a list of ((dms, ndm), (start, nsamps)) 
+    where the time piece is None if we are not splitting 
+    in time.
+
+    The time pieces overlap by the dispersion delay across 
+    the band at the top DM, plus the widest pulse (maxw) 
+    and the overlap between TransientX segments (overlap x 
+    seglen), so that a pulse at a boundary is seen whole in 
+    at least one piece.
+    """
+    opts = s_pd["opts"]
+    dms = float(opts.get("dms", 0))
+    ddm = float(opts.get("ddm", 1))
+    ndm = int(opts.get("ndm", 1))
+
+    ndm_shards = max(1, min(int(s_pd.get("ndm_shards", 1)), ndm))
+    edges = [ (ii * ndm) // ndm_shards for ii in range(ndm_shards + 1) ]
+    dm_pieces = [ (dms + edges[ii] * ddm, edges[ii+1] - edges[ii]) 
+                  for ii in range(ndm_shards) ]
+
+    nt_shards = int(s_pd.get("ntime_shards", 1))
+    if nt_shards <= 1:
+        t_pieces = [None]
+    else:
+        fil = sigproc.FilFile(filfile)
+        freqs = fil.freqs
+        f_lo, f_hi = freqs.min(), freqs.max()
+        dm_max = dms + ndm * ddm
+        t_delay = 4.148808e3 * dm_max * (f_lo**-2 - f_hi**-2)
+        t_over = t_delay + float(opts.get("maxw", 0)) + \
+                 float(opts.get("overlap", 0)) * float(opts.get("seglen", 0))
+        n_over = int(math.ceil(t_over / fil.tsamp))
 
-    # move cand files
-    cc_files =  glob(f"{results_dir}/*.cands") 
+        chunk = int(math.ceil(fil.nsamples / nt_shards))
+        t_pieces = [ (ii * chunk, min(chunk + n_over, fil.nsamples - ii * chunk)) 
+                     for ii in range(nt_shards) if ii * chunk < fil.nsamples ]
 
-    for cc in cc_files:
-        if os.path.exists(cc):
-            shutil.move(cc, all_dir)    
-        else:
-            print("No such file:")
-            print(f"  {cc}")
+    return [ (dd, tt) for tt in t_pieces for dd in dm_pieces ]
 
-    return
-        
 
-def run_transientX(beamname, fil_dir, results_dir, jdict):
+def run_tx_search(beamname, fil_dir, results_dir, jdict):
     """
     Run transientX single pulse search on fil file 
-    and then run replot_fil to filter out duplicates
+
+    If "ndm_shards" or "ntime_shards" in the search block 
+    is more than 1, the search is split into pieces (see 
+    get_tx_shards) that run at the same time, sharing the 
+    threads.  Each piece runs in its own directory, and 
+    then the pngs are moved to sp_plots/all and the .cands 
+    files are merged (removing the pulses found in more 
+    than one piece) into sp_plots/all/{beamname}.cands
     """
     t_start = time.time()
 
@@ -472,6 +917,8 @@ def run_transientX(beamname, fil_dir, results_dir, jdict):
     
     if not check_file_exists(filfile):
         sys.exit(0)
+
+    all_dir, sift_dir = make_sp_dirs(results_dir)
     
     # Set binds
     if fil_dir == results_dir:
@@ -480,72 +927,662 @@ def run_transientX(beamname, fil_dir, results_dir, jdict):
         bstr = f"{fil_dir},{results_dir}"
     print(f"{bstr=}")
 
-    ############################
-    ###  run transientx_fil  ###
-    ############################
-    if check_proc(jdict, "tx_sp_search"):
-        # Get relevant process dict
-        s_pd = jdict["tx_sp_search"]
+    # Get relevant process dict
+    s_pd = jdict["tx_sp_search"]
+
+    # Get sif file from arg dict
+    s_sif = get_and_check_sif(s_pd["sif"])
 
-        # Get sif file from arg dict
-        s_sif = get_and_check_sif(s_pd["sif"])
+    shards = get_tx_shards(filfile, s_pd)
 
+    if len(shards) == 1:
         # Get options from arg dict
         s_par_str = dict_to_opts(s_pd["opts"])
 
         s_cmd = f"transientx_fil {s_par_str} -o {outbase} " +\
                 f"-f {filfile}"
-    
+
         print(f"\n{s_cmd=}\n")
-        s_sing_cmd = f"singularity exec -B {bstr} {s_sif} {s_cmd}"
+        s_sing_cmd = container_backend.command(s_sif, s_cmd, bstr)
 
-        try_cmd(s_sing_cmd)
+        try_cmd(s_sing_cmd, cwd=all_dir)
 
+    else:
+        print(f"Splitting the single pulse search into {len(shards)} pieces")
+        shard_top = f"{all_dir}/shards"
+        nthreads = max(1, int(s_pd["opts"].get("threads", 1)) // len(shards))
+
+        def run_shard(sdir, s_cmd):
+            s_sing_cmd = container_backend.command(s_sif, s_cmd, bstr)
+            try_cmd(s_sing_cmd, cwd=sdir)
+            return
+
+        # Write the time pieces first, since several DM 
+        # pieces may use the same one
+        chunk_files = {}
+        for dd, tt in shards:
+            if tt is not None and tt not in chunk_files:
+                chunk_files[tt] = f"{shard_top}/{beamname}_" +\
+                                  f"t{len(chunk_files):02d}.fil"
+        if not os.path.exists(shard_top):
+            os.makedirs(shard_top)
+        for tt, chunk_file in chunk_files.items():
+            with sub_stage("write_chunk"):
+                sigproc.write_chunk(filfile, chunk_file, *tt)
+
+        sdirs = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+            for ii, ((dms, ndm), tt) in enumerate(shards):
+                sdir = f"{shard_top}/s{ii:02d}"
+                if not os.path.exists(sdir):
+                    os.makedirs(sdir)
+                sdirs.append(sdir)
+
+                opts = dict(s_pd["opts"])
+                opts["dms"] = dms
+                opts["ndm"] = ndm
+                opts["threads"] = nthreads
+                s_par_str = dict_to_opts(opts)
+
+                in_file = filfile if tt is None else chunk_files[tt]
+                s_cmd = f"transientx_fil {s_par_str} -o {outbase} " +\
+                        f"-f {in_file}"
+                print(f"\n{s_cmd=}\n")
+                futures.append(pool.submit(in_this_stage(run_shard), 
+                                           sdir, s_cmd))
+            for ff in futures:
+                ff.result()
+
+        # Merge the pieces
+        cfiles = []
+        for sdir in sdirs:
+            cfiles += sorted(glob(f"{sdir}/*.cands"))
+            for png in glob(f"{sdir}/*.png"):
+                os.replace(png, f"{all_dir}/{os.path.basename(png)}")
+        tx_cands.merge_cands(cfiles, f"{all_dir}/{outbase}.cands", 
+                             dt_tol=float(s_pd["opts"].get("maxw", 0.01)), 
+                             dm_frac=float(s_pd.get("dedup_dm_frac", 0.05)))
+        shutil.rmtree(shard_top)
 
-    ########################
-    ###  run replot_fil  ###
-    ########################
-    if check_proc(jdict, "tx_sp_filter"):
-        # Get relevant process dict
-        f_pd = jdict["tx_sp_filter"]
+    t_end = time.time()
+    dt = t_end - t_start
 
-        # Get sif file from arg dict
-        f_sif = get_and_check_sif(f_pd["sif"])
+    return dt
 
-        # Get options from arg dict
-        f_par_str = dict_to_opts(f_pd["opts"])
-    
-        # Get cands file
-        cfiles = glob(f"{results_dir}/{outbase}*cands")
-
-        if len(cfiles) == 1:
-            cand_file = cfiles[0]
-            f_cmd = f"replot_fil {f_par_str} " +\
-                    f"--candfile {cand_file} -f {filfile}"
-            print(f"\n{f_cmd=}\n")
-            f_sing_cmd = f"singularity exec -B {bstr} {f_sif} {f_cmd}"
-            try_cmd(f_sing_cmd)
-    
-        elif len(cfiles) == 0:
-            print("single pulse candfile not found!")
-            print("...skipping replot")
-       
-        else:
-            print("too many candfiles found!")
-            print(cfiles)
-            print("...skipping replot")
+
+def run_tx_filter(beamname, fil_dir, results_dir, jdict):
+    """
+    Run replot_fil on the transientX candidates 
+    to filter out duplicates
+
+    If the search left more than one .cands file, they 
+    are merged (see tx_cands.merge_cands) into one file 
+    in sp_plots/sifted first.
+    """
+    t_start = time.time()
+
+    filfile = f"{fil_dir}/{beamname}_01.fil" 
+    outbase = f"{beamname}"
     
-    # Make cands directory and move results there
-    organize_sp_results(results_dir)
+    if not check_file_exists(filfile):
+        sys.exit(0)
+
+    all_dir, sift_dir = make_sp_dirs(results_dir)
+
+    # Set binds
+    if fil_dir == results_dir:
+        bstr = f"{results_dir}"
+    else:
+        bstr = f"{fil_dir},{results_dir}"
+    print(f"{bstr=}")
+
+    # Get relevant process dict
+    f_pd = jdict["tx_sp_filter"]
+
+    # Get sif file from arg dict
+    f_sif = get_and_check_sif(f_pd["sif"])
+
+    # Get options from arg dict
+    f_par_str = dict_to_opts(f_pd["opts"])
+
+    # Get cands file
+    cfiles = sorted(glob(f"{all_dir}/{outbase}*cands"))
+
+    if len(cfiles) > 1:
+        print(f"Found {len(cfiles)} candfiles, merging them")
+        cand_file = f"{sift_dir}/{outbase}_merged.cands"
+        s_pd = jdict["tx_sp_search"]
+        tx_cands.merge_cands(cfiles, cand_file, 
+                             dt_tol=float(s_pd["opts"].get("maxw", 0.01)), 
+                             dm_frac=float(s_pd.get("dedup_dm_frac", 0.05)))
+        cfiles = [cand_file]
+
+    if len(cfiles) == 1:
+        cand_file = cfiles[0]
+        f_cmd = f"replot_fil {f_par_str} " +\
+                f"--candfile {cand_file} -f {filfile}"
+        print(f"\n{f_cmd=}\n")
+        f_sing_cmd = container_backend.command(f_sif, f_cmd, bstr)
+        try_cmd(f_sing_cmd, cwd=sift_dir)
+
+    else:
+        print("single pulse candfile not found!")
+        print("...skipping replot")
 
     t_end = time.time()
     dt = t_end - t_start
 
     return dt
- 
+
+
+def get_fil_info(filfile):
+    """
+    Read the header of a filterbank file and fill in 
+    nsamples from the file size if it is not there
+    """
+    fil = sigproc.FilFile(filfile)
+    hdr = dict(fil.header)
+    hdr["nsamples"] = fil.nsamples
+    return hdr
+
+
+def make_plan(beamname, fil_dir, results_dir, jdict, stages, 
+              work_dir=None, mem_gb=None):
+    """
+    Plan the steps for a beam from the headers of the 
+    data on the HOST (see planner.plan_beam).  If we are 
+    running filtool, we work out what its output will 
+    look like from the raw files.
+
+    Returns the plan (or None if we could not read 
+    the headers) and the args with missing options 
+    filled in.
+    """
+    try:
+        if "filtool" in stages:
+            raw_files = glob(f"{fil_dir}/*_{beamname}_*fil")
+            raw_files.sort()
+            raw_hdrs = [ get_fil_info(ff) for ff in raw_files ]
+            hdr = planner.cleaned_header(raw_hdrs, 
+                                         jdict["filtool"]["opts"])
+        else:
+            raw_hdrs = None
+            hdr = get_fil_info(f"{results_dir}/{beamname}_01.fil")
+    except (ValueError, KeyError, IndexError, OSError) as err:
+        print(f"Could not read headers to plan {beamname}: {err}")
+        return None, jdict
+
+    results_top = format_name( jdict["dirs"]["results_dir"] )
+    plan, jdict = planner.plan_beam(hdr, jdict, stages, raw_hdrs=raw_hdrs,
+                                    work_dir=work_dir, mem_gb=mem_gb, 
+                                    results_dir=results_top, 
+                                    peasoup_procs=gpu_pool.nslots)
+    planner.print_plan(beamname, plan)
+
+    return plan, jdict
+
+
+def count_xml_candidates(xml_file):
+    """
+    Count the candidates in a peasoup xml file 
+    (or return -1 if it can not be read)
+    """
+    ncands = 0
+    found = False
+    try:
+        for event, elem in ET.iterparse(xml_file):
+            if elem.tag == "candidate":
+                ncands += 1
+                elem.clear()
+            elif elem.tag == "candidates":
+                found = True
+    except (ET.ParseError, OSError):
+        return -1
+
+    if not found:
+        return -1
+
+    return ncands
+
+
+def check_stage_outputs(stage, beamname, results_dir):
+    """
+    Check that a processing step made what it should have.
+    Returns a description of the problem, or None if 
+    everything looks ok.
+    """
+    if stage == "filtool":
+        return sigproc.check_file(f"{results_dir}/{beamname}_01.fil")
+
+    if stage == "peasoup":
+        xml_file = f"{results_dir}/overview.xml"
+        ncands = count_xml_candidates(xml_file)
+        if ncands < 0:
+            return f"{xml_file} is missing or can not be read"
+        print(f"{beamname}: peasoup found {ncands} candidates")
+        return None
+
+    if stage == "fold":
+        if count_xml_candidates(f"{results_dir}/overview.xml") == 0:
+            return None
+        if len(glob(f"{results_dir}/cand_plots/*.cands")) == 0:
+            return f"No fold .cands file in {results_dir}/cand_plots"
+        return None
+
+    if stage == "tx_sp_search":
+        all_dir = f"{results_dir}/sp_plots/all"
+        if len(glob(f"{all_dir}/{beamname}*cands")) == 0:
+            return f"No single pulse .cands file in {all_dir}"
+        return None
+
+    return None
+
+
+def stage_dependents(stage):
+    """
+    Get all the steps that need stage (directly or not)
+    """
+    deps = []
+    for ss, ss_deps in STAGE_GRAPH.items():
+        if stage in ss_deps:
+            deps += [ss] + stage_dependents(ss)
+    return deps
+
+
+# Processing steps and the steps they need to be finished 
+# before they can start.  If a needed step was not requested 
+# (ie, it was run before and its products copied over in setup)
+# then it does not hold anything up.
+#
+#  filtool --> peasoup --> fold 
+#          \-> tx_sp_search --> tx_sp_filter
+STAGE_GRAPH = {
+    "filtool"      : [],
+    "peasoup"      : ["filtool"],
+    "fold"         : ["peasoup"],
+    "tx_sp_search" : ["filtool"],
+    "tx_sp_filter" : ["tx_sp_search"],
+}
+
+# Function to run each step 
+STAGE_FUNCS = {
+    "filtool"      : run_filtool,
+    "peasoup"      : run_peasoup,
+    "fold"         : run_psrX_fold,
+    "tx_sp_search" : run_tx_search,
+    "tx_sp_filter" : run_tx_filter,
+}
+
+# Option that sets the number of CPU threads for each 
+# step (peasoup is on the GPU so we leave it alone)
+STAGE_THREAD_OPTS = {
+    "filtool"      : "threads",
+    "fold"         : "pulsarx_threads",
+    "tx_sp_search" : "threads",
+    "tx_sp_filter" : "threads",
+}
+
+# Products of each step (relative to the results dir).  These 
+# are saved back to the results dir as soon as the step is done
+STAGE_OUTPUTS = {
+    "filtool"      : ["{beam}_01.fil"],
+    "peasoup"      : ["overview.xml"],
+    "fold"         : ["cand_plots"],
+    "tx_sp_search" : ["sp_plots/all"],
+    "tx_sp_filter" : ["sp_plots/sifted"],
+}
+
+
+def get_ncpus():
+    """
+    Number of CPUs we have to work with.  Use the slurm 
+    allocation if there is one, otherwise the whole machine
+    """
+    ncpus = os.environ.get("SLURM_CPUS_PER_TASK")
+    if ncpus is None:
+        ncpus = os.cpu_count()
+    return int(ncpus)
+
+
+def stage_branch(stage):
+    """
+    Find which branch of the graph a step is on.  This 
+    is the step just after the first one (filtool), so 
+    fold is on the "peasoup" branch and tx_sp_filter 
+    is on the "tx_sp_search" branch
+    """
+    deps = STAGE_GRAPH[stage]
+    while len(deps) and len(STAGE_GRAPH[deps[0]]):
+        stage = deps[0]
+        deps = STAGE_GRAPH[stage]
+    return stage
+
+
+def run_stage_graph(beamname, fil_dir, results_dir, jdict, tt, 
+                    ncpus=None, stages=None, on_done=None):
+    """
+    Run the requested steps following STAGE_GRAPH
+
+    Each step is started as soon as the steps it needs 
+    are done, so the single pulse branch can run at the 
+    same time as peasoup + fold.  The CPUs are split 
+    evenly between the branches that are still running 
+    when a step is started.
+
+    fil_dir is only used for filtool, everything after 
+    that works on the filtool output in results_dir.
+
+    stages is the list of steps to run (default is all the 
+    requested steps).  If on_done is given, it is called 
+    as on_done(stage) when each step finishes.
+
+    When a step finishes, its outputs are checked with 
+    check_stage_outputs.  If the step failed (bad exit 
+    status, missing or bad outputs), every step that 
+    depends on it is skipped, but the other branch keeps 
+    going.  Returns the lists of failed and skipped steps.
+    """
+    if ncpus is None:
+        ncpus = get_ncpus()
+
+    if stages is None:
+        requested = [ ss for ss in STAGE_GRAPH if check_proc(jdict, ss) ]
+    else:
+        requested = [ ss for ss in STAGE_GRAPH if ss in stages ]
+    todo = list(requested)
+    done = []
+    failed = []
+    skipped = []
+    running = {}
+
+    def is_ready(stage):
+        for dd in STAGE_GRAPH[stage]:
+            if dd in requested and dd not in done:
+                return False
+        return True
+
+    def run_stage(stage, sjdict):
+        if stage == "filtool":
+            s_fil_dir = fil_dir
+        else:
+            s_fil_dir = results_dir
+
+        with tt.stage(stage):
+            dt = STAGE_FUNCS[stage](beamname, s_fil_dir, 
+                                    results_dir, sjdict)
+            problem = check_stage_outputs(stage, beamname, 
+                                          results_dir)
+        if problem is not None:
+            raise StageError(problem)
+        return dt
+
+    with ThreadPoolExecutor(max_workers=len(STAGE_GRAPH)) as pool:
+        while len(todo) or len(running):
+            ready = [ ss for ss in todo if is_ready(ss) ]
+
+            # Branches that still have steps to run (not counting 
+            # filtool, which all the others are waiting on)
+            live_branches = set([ stage_branch(ss) for ss in 
+                                  todo + list(running.values()) ])
+            live_branches.discard("filtool")
+            
+            for stage in ready:
+                todo.remove(stage)
+                sjdict = jdict
+                opt_name = STAGE_THREAD_OPTS.get(stage)
+                if opt_name is not None:
+                    if stage == "filtool":
+                        nbranch = 1
+                    else:
+                        nbranch = max(1, len(live_branches))
+                    nthreads = max(1, ncpus // nbranch)
+                    sjdict = copy.deepcopy(jdict)
+                    sjdict[stage]["opts"][opt_name] = nthreads
+                    print(f"{beamname}: starting {stage} with " +\
+                          f"{opt_name}={nthreads}")
+                else:
+                    print(f"{beamname}: starting {stage}")
+                ff = pool.submit(run_stage, stage, sjdict)
+                running[ff] = stage
+
+            fdone, fwait = wait(list(running.keys()), 
+                                return_when=FIRST_COMPLETED)
+            for ff in fdone:
+                stage = running.pop(ff)
+                try:
+                    dt = ff.result()
+                except (Exception, SystemExit) as err:
+                    # sys.exit() is still used for missing inputs
+                    print(f"{beamname}: {stage} FAILED: {err}")
+                    failed.append(stage)
+                    for ss in stage_dependents(stage):
+                        if ss in todo:
+                            print(f"{beamname}: skipping {ss}")
+                            todo.remove(ss)
+                            skipped.append(ss)
+                    continue
+
+                print(f"{beamname}: finished {stage} in {dt/60.:.2f} min")
+                if stage in ["tx_sp_search", "tx_sp_filter"]:
+                    tt.sp += dt
+                else:
+                    setattr(tt, stage, dt)
+                if on_done is not None:
+                    on_done(stage)
+                done.append(stage)
+
+    return failed, skipped
+
+
+def file_identity(fpath):
+    """
+    Return [name, size, mtime] for a file (or None if it 
+    does not exist).  This is what we hash to decide if 
+    an input has changed, since hashing the contents of 
+    every filterbank file would take as long as copying it
+    """
+    if not os.path.exists(fpath):
+        return None
+    fstat = os.stat(fpath)
+    return [fpath, fstat.st_size, int(fstat.st_mtime)]
+
+
+def stage_key(stage, beamname, local_fil, jdict, dep_keys):
+    """
+    Make a key for a processing step that will change if 
+    anything that goes into it changes:  the sif file, the 
+    options for the step, the raw fil files (for filtool), 
+    the template (for fold), and the keys of the steps it 
+    depends on (dep_keys)
+
+    The number of threads is left out since the step is 
+    given a different number depending on what else is 
+    running at the same time.
+    """
+    pd = jdict[stage]
+
+    opts = dict(pd.get("opts", {}))
+    opts.pop(STAGE_THREAD_OPTS.get(stage), None)
+
+    sif_dict = pd.get("sif", {})
+    sif_file = f"{sif_dict.get('dir')}/{sif_dict.get('file')}"
+
+    kd = {"stage" : stage, 
+          "sif"   : file_identity(sif_file) or sif_file, 
+          "opts"  : opts, 
+          "deps"  : [ dep_keys.get(dd) for dd in STAGE_GRAPH[stage] ]}
+
+    if stage == "filtool":
+        fil_files = glob(f"{local_fil}/*_{beamname}_*fil")
+        fil_files.sort()
+        kd["inputs"] = [ file_identity(ff) for ff in fil_files ]
+
+    if stage == "fold":
+        kd["template"] = pd.get("template")
+
+    kstr = json.dumps(kd, sort_keys=True)
+    return hashlib.sha256(kstr.encode()).hexdigest()
+
+
+def stage_output_paths(stage, beamname, results_dir):
+    """
+    Get the paths of the products of a processing step
+    """
+    return [ f"{results_dir}/{oo.format(beam=beamname)}" 
+             for oo in STAGE_OUTPUTS[stage] ]
+
+
+def read_manifest(local_results):
+    """
+    Read the manifest of finished steps for a beam.  
+    If there is no manifest, return an empty one
+    """
+    mfile = f"{local_results}/manifest.json"
+    if not os.path.exists(mfile):
+        return {"stages" : {}}
+
+    with open(mfile, 'r') as fin:
+        mdict = json.load(fin)
+
+    return mdict
+
+
+def write_manifest(mdict, local_results):
+    """
+    Write the manifest of finished steps for a beam.
+    We write to a temp file first so that a job being 
+    killed can not leave a half-written manifest
+    """
+    if not os.path.exists(local_results):
+        os.makedirs(local_results)
+
+    mfile = f"{local_results}/manifest.json"
+    with open(f"{mfile}.tmp", 'w') as fout:
+        json.dump(mdict, fout, indent=4, sort_keys=True)
+    os.replace(f"{mfile}.tmp", mfile)
+
+    return
+
+
+def get_stage_keys(beamname, local_fil, jdict, mdict):
+    """
+    Get keys for all the steps that are requested.  For 
+    steps that are not requested, we use the key in the 
+    manifest (if there is one), since that is what the 
+    requested steps will be using as input.
+    """
+    keys = {}
+    for stage in STAGE_GRAPH:
+        if check_proc(jdict, stage):
+            keys[stage] = stage_key(stage, beamname, local_fil, 
+                                    jdict, keys)
+        else:
+            keys[stage] = mdict["stages"].get(stage, {}).get("key")
+    return keys
+
+
+def find_done_stages(beamname, local_results, jdict, keys, mdict):
+    """
+    Find which of the requested steps have already been 
+    run with the same key and still have all their products 
+    in local_results.  These do not need to be run again.
+    """
+    done_stages = []
+    for stage in STAGE_GRAPH:
+        if not check_proc(jdict, stage):
+            continue
+        
+        mstage = mdict["stages"].get(stage)
+        if mstage is None or mstage.get("key") != keys[stage]:
+            continue
+
+        out_paths = stage_output_paths(stage, beamname, local_results)
+        if all([ os.path.exists(oo) for oo in out_paths ]):
+            print(f"{beamname}: {stage} already done, skipping")
+            done_stages.append(stage)
+
+    return done_stages
+
+
+def checkpoint_stage(stage, beamname, host_results, local_results, 
+                     key, mdict, mlock, nthreads=4):
+    """
+    Copy the products of a finished step back to 
+    local_results and record it in the manifest, so 
+    that a later failure does not lose it.
+
+    Products that are directories (eg, cand_plots) are 
+    copied next to the old one and then swapped in, so we 
+    never end up with a mix of old and new files.
+    """
+    if not os.path.exists(local_results):
+        os.makedirs(local_results)
+
+    host_paths  = stage_output_paths(stage, beamname, host_results)
+    local_paths = stage_output_paths(stage, beamname, local_results)
+
+    checksums = {}
+    for hpath, lpath in zip(host_paths, local_paths):
+        if not os.path.exists(hpath):
+            print(f"{beamname}: {stage} product missing, not saving:")
+            print(f"  {hpath}")
+            return
+
+        print(f"{beamname}: saving {hpath} -> {lpath}")
+        if os.path.isdir(hpath):
+            if os.path.exists(f"{lpath}.tmp"):
+                shutil.rmtree(f"{lpath}.tmp")
+            cc = staging.copy_tree(hpath, f"{lpath}.tmp", 
+                                   nthreads=nthreads, label=beamname)
+            record_copies(cc)
+            if os.path.exists(lpath):
+                shutil.rmtree(lpath)
+            os.rename(f"{lpath}.tmp", lpath)
+            for cpath, md5 in cc.items():
+                checksums[lpath + cpath[len(f"{lpath}.tmp"):]] = md5
+        else:
+            lpath_dir = os.path.dirname(lpath)
+            if not os.path.exists(lpath_dir):
+                os.makedirs(lpath_dir)
+            cc = staging.copy_files([(hpath, f"{lpath}.tmp")], 
+                                    nthreads=nthreads, label=beamname)
+            record_copies(cc)
+            os.replace(f"{lpath}.tmp", lpath)
+            checksums[lpath] = cc[f"{lpath}.tmp"]
+
+    with mlock:
+        mdict["stages"][stage] = { 
+            "key"     : key, 
+            "outputs" : [ oo.format(beam=beamname) 
+                          for oo in STAGE_OUTPUTS[stage] ], 
+            "date"    : datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        } 
+        write_manifest(mdict, local_results)
+        staging.update_checksums(checksums, local_results)
+
+    return
+
+
+def check_inputs(beamname, fil_list):
+    """
+    Run the pre-flight checks on the fil files for a beam 
+    (see sigproc.check_inputs) and raise a StageError if 
+    anything is wrong with them
+    """
+    problems = sigproc.check_inputs(fil_list)
+    if len(problems):
+        for prob in problems:
+            print(f"BAD INPUT: {prob}")
+        raise StageError(f"{beamname}: {len(problems)} problem(s) " +\
+                         f"with the input fil files")
+    print(f"Pre-flight checks passed for {len(fil_list)} fil files")
+    return
+
 
 def setup(beamname, local_fil, local_results, 
-          host_fil, host_results, jdict):
+          host_fil, host_results, jdict, run_stages=None, 
+          prefetched=False):
     """
     Setup HOST directories and copy over necessary files
 
@@ -557,7 +1594,23 @@ def setup(beamname, local_fil, local_results,
 
     In this setup function, we will decide which files 
     are needed and move them over to the HOST accordingly
+
+    run_stages is the list of steps that will actually be 
+    run (requested and not already done, see find_done_stages).
+    If None, we use all the requested steps.
+
+    If prefetched is True, the raw fil files have already 
+    been copied to host_fil (see staging.Prefetcher)
+
+    The fil files are checked (check_inputs) before we 
+    copy anything, so bad data fail right away.
     """
+    if run_stages is None:
+        run_stages = [ ss for ss in STAGE_GRAPH if check_proc(jdict, ss) ]
+
+    # Number of files to copy at once
+    nthreads = staging.get_copy_threads(jdict)
+
     # Make HOST fil dir
     if not os.path.exists(host_fil):
         os.makedirs(host_fil)
@@ -569,7 +1622,7 @@ def setup(beamname, local_fil, local_results,
     # If we are running filtool, then copy over 
     # all the fil files of the form:
     #  *_{beamname}_*.fil
-    if check_proc(jdict, "filtool"):
+    if "filtool" in run_stages:
         glob_str = f"{local_fil}/*_{beamname}_*fil"
         fil_list = glob(glob_str)
         fil_list.sort()
@@ -584,17 +1637,27 @@ def setup(beamname, local_fil, local_results,
         if len(fil_list) == 0:
             sys.exit(0)
 
+        # Pre-flight checks (only the headers and file 
+        # sizes are read, so this is quick)
+        check_inputs(beamname, fil_list)
+
         # Copy over fil files to HOST_FIL
-        print("\nCOPYING OVER FIL FILES")
-        for ffn in fil_list:
-            shutil.copy(ffn, host_fil)
+        if prefetched:
+            print("\nFIL FILES ALREADY PREFETCHED")
+        else:
+            print("\nCOPYING OVER FIL FILES")
+            pairs = [ (ffn, host_fil) for ffn in fil_list ]
+            cc = staging.copy_files(pairs, nthreads=nthreads, 
+                                    label=beamname, cache=artifact_cache)
+            record_copies(cc)
         
     # If we are NOT running filtool then the combined 
     # data file should already exist in LOCAL_RESULTS,
     # so we can just copy it over
-    elif (check_proc(jdict, "peasoup") or \
-          check_proc(jdict, "fold") or \
-          check_proc(jdict, "tx_sp_search")):
+    elif ("peasoup" in run_stages or \
+          "fold" in run_stages or \
+          "tx_sp_search" in run_stages or \
+          "tx_sp_filter" in run_stages):
         glob_str = f"{local_results}/{beamname}*.fil"
         fil_list = glob(glob_str)
         fil_list.sort()
@@ -613,29 +1676,71 @@ def setup(beamname, local_fil, local_results,
             print(f"Only expected one file, found {len(fil_list)}")
             sys.exit(0) 
 
+        check_inputs(beamname, fil_list)
+
         # Copy over fil files to HOST_FIL
         print("COPYING OVER FIL FILE")
-        shutil.copy(fil_list[0], host_results)
+        cc = staging.copy_files([(fil_list[0], host_results)], 
+                                nthreads=nthreads, label=beamname, 
+                                cache=artifact_cache)
+        record_copies(cc)
 
     else: pass
 
     # If we are running fold then we either need 
     # to run peasoup first or copy over a cand list
-    if check_proc(jdict, "fold") and not check_proc(jdict, "peasoup"):
+    if "fold" in run_stages and "peasoup" not in run_stages:
         print("Folding but NOT searching")
         print(f"Looking for overview.xml in {local_results}")
         xml_file = f"{local_results}/overview.xml"
         if os.path.exists(xml_file):
             print(f"Found xml file: {xml_file}")
             shutil.copy(xml_file, host_results)
+            # and the table of its candidates, if it was saved
+            xml_table = cand_table.find_table(cand_table.sidecar_base(xml_file))
+            if xml_table is not None:
+                print(f"Found candidate table: {xml_table}")
+                shutil.copy(xml_table, host_results)
+
+    # When folding incrementally, bring back what was folded 
+    # before (organize_fold_results will put it back in 
+    # cand_plots), so only new candidates are folded
+    if "fold" in run_stages and jdict["fold"]["opts"].get("incremental"):
+        local_plots = f"{local_results}/cand_plots"
+        if os.path.exists(f"{local_plots}/fold_index.json"):
+            print(f"Restaging earlier folds from {local_plots}")
+            cc = staging.copy_tree(local_plots, host_results, 
+                                   nthreads=nthreads, label=beamname)
+            record_copies(cc)
+
+    # Same for the single pulse sifting, which needs the 
+    # candidates from the search
+    if "tx_sp_filter" in run_stages and "tx_sp_search" not in run_stages:
+        print("Sifting but NOT searching for single pulses")
+        local_all = f"{local_results}/sp_plots/all"
+        print(f"Looking for {local_all}")
+        if os.path.exists(local_all):
+            print(f"Found single pulse search results: {local_all}")
+            cc = staging.copy_tree(local_all, 
+                                   f"{host_results}/sp_plots/all", 
+                                   nthreads=nthreads, label=beamname)
+            record_copies(cc)
 
     return
 
 
-def get_results(local_results, host_results):
+def get_results(local_results, host_results, nthreads=4):
     """
     Copy over files from HOST to LOCAL
+
+    Files are copied nthreads at a time and their md5 
+    sums are added to local_results/checksums.md5
     """
+    if not os.path.exists(local_results):
+        os.makedirs(local_results)
+
+    pairs = []
+
     # Check for and copy directories
     sub_dirs = ["cand_plots", "sp_plots"]
     for sub_dir in sub_dirs:
@@ -643,7 +1748,7 @@ def get_results(local_results, host_results):
         host_path  = "%s/%s" %(host_results, sub_dir)
         if not os.path.exists(local_path):
             if os.path.exists(host_path):
-                shutil.copytree(host_path, local_path)
+                pairs += staging.tree_pairs(host_path, local_path)
             else: pass
         else: pass
 
@@ -651,17 +1756,28 @@ def get_results(local_results, host_results):
     log_files = glob("%s/*log" %(host_results))
     # Check for xml files 
     xml_files = glob("%s/*xml" %(host_results))
+    # and the candidate tables saved with them
+    table_files = []
+    for xx in xml_files:
+        xml_table = cand_table.find_table(cand_table.sidecar_base(xx))
+        if xml_table is not None:
+            table_files.append(xml_table)
     
-    misc_files = log_files + xml_files
+    misc_files = log_files + xml_files + table_files
 
     # Copy them over
     if len(misc_files):
         for mm_file in misc_files:
             print(mm_file)
             fname = mm_file.split('/')[-1]
-            shutil.copyfile(mm_file, "%s/%s" %(local_results, fname))
+            pairs.append( (mm_file, "%s/%s" %(local_results, fname)) )
     else: pass
 
+    checksums = staging.copy_files(pairs, nthreads=nthreads, 
+                                   label="get_results")
+    record_copies(checksums)
+    staging.update_checksums(checksums, local_results)
+
     return
 
 
@@ -682,10 +1798,14 @@ def cleanup(host_fil, host_results):
     return 
 
 
-def cleanup_beam(beam_host):
+def cleanup_beam(beam_host, stop_containers=True):
     """
-    Remove remaining files from HOST
+    Remove remaining files from HOST and (unless other 
+    beams are still using them) stop the container instances
     """
+    if stop_containers:
+        container_backend.stop_all()
+
     if os.path.exists(beam_host):
         print("REMOVING DIRECTORY %s" %beam_host)
         shutil.rmtree(beam_host)
@@ -728,6 +1848,25 @@ def print_dirs(h_top, h_fil, h_results, l_fil, l_results):
     return 
 
 
+def parse_beam_list(beam_str):
+    """
+    Convert a beam list string like "2,3,7-12" to 
+    a sorted list of unique beam numbers
+    """
+    beams = []
+    for part in beam_str.split(','):
+        part = part.strip()
+        if part == "":
+            continue
+        if '-' in part:
+            b_lo, b_hi = part.split('-', 1)
+            beams += list(range(int(b_lo), int(b_hi) + 1))
+        else:
+            beams.append(int(part))
+
+    return sorted(set(beams))
+
+
 def parse_input():
     """
     Parse argumnents to GC Search Pipeline
@@ -741,43 +1880,81 @@ def parse_input():
     parser.add_argument('--args_json', 
                         help='JSON file containing pipeline args',
                         required=True)
-    parser.add_argument('--beam',
-                        help='Beam number',
-                        required=True, type=int, default=0)
+    beam_group = parser.add_mutually_exclusive_group(required=True)
+    beam_group.add_argument('--beam',
+                            help='Beam number',
+                            type=int, default=None)
+    beam_group.add_argument('--beams',
+                            help='List of beams to run in this job '+\
+                                 '(e.g., 2,3,7-12)',
+                            type=str, default=None)
+    parser.add_argument('--beam_slots',
+                        help='Number of beams processed at once '+\
+                             'when running with --beams (default: 2)',
+                        type=int, default=2)
+    parser.add_argument('--ngpus',
+                        help='Number of GPUs to use (default: all '+\
+                             'in CUDA_VISIBLE_DEVICES, or 1 if unset)',
+                        type=int, default=None)
+    parser.add_argument('--procs_per_gpu',
+                        help='Number of peasoup runs allowed on each '+\
+                             'GPU at once (default: 1)',
+                        type=int, default=1)
+    parser.add_argument('--ncpus',
+                        help='Number of CPUs to split between steps '+\
+                             '(default: SLURM_CPUS_PER_TASK or all)',
+                        type=int, default=None)
+    parser.add_argument('--container_mode',
+                        help='How to run the tools: one singularity '+\
+                             'instance per image for the whole job, '+\
+                             'a singularity exec per command, or '+\
+                             'directly without containers '+\
+                             '(default: instance)',
+                        choices=containers.BACKEND_MODES, 
+                        default="instance")
     args = parser.parse_args()
 
     return args
 
 
-####################
-##     MAIN       ##
-####################
+def process_beam(beam_num, top_HOST, jsonfile, jd, ncpus=None, 
+                 prefetcher=None, stop_containers=True, mem_gb=None):
+    """
+    Run all the requested processing steps on one beam
+
+    Everything for this beam happens in its own directory 
+    (top_HOST/cfbfXXXXX) and is removed with cleanup_beam 
+    when we are done, whether or not things worked.
+
+    The peasoup runs get their GPUs from gpu_pool, so that 
+    several beams running at once do not put more than 
+    procs_per_gpu searches on each GPU at a time.
+
+    ncpus is the number of CPUs this beam can use, which 
+    are split between the steps that run at the same time, 
+    and mem_gb is the memory it can use (default is what 
+    planner.get_mem_gb finds)
+
+    If prefetcher is given (a staging.Prefetcher), the raw 
+    data for this beam may have already been copied over 
+    in the background.
+
+    If stop_containers is False, the container instances 
+    are left running for the next beam (run_beams stops 
+    them at the end of the job).
+    """
+    # beam name
+    beamname = f"cfbf{beam_num:05d}"
 
-if __name__ == "__main__":
     # Start Timer
-    tt = Timer()
+    tt = Timer(beamname)
     t_start = time.time()
 
     # Get date time start 
     dstart = datetime.now() 
     tt.dstart = dstart.strftime('%Y-%m-%dT%H:%M:%S')
 
-    # Parse input
-    args = parse_input()
-    
-    # beam name
-    beam_num = args.beam
-    beamname = f"cfbf{beam_num:05d}"
-
-    # Read in the json args file and make sure its ok
-    # It will return None if something went wrong
-    jsonfile = args.args_json
-    jd = read_and_check_json(jsonfile)
-    if jd is None:
-        sys.exit(0)
-
     # Relevant directories on compute node
-    top_HOST     = format_name( args.work_dir )
     beam_HOST    = f"{top_HOST}/{beamname}"
     fil_HOST     = f"{beam_HOST}/fil"
     results_HOST = f"{beam_HOST}/search"
@@ -795,49 +1972,82 @@ if __name__ == "__main__":
 
     # TRY SETTING UP AND SEARCHING
     try:
-        # SET-UP on HOST 
-        setup(beamname, fil_LOCAL, results_LOCAL, 
-              fil_HOST, results_HOST, jd)
+        # Figure out which steps were already done in an 
+        # earlier run (same inputs, sif, and options) so we 
+        # can skip them
+        mdict = read_manifest(results_LOCAL)
+        mlock = threading.Lock()
+        keys  = get_stage_keys(beamname, fil_LOCAL, jd, mdict)
+        done_stages = find_done_stages(beamname, results_LOCAL, jd, 
+                                       keys, mdict)
+        run_stages = [ ss for ss in STAGE_GRAPH if check_proc(jd, ss) 
+                       and ss not in done_stages ]
+
+        def save_stage(stage):
+            with tt.stage(f"checkpoint_{stage}"):
+                checkpoint_stage(stage, beamname, results_HOST, 
+                                 results_LOCAL, keys[stage], mdict, mlock, 
+                                 nthreads=staging.get_copy_threads(jd))
+
+        with tt.stage("setup"):
+            # Wait for (or cancel) the prefetch of the raw data
+            prefetched = False
+            if prefetcher is not None:
+                prefetched = prefetcher.claim(beamname)
+
+            # SET-UP on HOST 
+            setup(beamname, fil_LOCAL, results_LOCAL, 
+                  fil_HOST, results_HOST, jd, run_stages, prefetched)
 
         print(f"Files in {fil_HOST}:", glob("%s/*" %fil_HOST), "\n")
         print(f"Files in {results_HOST}:", glob("%s/*" %results_HOST), "\n")
 
-        # Go to results directory
-        os.chdir(results_HOST)
-        # print current working directory
-        print("Currently in: ", os.getcwd(), "\n")
-
-        # run filtool to combine + clean files
+        # Estimate what the steps will need from the data 
+        # headers and fill in (or warn about) the options 
+        # before starting any containers
+        with tt.stage("plan") as rec:
+            if mem_gb is None:
+                mem_gb = planner.get_mem_gb(jd)
+            plan, run_jd = make_plan(beamname, fil_HOST, results_HOST, 
+                                     jd, run_stages, work_dir=top_HOST, 
+                                     mem_gb=mem_gb)
+            if plan is not None:
+                rec["units"] = plan["units"]
+                rec["plan"]  = plan
+
+        # run the processing steps... filtool first, then the 
+        # peasoup + fold and single pulse branches side by side.
         # prelim fil files will be in fil_HOST, 
         # the result will be placed in results_HOST
-        if check_proc(jd, "filtool"):
-            dt_ft = run_filtool(beamname, fil_HOST, results_HOST, jd)
-            tt.filtool = dt_ft
-   
-        # run psoup fourier domain periodicity search     
-        if check_proc(jd, "peasoup"):
-            dt_ps = run_peasoup(beamname, results_HOST, results_HOST, jd)
-            tt.peasoup = dt_ps
-   
-        # run pulsarX candidate folding 
-        if check_proc(jd, "fold"):
-            dt_fold = run_psrX_fold(beamname, results_HOST, results_HOST, jd)
-            tt.fold = dt_fold
-
-        # run TransientX single pulse search
-        if check_proc(jd, "tx_sp_search") or  check_proc(jd, "tx_sp_filter"):
-            dt_sp = run_transientX(beamname, results_HOST, results_HOST, jd)
-            tt.sp = dt_sp
+        # Each step is saved back to results_LOCAL as soon 
+        # as it finishes.
+        failed, skipped = run_stage_graph(beamname, fil_HOST, 
+                                          results_HOST, run_jd, tt, 
+                                          ncpus=ncpus, 
+                                          stages=run_stages, 
+                                          on_done=save_stage)
 
         # Copy back results
-        get_results(results_LOCAL, results_HOST)
+        with tt.stage("get_results"):
+            get_results(results_LOCAL, results_HOST, 
+                        nthreads=staging.get_copy_threads(jd))
+
+        # Made it to the end 
+        if len(failed) == 0:
+            tt.status = "COMPLETE"
+        else:
+            print(f"{beamname}: FAILED steps:  {failed}")
+            print(f"{beamname}: SKIPPED steps: {skipped}")
 
     except:
-        print("Something failed!!!!")
+        print(f"Something failed on {beamname}!!!!")
 
     finally:
         # Delete everything from compute node
-        cleanup_beam(beam_HOST)
+        with tt.stage("cleanup"):
+            cleanup_beam(beam_HOST, stop_containers)
+        if prefetcher is not None:
+            prefetcher.release(beamname)
 
         # Finish up time profiling and print summary to screen
         t_finish = time.time()
@@ -852,7 +2062,156 @@ if __name__ == "__main__":
         logname = f"{beamname}_{dstr}.log"
         tt.write_summary(f"{results_LOCAL}/{logname}")
 
+        # Machine readable per-stage metrics next to the log
+        mname = f"{beamname}_{dstr}.jsonl"
+        tt.write_metrics(f"{results_LOCAL}/{mname}")
+
         # Copy JSON file to results
         copy_and_tag_json(jsonfile, results_LOCAL)
 
-        print("done")
+    return tt.status
+
+
+def get_prefetch_jobs(beam_list, top_HOST, jd):
+    """
+    Get the (beamname, fil_files, dst_dir) jobs for 
+    staging.Prefetcher.  We only prefetch for beams that 
+    will be running filtool (ie, it is requested and not 
+    already done according to the manifest).
+    """
+    raw_dir     = format_name( jd["dirs"]["raw_dir"] )
+    results_dir = format_name( jd["dirs"]["results_dir"] )
+
+    jobs = []
+    for beam_num in beam_list:
+        beamname = f"cfbf{beam_num:05d}"
+        fil_LOCAL     = f"{raw_dir}/{beamname}"
+        results_LOCAL = f"{results_dir}/{beamname}"
+        fil_HOST      = f"{top_HOST}/{beamname}/fil"
+
+        mdict = read_manifest(results_LOCAL)
+        keys  = get_stage_keys(beamname, fil_LOCAL, jd, mdict)
+        done_stages = find_done_stages(beamname, results_LOCAL, jd, 
+                                       keys, mdict)
+        if not check_proc(jd, "filtool") or "filtool" in done_stages:
+            continue
+
+        fil_files = glob(f"{fil_LOCAL}/*_{beamname}_*fil")
+        fil_files.sort()
+        if len(fil_files):
+            jobs.append( (beamname, fil_files, fil_HOST) )
+
+    return jobs
+
+
+def run_beams(beam_list, top_HOST, jsonfile, jd, beam_slots=2, 
+              ncpus=None):
+    """
+    Process several beams in one job
+
+    Up to beam_slots beams are in flight at once.  The GPUs 
+    are shared through gpu_pool, so while one beam is in 
+    peasoup the others can be running filtool, folding, or 
+    the single pulse search on the CPUs.
+
+    The ncpus CPUs (and the memory) are split evenly 
+    between the slots.
+
+    While the first beams are running, the raw data for 
+    the following beams is copied over in the background 
+    (up to the prefetch_gb limit in the "staging" block).
+
+    The container instances are shared by all the beams 
+    and stopped at the end.
+    """
+    nslots = max(1, min(beam_slots, len(beam_list)))
+
+    if ncpus is None:
+        ncpus = get_ncpus()
+    beam_ncpus = max(1, ncpus // nslots)
+
+    beam_mem_gb = planner.get_mem_gb(jd)
+    if beam_mem_gb is not None:
+        beam_mem_gb /= nslots
+
+    print(f"Processing {len(beam_list)} beams with {nslots} slots")
+    print(f"  ({beam_ncpus} CPUs per slot)")
+    print(f"  {beam_list}\n")
+
+    # Prefetch the raw data for beams that need filtool.  
+    # The first nslots beams start right away, so there is 
+    # no point prefetching those.
+    prefetcher = None
+    max_bytes = staging.get_prefetch_bytes(jd)
+    if max_bytes > 0:
+        pf_jobs = get_prefetch_jobs(beam_list[nslots:], top_HOST, jd)
+        if len(pf_jobs):
+            prefetcher = staging.Prefetcher(pf_jobs, max_bytes, 
+                                   nthreads=staging.get_copy_threads(jd), 
+                                   cache=artifact_cache)
+            prefetcher.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=nslots) as pool:
+            futures = [ pool.submit(process_beam, beam_num, top_HOST, 
+                                    jsonfile, jd, beam_ncpus, 
+                                    prefetcher, False, beam_mem_gb) 
+                        for beam_num in beam_list ]
+            statuses = [ ff.result() for ff in futures ]
+    finally:
+        if prefetcher is not None:
+            prefetcher.stop()
+        container_backend.stop_all()
+
+    failed_beams = [ bb for bb, ss in zip(beam_list, statuses) 
+                     if ss != "COMPLETE" ]
+    if len(failed_beams):
+        print(f"FAILED beams: {failed_beams}")
+
+    return failed_beams
+
+
+####################
+##     MAIN       ##
+####################
+
+if __name__ == "__main__":
+    # Parse input
+    args = parse_input()
+
+    # Read in the json args file and make sure its ok
+    # It will return None if something went wrong
+    jsonfile = args.args_json
+    jd = read_and_check_json(jsonfile)
+    if jd is None:
+        sys.exit(0)
+
+    # Top of the work directory on compute node
+    top_HOST = format_name( args.work_dir )
+
+    # Start each container once per job (binding the work 
+    # directory) instead of once per command
+    container_backend = containers.ContainerBackend(args.container_mode, 
+                                                    binds=[top_HOST])
+
+    # GPUs for peasoup
+    gpu_pool = GpuPool(get_gpu_devices(args.ngpus), args.procs_per_gpu)
+
+    # Keep sif and fil files on the node if we have a cache_dir
+    artifact_cache = staging.get_cache(jd)
+
+    if args.beams is not None:
+        beam_list = parse_beam_list(args.beams)
+        failed_beams = run_beams(beam_list, top_HOST, jsonfile, jd, 
+                                 beam_slots=args.beam_slots, 
+                                 ncpus=args.ncpus)
+    else:
+        status = process_beam(args.beam, top_HOST, jsonfile, jd, 
+                              ncpus=args.ncpus)
+        failed_beams = [] if status == "COMPLETE" else [args.beam]
+
+    print("done")
+
+    # Let slurm know if something went wrong
+    if len(failed_beams):
+        sys.exit(1)
@@ -0,0 +1,167 @@
+"""
+Merge peasoup output (overview.xml) files from searches
+that were split up (used by gcpsr_search2.py)
+
+The merged file keeps the layout of a normal peasoup
+overview.xml (fold_cands.py finds the blocks by tag, so an
+extra merge_note block does no harm),
+with the candidates from all the files sorted by S/N,
+cut to the peasoup limit, and renumbered.
+
+Searches over segments of the observation are merged the
+same way, but each candidate gets the segment it came from
+(segment_start_sample, segment_nsamples, segment_pepoch)
+so that fold_cands.py can fold it over the right span.
+"""
+import xml.etree.ElementTree as ET
+
+
+def get_float(elem, tag, default=0.0):
+    child = elem.find(tag)
+    if child is None or child.text is None:
+        return default
+    try:
+        return float(child.text)
+    except ValueError:
+        return default
+
+
+def merge_trials(roots, tag):
+    """
+    Combine the trial lists (eg, dedispersion_trials)
+    of several files into the block of the first one
+    """
+    block = roots[0].find(tag)
+    if block is None:
+        return
+
+    vals = []
+    for root in roots:
+        rblock = root.find(tag)
+        if rblock is None:
+            continue
+        vals += [ tt.text for tt in rblock.findall("trial") ]
+
+    # Keep the order, but drop repeats
+    vals = list(dict.fromkeys(vals))
+
+    for tt in block.findall("trial"):
+        block.remove(tt)
+    for ii, val in enumerate(vals):
+        tt = ET.SubElement(block, "trial", id=str(ii))
+        tt.text = val
+    block.set("count", str(len(vals)))
+    return
+
+
+SEGMENT_TAGS = ["segment_start_sample", "segment_nsamples", "segment_pepoch"]
+
+
+def top_candidates(roots, limit=None):
+    """
+    All the candidates in roots sorted by S/N and cut to 
+    the top limit (if given)
+    """
+    cands = []
+    for rr in roots:
+        cblock = rr.find("candidates")
+        if cblock is not None:
+            cands += cblock.findall("candidate")
+
+    cands.sort(key=lambda cc: get_float(cc, "snr"), reverse=True)
+    if limit is not None and limit > 0:
+        cands = cands[:int(limit)]
+    return cands
+
+
+def tag_segment(cands, root):
+    """
+    Add the segment parameters of root (and the FFT size 
+    of its search, as segment_fft_size) to each candidate
+    """
+    sblock = root.find("segment_parameters")
+    if sblock is None:
+        return
+    size = root.find("search_parameters/size")
+    for cc in cands:
+        for tag in SEGMENT_TAGS:
+            elem = sblock.find(tag)
+            if elem is not None and cc.find(tag) is None:
+                ET.SubElement(cc, tag).text = elem.text
+        if size is not None and cc.find("segment_fft_size") is None:
+            ET.SubElement(cc, "segment_fft_size").text = size.text
+    return
+
+
+def merge_overviews(xml_groups, outfile, limit=None, full_group=None):
+    """
+    Merge the candidates from several peasoup xml files
+    into outfile.  xml_groups is a list of lists of files, 
+    where each group is one search (eg, one segment) split 
+    up by DM.  The candidates of each group are cut to 
+    the top limit (if given) by S/N like a single peasoup 
+    run.  If there is more than one group, each candidate 
+    is tagged with the segment of its group.
+
+    The header and segment blocks come from the first file 
+    of group full_group (the full length search).  If there 
+    is no full length search (full_group is None), they come 
+    from the first group, and a merge_note in the output 
+    says so.  The DM trials come from all the files, and 
+    dm_start and dm_end in the search parameters cover the 
+    whole range.  The candidates are sorted by S/N and 
+    renumbered from 0.
+
+    Returns the number of candidates written.
+    """
+    trees = []
+    cands = []
+    first_tree = {}
+    for gg, group in enumerate(xml_groups):
+        gtrees = [ ET.parse(xx) for xx in group ]
+        groots = [ tree.getroot() for tree in gtrees ]
+        gcands = top_candidates(groots, limit)
+        if len(xml_groups) > 1:
+            tag_segment(gcands, groots[0])
+        first_tree[gg] = gtrees[0]
+        trees += gtrees
+        cands += gcands
+
+    roots = [ tree.getroot() for tree in trees ]
+    out_tree = first_tree[0 if full_group is None else full_group]
+    root = out_tree.getroot()
+    # merge_trials fills in the blocks of the first root
+    roots = [root] + [ rr for rr in roots if rr is not root ]
+
+    if full_group is None and len(xml_groups) > 1:
+        note = ET.SubElement(root, "merge_note")
+        note.text = "No full length search: the header and " +\
+                    "segment blocks are from the first segment " +\
+                    f"searched ({xml_groups[0][0]})"
+
+    cands.sort(key=lambda cc: get_float(cc, "snr"), reverse=True)
+
+    cblock = root.find("candidates")
+    for cc in cblock.findall("candidate"):
+        cblock.remove(cc)
+    for ii, cc in enumerate(cands):
+        cc.set("id", str(ii))
+        cblock.append(cc)
+
+    merge_trials(roots, "dedispersion_trials")
+    merge_trials(roots, "acceleration_trials")
+
+    sblock = root.find("search_parameters")
+    if sblock is not None:
+        for tag, func in [("dm_start", min), ("dm_end", max)]:
+            elem = sblock.find(tag)
+            if elem is None:
+                continue
+            vals = [ get_float(rr.find("search_parameters"), tag)
+                     for rr in roots
+                     if rr.find("search_parameters") is not None ]
+            elem.text = str(func(vals))
+
+    out_tree.write(outfile, xml_declaration=True)
+
+    return len(cands)
@@ -0,0 +1,396 @@
+"""
+Work out what a beam will need before running anything
+(used by gcpsr_search2.py)
+
+From the filterbank header(s) and the options in the JSON
+args, we estimate the number of DM and acceleration trials
+and the FFT size of the peasoup search, and the memory,
+scratch disk, and run time of each step.  The run times
+come from a simple cost model fit to the metrics (.jsonl)
+files of beams that have already been processed:
+
+    wall_s = coeff[stage] * units[stage]
+
+where units is a rough count of the work done in each step
+(eg, DM trials x accel trials x FFT size for peasoup).  The
+units for each beam are saved in its metrics file (the
+"plan" record), so the model gets better as we go.
+
+Options that are not set are filled in where we can (eg,
+the peasoup ram_limit_gb), and we warn about the rest.
+"""
+import os
+import json
+import math
+import copy
+import shutil
+from glob import glob
+
+
+# Speed of light (m/s)
+SPEED_OF_LIGHT = 2.99792458e8
+
+# peasoup defaults for the DM and accel trial spacing
+DM_TOL          = 1.10
+DM_PULSE_WIDTH  = 64.0
+ACC_TOL         = 1.10
+ACC_PULSE_WIDTH = 64.0
+
+# Fraction of the memory we let the steps use
+MEM_FRAC = 0.8
+
+# Max number of metrics files to fit the cost model
+MAX_METRICS = 200
+
+
+def get_mem_gb(jdict=None):
+    """
+    Memory we have to work with (GB).  Use "mem_gb" from
+    the (optional) "planner" block of the JSON args, then
+    the slurm allocation, and then the whole machine.
+    """
+    pd = {} if jdict is None else jdict.get("planner", {})
+    if pd.get("mem_gb") is not None:
+        return float(pd["mem_gb"])
+
+    mem_mb = os.environ.get("SLURM_MEM_PER_NODE")
+    if mem_mb is not None:
+        return float(mem_mb) / 1024.
+
+    mem_cpu = os.environ.get("SLURM_MEM_PER_CPU")
+    ncpus   = os.environ.get("SLURM_CPUS_PER_TASK")
+    if mem_cpu is not None and ncpus is not None:
+        return float(mem_cpu) * int(ncpus) / 1024.
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * \
+               os.sysconf('SC_PHYS_PAGES') / 1024.**3
+    except (ValueError, OSError):
+        return None
+
+
+def generate_dm_list(dm_start, dm_end, tsamp, nchans, fch1, foff,
+                     pulse_width=DM_PULSE_WIDTH, tol=DM_TOL):
+    """
+    DM trials spaced so that the extra smearing between
+    trials is a factor tol of the intrinsic width (the
+    same scheme as dedisp, which peasoup uses)
+
+    tsamp in s, fch1 and foff in MHz, pulse_width in us
+    """
+    dt = tsamp * 1e6
+    df = abs(foff)
+    ff = (fch1 + (nchans / 2. - 0.5) * foff) * 1e-3
+    tol2 = tol * tol
+    aa = 8.3 * df / (ff * ff * ff)
+    a2 = aa * aa
+    b2 = a2 * (nchans * nchans / 16.0)
+    cc = (dt * dt + pulse_width * pulse_width) * (tol2 - 1.0)
+
+    dm_list = [dm_start]
+    while dm_list[-1] < dm_end:
+        prev  = dm_list[-1]
+        prev2 = prev * prev
+        kk = cc + tol2 * a2 * prev2
+        dm = (b2 * prev + math.sqrt(-a2 * b2 * prev2 + (a2 + b2) * kk)) /\
+             (a2 + b2)
+        dm_list.append(dm)
+
+    return dm_list
+
+
+def prev_power_of_two(nn):
+    """
+    Largest power of two <= nn (what peasoup uses for
+    the FFT size if it is not given)
+    """
+    if nn < 1:
+        return 0
+    return 2**int(math.floor(math.log2(nn)))
+
+
+def num_accel_trials(acc_start, acc_end, tobs, tsamp,
+                     pulse_width=ACC_PULSE_WIDTH, tol=ACC_TOL):
+    """
+    Approximate number of acceleration trials.  The step
+    is the acceleration that moves a pulse by the
+    tolerated extra smearing over the observation,
+    a * tobs^2 / (8 c)
+    """
+    if acc_end <= acc_start:
+        return 1
+    width = math.sqrt( (tsamp * 1e6)**2 + pulse_width**2 ) * 1e-6
+    step = 8 * SPEED_OF_LIGHT * width * math.sqrt(tol**2 - 1) / tobs**2
+    return int(math.ceil((acc_end - acc_start) / step)) + 1
+
+
+def cleaned_header(raw_hdrs, ft_opts):
+    """
+    Header of the filtool output from the raw headers (the
+    raw files are joined in time) and the decimation
+    factors in the filtool options.  The output is 8 bit.
+    """
+    td = int(ft_opts.get("td", 1))
+    fd = int(ft_opts.get("fd", 1))
+
+    hdr = dict(raw_hdrs[0])
+    hdr["nsamples"] = sum([ hh["nsamples"] for hh in raw_hdrs ]) // td
+    hdr["nchans"]   = hdr["nchans"] // fd
+    hdr["tsamp"]    = hdr["tsamp"] * td
+    hdr["foff"]     = hdr["foff"] * fd
+    hdr["nbits"]    = 8
+    return hdr
+
+
+def data_bytes(hdr):
+    return hdr["nsamples"] * hdr["nchans"] * hdr["nbits"] // 8
+
+
+def fit_cost_model(results_dir, max_files=MAX_METRICS):
+    """
+    Fit seconds per unit of work for each step from
+    the metrics files under results_dir.  We use the
+    median over the beams to be robust to the odd slow
+    node.  Also returns the largest max RSS (GB) seen for
+    each step.  Steps without any history are left out.
+    """
+    mfiles = glob(f"{results_dir}/cfbf*/cfbf*_*.jsonl")
+    mfiles.sort(key=os.path.getmtime)
+    mfiles = mfiles[-max_files:]
+
+    ratios = {}
+    rss = {}
+    for mfile in mfiles:
+        units = None
+        walls = {}
+        try:
+            with open(mfile, 'r') as fin:
+                for line in fin:
+                    rec = json.loads(line)
+                    if rec["stage"] == "plan":
+                        units = rec.get("units")
+                    elif rec.get("parent") is None and \
+                         rec.get("status") == "ok":
+                        walls[rec["stage"]] = rec["wall_s"]
+                        rss[rec["stage"]] = max(rss.get(rec["stage"], 0.0),
+                                        rec.get("maxrss_mb", 0.0) / 1024.)
+        except (ValueError, KeyError, OSError):
+            continue
+
+        if units is None:
+            continue
+
+        for stage, wall_s in walls.items():
+            if units.get(stage, 0) > 0:
+                ratios.setdefault(stage, []).append(wall_s / units[stage])
+
+    coeffs = {}
+    for stage, rr in ratios.items():
+        rr.sort()
+        coeffs[stage] = rr[len(rr) // 2]
+
+    return coeffs, rss
+
+
+def peasoup_searches(ps_pd):
+    """
+    Number of peasoup runs for a beam: the DM pieces 
+    (nshards) times the segments searched (see 
+    gcpsr_search2.get_segments)
+    """
+    nshards = max(1, int(ps_pd.get("nshards", 1)))
+    sd = ps_pd.get("segments", {})
+    nsegs = set([ max(1, int(nn)) for nn in sd.get("nsegments", [1]) ])
+    return nshards * sum(nsegs)
+
+
+def plan_beam(hdr, jdict, stages, raw_hdrs=None, work_dir=None,
+              mem_gb=None, results_dir=None, peasoup_procs=1):
+    """
+    Make a plan for one beam
+
+    hdr is the header of the filtool output (or what we
+    expect it to be, see cleaned_header) with nsamples
+    filled in, raw_hdrs are the headers of the raw files
+    if we are running filtool, and stages is the list of
+    steps we will run.  peasoup_procs is the number of 
+    peasoup runs that can be on the GPUs at once, which 
+    share the memory if the search is split up.
+
+    Returns the plan (a dictionary that can go in the
+    metrics file) and a copy of jdict with any missing
+    options filled in.
+    """
+    jdict = copy.deepcopy(jdict)
+    warnings = []
+
+    nsamples = hdr["nsamples"]
+    tsamp    = hdr["tsamp"]
+    nchans   = hdr["nchans"]
+    tobs     = nsamples * tsamp
+    fil_gb   = data_bytes(hdr) / 1024.**3
+    raw_gb   = 0.0
+    if raw_hdrs is not None:
+        raw_gb = sum([ data_bytes(hh) for hh in raw_hdrs ]) / 1024.**3
+
+    plan = {"nsamples" : nsamples,
+            "nchans"   : nchans,
+            "tsamp"    : tsamp,
+            "tobs"     : tobs,
+            "raw_gb"   : raw_gb,
+            "fil_gb"   : fil_gb}
+
+    units  = {}
+    mem    = {}
+
+    if "filtool" in stages:
+        units["filtool"] = raw_gb * 1024.**3
+
+    # peasoup: DM and accel trials, FFT size, and memory
+    ps_opts = jdict["peasoup"]["opts"]
+    if "peasoup" in stages or "fold" in stages:
+        dm_list = generate_dm_list(float(ps_opts.get("dm_start", 0)),
+                                   float(ps_opts.get("dm_end", 100)),
+                                   tsamp, nchans, hdr["fch1"], hdr["foff"],
+                    pulse_width=float(ps_opts.get("dm_pulse_width",
+                                                  DM_PULSE_WIDTH)),
+                    tol=float(ps_opts.get("dm_tol", DM_TOL)))
+        ndm = len(dm_list)
+
+        fft_size = ps_opts.get("fft_size")
+        if fft_size is None:
+            fft_size = prev_power_of_two(nsamples)
+            if fft_size < 0.9 * nsamples:
+                warnings.append(f"peasoup fft_size not set, so it will " +\
+                     f"use {fft_size} samples ({100.*fft_size/nsamples:.0f}% " +\
+                     f"of the data)")
+        fft_size = int(fft_size)
+
+        nacc = num_accel_trials(float(ps_opts.get("acc_start", 0)),
+                                float(ps_opts.get("acc_end", 0)),
+                                tobs, tsamp,
+                    pulse_width=float(ps_opts.get("acc_pulse_width",
+                                                  ACC_PULSE_WIDTH)),
+                    tol=float(ps_opts.get("acc_tol", ACC_TOL)))
+
+        plan["ndm"]      = ndm
+        plan["fft_size"] = fft_size
+        plan["nacc"]     = nacc
+
+        # peasoup holds the data plus as many 8 bit
+        # dedispersed time series as fit in ram_limit_gb.  
+        # A split up search has nproc of them at once, so 
+        # each gets its share of the memory.
+        nproc = max(1, min(int(peasoup_procs), 
+                           peasoup_searches(jdict["peasoup"])))
+        plan["peasoup_procs"] = nproc
+        dd_gb = ndm * nsamples / 1024.**3
+        ps_mem = fil_gb + dd_gb
+        if mem_gb is not None and "peasoup" in stages:
+            ram_limit = max(1.0, MEM_FRAC * mem_gb / nproc - fil_gb)
+            if ps_opts.get("ram_limit_gb") is None:
+                ps_opts["ram_limit_gb"] = round(ram_limit, 1)
+                print(f"PLAN: setting peasoup ram_limit_gb = {ram_limit:.1f}")
+            elif float(ps_opts["ram_limit_gb"]) > ram_limit:
+                warnings.append(f"peasoup ram_limit_gb = " +\
+                     f"{ps_opts['ram_limit_gb']} but we only have " +\
+                     f"{mem_gb:.1f} GB for {nproc} run(s), lowering " +\
+                     f"it to {ram_limit:.1f}")
+                ps_opts["ram_limit_gb"] = round(ram_limit, 1)
+            ps_mem = fil_gb + min(dd_gb, float(ps_opts["ram_limit_gb"]))
+
+        # A segmented search does about the same work again 
+        # for each level (halves, quarters, ...)
+        sd = jdict["peasoup"].get("segments", {})
+        nlevels = len(set([ int(nn) for nn in sd.get("nsegments", [1]) ]))
+
+        if "peasoup" in stages:
+            units["peasoup"] = float(ndm) * nacc * fft_size * max(1, nlevels)
+            mem["peasoup"] = nproc * ps_mem
+
+        if "fold" in stages:
+            ncands = int(ps_opts.get("limit", 1000))
+            units["fold"] = float(ncands) * nsamples * nchans
+
+    # TransientX: one pass over the data per DM trial
+    if "tx_sp_search" in stages:
+        tx_opts = jdict["tx_sp_search"]["opts"]
+        units["tx_sp_search"] = float(tx_opts.get("ndm", 1)) * \
+                                nsamples * nchans
+    if "tx_sp_filter" in stages:
+        units["tx_sp_filter"] = float(nsamples) * nchans
+
+    plan["units"] = units
+
+    # Scratch disk: raw data + filtool output (everything
+    # else is small in comparison)
+    disk_gb = fil_gb
+    if "filtool" in stages:
+        disk_gb += raw_gb
+    plan["disk_gb"] = disk_gb
+    if work_dir is not None and os.path.exists(work_dir):
+        free_gb = shutil.disk_usage(work_dir).free / 1024.**3
+        plan["free_gb"] = free_gb
+        if disk_gb > free_gb:
+            warnings.append(f"need about {disk_gb:.1f} GB of scratch " +\
+                            f"but only {free_gb:.1f} GB free in {work_dir}")
+
+    # Memory and run time from the past beams
+    coeffs, rss = {}, {}
+    if results_dir is not None:
+        coeffs, rss = fit_cost_model(results_dir)
+
+    for stage in units:
+        mem[stage] = max(mem.get(stage, 0.0), rss.get(stage, 0.0))
+    plan["mem_gb"] = mem
+
+    if mem_gb is not None:
+        for stage, sgb in mem.items():
+            if sgb > mem_gb:
+                warnings.append(f"{stage} may need {sgb:.1f} GB of " +\
+                                f"memory but we only have {mem_gb:.1f} GB")
+
+    runtime = {}
+    for stage, nunits in units.items():
+        if stage in coeffs:
+            runtime[stage] = coeffs[stage] * nunits / 60.
+    plan["runtime_min"] = runtime
+
+    walltime = jdict.get("planner", {}).get("walltime_min")
+    if walltime is not None and len(runtime):
+        # The two branches after filtool run side by side
+        est = runtime.get("filtool", 0.0) + \
+              max(runtime.get("peasoup", 0.0) + runtime.get("fold", 0.0),
+                  runtime.get("tx_sp_search", 0.0) +
+                  runtime.get("tx_sp_filter", 0.0))
+        plan["est_min"] = est
+        if est > float(walltime):
+            warnings.append(f"estimated run time {est:.1f} min is " +\
+                            f"longer than walltime_min = {walltime}")
+
+    plan["warnings"] = warnings
+
+    return plan, jdict
+
+
+def print_plan(beamname, plan):
+    """
+    Print a summary of the plan
+    """
+    print("\n\n========== PLAN %s ===========" %beamname)
+    print(" nsamples x nchans = %d x %d" %(plan["nsamples"], plan["nchans"]))
+    print(" tsamp = %.2f us, tobs = %.1f s" %(plan["tsamp"] * 1e6,
+                                               plan["tobs"]))
+    if "ndm" in plan:
+        print(" peasoup: %d DMs x %d accels, fft_size = %d" \
+              %(plan["ndm"], plan["nacc"], plan["fft_size"]))
+    print(" scratch disk: %.1f GB" %plan["disk_gb"])
+    for stage, sgb in plan["mem_gb"].items():
+        tstr = ""
+        if stage in plan["runtime_min"]:
+            tstr = ", %.1f min" %plan["runtime_min"][stage]
+        print(" %-13s %.1f GB%s" %(stage + ":", sgb, tstr))
+    for wstr in plan["warnings"]:
+        print(" WARNING: %s" %wstr)
+    print("====================================\n\n")
+    return
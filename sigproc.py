@@ -0,0 +1,289 @@
+"""
+A small reader for SIGPROC filterbank files
+
+    fil = FilFile("cfbf00002_01.fil")
+    fil.header, fil.nsamples, fil.freqs
+    fil.data                    # (nsamples, nchans) np.memmap
+    for start, block in fil.blocks(65536):
+        ...
+
+plus the pre-flight checks used by gcpsr_search2.py to
+make sure the data look sane before we start copying
+them around and running things on them, and write_chunk
+to cut out a piece of a file in time.
+"""
+import os
+import struct
+import numpy as np
+
+
+# Header keys by type
+INT_KEYS = ["machine_id", "telescope_id", "data_type", "nchans",
+            "nbits", "nifs", "nbeams", "ibeam", "nsamples",
+            "barycentric", "pulsarcentric"]
+DBL_KEYS = ["tstart", "tsamp", "fch1", "foff", "refdm", "az_start",
+            "za_start", "src_raj", "src_dej", "period"]
+STR_KEYS = ["source_name", "rawdatafile"]
+CHR_KEYS = ["signed"]
+
+# numpy types for the sample sizes we can map directly
+NBITS_DTYPES = {8 : np.uint8, 16 : np.uint16, 32 : np.float32}
+
+
+def read_header(filfile):
+    """
+    Read the header of a SIGPROC filterbank file
+
+    Returns a dictionary of header parameters and the
+    size of the header in bytes.  Raises a ValueError
+    if the header is not valid.
+    """
+    hdr = {}
+    with open(filfile, 'rb') as fin:
+        def read_bytes(nn):
+            buf = fin.read(nn)
+            if len(buf) != nn:
+                raise ValueError("Header ends early")
+            return buf
+
+        def read_string():
+            nn = struct.unpack('i', read_bytes(4))[0]
+            if nn < 1 or nn > 80:
+                raise ValueError(f"Bad header string length {nn}")
+            return read_bytes(nn).decode(errors='replace')
+
+        if read_string() != "HEADER_START":
+            raise ValueError("No HEADER_START")
+
+        while True:
+            key = read_string()
+            if key == "HEADER_END":
+                break
+            elif key in INT_KEYS:
+                hdr[key] = struct.unpack('i', read_bytes(4))[0]
+            elif key in DBL_KEYS:
+                hdr[key] = struct.unpack('d', read_bytes(8))[0]
+            elif key in STR_KEYS:
+                hdr[key] = read_string()
+            elif key in CHR_KEYS:
+                hdr[key] = struct.unpack('b', read_bytes(1))[0]
+            else:
+                raise ValueError(f"Unknown header key {key}")
+
+        hdr_size = fin.tell()
+
+    return hdr, hdr_size
+
+
+def write_header(hdr, fout):
+    """
+    Write a header dictionary (as from read_header) to 
+    the open file fout
+    """
+    def write_string(val):
+        val = val.encode()
+        fout.write(struct.pack('i', len(val)))
+        fout.write(val)
+
+    write_string("HEADER_START")
+    for key, val in hdr.items():
+        if key in INT_KEYS:
+            write_string(key)
+            fout.write(struct.pack('i', int(val)))
+        elif key in DBL_KEYS:
+            write_string(key)
+            fout.write(struct.pack('d', float(val)))
+        elif key in STR_KEYS:
+            write_string(key)
+            write_string(val)
+        elif key in CHR_KEYS:
+            write_string(key)
+            fout.write(struct.pack('b', int(val)))
+        else:
+            raise ValueError(f"Unknown header key {key}")
+    write_string("HEADER_END")
+    return
+
+
+class FilFile:
+    """
+    A filterbank file, with the data available as a
+    (nsamples, nifs * nchans) memory map (no copy is
+    made until you index it).  Data with fewer than 8
+    bits per sample are mapped as packed bytes, use
+    blocks() to get them unpacked.
+    """
+    def __init__(self, filfile):
+        self.filename = filfile
+        self.header, self.hdr_size = read_header(filfile)
+
+        self.nchans = self.header.get("nchans", 0)
+        self.nbits  = self.header.get("nbits", 0)
+        self.nifs   = self.header.get("nifs", 1)
+        self.tsamp  = self.header.get("tsamp", 0.0)
+        self.fch1   = self.header.get("fch1", 0.0)
+        self.foff   = self.header.get("foff", 0.0)
+        if self.nchans <= 0 or self.nbits <= 0:
+            raise ValueError(f"Bad nchans = {self.nchans} or " +\
+                             f"nbits = {self.nbits}")
+
+        self.bytes_per_samp = self.nchans * self.nifs * self.nbits / 8.
+        self.nbytes = os.path.getsize(filfile) - self.hdr_size
+
+        # Use the header value if there is one, but
+        # check_file will complain if they do not agree
+        self.nsamples = self.header.get("nsamples", 0)
+        if self.nsamples <= 0:
+            self.nsamples = int(self.nbytes // self.bytes_per_samp)
+        self.tobs = self.nsamples * self.tsamp
+
+        self._data = None
+
+    @property
+    def freqs(self):
+        return self.fch1 + self.foff * np.arange(self.nchans)
+
+    @property
+    def data(self):
+        if self._data is None:
+            dtype = NBITS_DTYPES.get(self.nbits, np.uint8)
+            nwide = self.nchans * self.nifs
+            if self.nbits < 8:
+                nwide = int(nwide * self.nbits // 8)
+            self._data = np.memmap(self.filename, dtype=dtype, mode='r',
+                                   offset=self.hdr_size,
+                                   shape=(self.nsamples, nwide))
+        return self._data
+
+    def unpack(self, block):
+        """
+        Unpack 1, 2, or 4 bit samples (lowest bits first)
+        to uint8.  Other sample sizes are returned as is.
+        """
+        if self.nbits >= 8:
+            return block
+        nper = 8 // self.nbits
+        mask = (1 << self.nbits) - 1
+        shifts = np.arange(nper, dtype=np.uint8) * self.nbits
+        out = (block[..., None] >> shifts) & mask
+        return out.reshape(block.shape[0], -1).astype(np.uint8)
+
+    def blocks(self, nsamps, overlap=0, start=0, stop=None):
+        """
+        Iterate over the data in time, nsamps samples at a
+        time (plus overlap samples from the next block).
+        Yields (start sample, block).  Only the samples in
+        the current block are read from disk.
+        """
+        if stop is None or stop > self.nsamples:
+            stop = self.nsamples
+        if nsamps <= 0:
+            raise ValueError(f"Bad block size {nsamps}")
+
+        data = self.data
+        for ii in range(start, stop, nsamps):
+            jj = min(ii + nsamps + overlap, stop)
+            yield ii, self.unpack(np.asarray(data[ii:jj]))
+
+
+def check_file(filfile):
+    """
+    Make sure a filterbank file exists, has a valid header,
+    and has a size that matches the header.  Returns a
+    description of the problem, or None if it looks ok.
+    """
+    if not os.path.exists(filfile):
+        return f"{filfile} not found"
+
+    try:
+        hdr, hdr_size = read_header(filfile)
+    except (ValueError, struct.error) as err:
+        return f"{filfile} has a bad header: {err}"
+
+    for key in ["nchans", "nbits", "tsamp"]:
+        if hdr.get(key, 0) <= 0:
+            return f"{filfile} has bad {key} = {hdr.get(key)}"
+
+    if hdr["nbits"] not in [1, 2, 4, 8, 16, 32]:
+        return f"{filfile} has bad nbits = {hdr['nbits']}"
+
+    if hdr.get("foff", 0.0) == 0.0 or hdr.get("fch1", 0.0) <= 0.0:
+        return f"{filfile} has bad fch1 = {hdr.get('fch1')} or " +\
+               f"foff = {hdr.get('foff')}"
+
+    nbytes = os.path.getsize(filfile) - hdr_size
+    bytes_per_samp = hdr["nchans"] * hdr.get("nifs", 1) * hdr["nbits"] / 8.
+
+    if nbytes <= 0:
+        return f"{filfile} has no data"
+
+    if hdr.get("nsamples", 0) > 0:
+        if nbytes != hdr["nsamples"] * bytes_per_samp:
+            return f"{filfile} has {nbytes} bytes of data, but " +\
+                   f"nsamples = {hdr['nsamples']} needs " +\
+                   f"{int(hdr['nsamples'] * bytes_per_samp)}"
+    elif nbytes % bytes_per_samp:
+        return f"{filfile} data size {nbytes} is not a whole " +\
+               f"number of samples ({bytes_per_samp} bytes)"
+
+    return None
+
+
+def check_inputs(filfiles, rtol=1e-9):
+    """
+    Pre-flight checks for a set of files that will be
+    combined (eg, the *_{beam}_*fil inputs to filtool):
+    each file has to pass check_file, and they all need
+    the same sample time and channel layout.
+
+    Returns a list of problems (empty if all is well)
+    """
+    problems = []
+    hdrs = []
+    for ff in filfiles:
+        prob = check_file(ff)
+        if prob is not None:
+            problems.append(prob)
+        else:
+            hdrs.append( (ff, read_header(ff)[0]) )
+
+    if len(hdrs) < 2:
+        return problems
+
+    ff0, hdr0 = hdrs[0]
+    for ff, hdr in hdrs[1:]:
+        for key in ["nchans", "nbits", "nifs"]:
+            if hdr.get(key, 1) != hdr0.get(key, 1):
+                problems.append(f"{ff} has {key} = {hdr.get(key, 1)} " +\
+                                f"but {ff0} has {hdr0.get(key, 1)}")
+        for key in ["tsamp", "fch1", "foff"]:
+            if not np.isclose(hdr[key], hdr0[key], rtol=rtol, atol=0):
+                problems.append(f"{ff} has {key} = {hdr[key]} " +\
+                                f"but {ff0} has {hdr0[key]}")
+
+    return problems
+
+
+def write_chunk(filfile, outfile, start, nsamps, block_size=65536):
+    """
+    Write samples start to start + nsamps of filfile to a 
+    new file outfile, with tstart (and nsamples, if it is 
+    in the header) updated to match
+    """
+    fil = FilFile(filfile)
+    stop = min(start + nsamps, fil.nsamples)
+
+    hdr = dict(fil.header)
+    if "tstart" in hdr:
+        hdr["tstart"] += start * fil.tsamp / 86400.
+    if "nsamples" in hdr:
+        hdr["nsamples"] = stop - start
+
+    with open(outfile, 'wb') as fout:
+        write_header(hdr, fout)
+        data = fil.data
+        for ii in range(start, stop, block_size):
+            jj = min(ii + block_size, stop)
+            fout.write(np.asarray(data[ii:jj]).tobytes())
+
+    return stop - start
@@ -0,0 +1,545 @@
+"""
+Helpers for moving data between the shared filesystem
+and the compute node (used by gcpsr_search2.py)
+
+Copies are done a few files at a time with a large
+buffer, since a single stream only gets a fraction of
+the bandwidth of the parallel filesystem.  The md5 sum
+of each file is computed from the same buffers as they
+are written, so we get checksums without reading the
+data a second time.
+
+Optionally, files can be kept in a cache directory on 
+the node (ArtifactCache) so that rerunning beams on the 
+same node skips the shared filesystem.
+"""
+import os
+import time
+import json
+import fcntl
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Size of read/write buffer
+COPY_BUFSIZE = 16 * 1024 * 1024
+
+# Default number of files to copy at once
+COPY_THREADS = 4
+
+# Default limit on data prefetched to the work dir (GB)
+PREFETCH_GB = 100.0
+
+# Default size limit of the node-local cache (GB)
+CACHE_GB = 200.0
+
+
+def get_copy_threads(jdict):
+    """
+    Get the number of files to copy at once from the
+    (optional) "staging" block of the JSON args
+    """
+    sd = jdict.get("staging", {})
+    return int(sd.get("copy_threads", COPY_THREADS))
+
+
+def get_prefetch_bytes(jdict):
+    """
+    Get the limit on the amount of data prefetched to
+    the work directory from the (optional) "staging" block
+    of the JSON args.  A limit of 0 turns off prefetching.
+    """
+    sd = jdict.get("staging", {})
+    return float(sd.get("prefetch_gb", PREFETCH_GB)) * 1024**3
+
+
+def get_cache(jdict):
+    """
+    Get the node-local ArtifactCache from the (optional) 
+    "staging" block of the JSON args, or None if no 
+    cache_dir is given
+    """
+    sd = jdict.get("staging", {})
+    cache_dir = sd.get("cache_dir")
+    if not cache_dir:
+        return None
+    cache_gb = float(sd.get("cache_gb", CACHE_GB))
+    return ArtifactCache(cache_dir, cache_gb * 1024**3)
+
+
+def file_md5(fpath, bufsize=COPY_BUFSIZE):
+    """
+    md5 hex digest of a file
+    """
+    md5 = hashlib.md5()
+    buf = bytearray(bufsize)
+    mv = memoryview(buf)
+    with open(fpath, 'rb') as fin:
+        while True:
+            nread = fin.readinto(buf)
+            if not nread:
+                break
+            md5.update(mv[:nread])
+    return md5.hexdigest()
+
+
+def copy_file(src, dst, bufsize=COPY_BUFSIZE):
+    """
+    Copy src to dst (a file name or a directory) and
+    compute the md5 sum of the data along the way
+
+    Returns the md5 hex digest, the number of bytes,
+    and the time it took
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    t_start = time.time()
+
+    md5 = hashlib.md5()
+    nbytes = 0
+    buf = bytearray(bufsize)
+    mv = memoryview(buf)
+
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        while True:
+            nread = fin.readinto(buf)
+            if not nread:
+                break
+            md5.update(mv[:nread])
+            fout.write(mv[:nread])
+            nbytes += nread
+
+    shutil.copymode(src, dst)
+
+    dt = time.time() - t_start
+
+    return md5.hexdigest(), nbytes, dt
+
+
+def tree_pairs(src_dir, dst_dir):
+    """
+    Get (src, dst) pairs for every file under src_dir,
+    making the matching directories under dst_dir
+    """
+    pairs = []
+    for dpath, dnames, fnames in os.walk(src_dir):
+        rel_dir = os.path.relpath(dpath, src_dir)
+        out_dir = os.path.normpath(os.path.join(dst_dir, rel_dir))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        for fname in fnames:
+            pairs.append( (os.path.join(dpath, fname),
+                           os.path.join(out_dir, fname)) )
+    return pairs
+
+
+def copy_files(pairs, nthreads=COPY_THREADS, label="", cache=None):
+    """
+    Copy a list of (src, dst) pairs, up to nthreads at once
+
+    Prints the throughput of each file and the total, and
+    returns a dictionary of {dst : md5}.  If any copy
+    fails, the error is raised once all the copies
+    in flight are done.
+
+    If cache (an ArtifactCache) is given, the files are 
+    staged through it
+    """
+    checksums = {}
+    if len(pairs) == 0:
+        return checksums
+
+    nthreads = max(1, min(nthreads, len(pairs)))
+
+    t_start = time.time()
+    tot_bytes = 0
+
+    copy_func = copy_file if cache is None else cache.stage_file
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        futures = [ pool.submit(copy_func, src, dst)
+                    for src, dst in pairs ]
+        for (src, dst), ff in zip(pairs, futures):
+            md5, nbytes, dt = ff.result()
+            if os.path.isdir(dst):
+                dst = os.path.join(dst, os.path.basename(src))
+            checksums[dst] = md5
+            tot_bytes += nbytes
+            rate = nbytes / max(dt, 1e-6) / 1024**2
+            print(f"{label} {os.path.basename(src)}: " +\
+                  f"{nbytes/1024**2:.1f} MB in {dt:.1f} s " +\
+                  f"({rate:.1f} MB/s) md5={md5}")
+
+    dt_tot = time.time() - t_start
+    rate_tot = tot_bytes / max(dt_tot, 1e-6) / 1024**2
+    print(f"{label} copied {len(pairs)} files, " +\
+          f"{tot_bytes/1024**2:.1f} MB in {dt_tot:.1f} s " +\
+          f"({rate_tot:.1f} MB/s)\n")
+
+    return checksums
+
+
+def copy_tree(src_dir, dst_dir, nthreads=COPY_THREADS, label=""):
+    """
+    Copy a directory tree with copy_files
+    """
+    pairs = tree_pairs(src_dir, dst_dir)
+    return copy_files(pairs, nthreads=nthreads, label=label)
+
+
+def update_checksums(checksums, top_dir, fname="checksums.md5"):
+    """
+    Add checksums for files under top_dir to the file
+    top_dir/fname.  The file has the same format as the
+    output of md5sum, so it can be checked with
+
+        cd top_dir; md5sum -c checksums.md5
+    """
+    cfile = os.path.join(top_dir, fname)
+
+    cdict = {}
+    if os.path.exists(cfile):
+        with open(cfile, 'r') as fin:
+            for line in fin:
+                cols = line.rstrip('\n').split('  ', 1)
+                if len(cols) == 2:
+                    cdict[cols[1]] = cols[0]
+
+    for fpath, md5 in checksums.items():
+        cdict[os.path.relpath(fpath, top_dir)] = md5
+
+    with open(f"{cfile}.tmp", 'w') as fout:
+        for rel_path in sorted(cdict.keys()):
+            fout.write(f"{cdict[rel_path]}  {rel_path}\n")
+    os.replace(f"{cfile}.tmp", cfile)
+
+    return
+
+
+class Prefetcher:
+    """
+    Copy the raw fil files for upcoming beams to the
+    work directory in the background, while the current
+    beams are being processed.
+
+    jobs is a list of (beamname, fil_files, dst_dir) in
+    the order the beams will be processed.  We only
+    prefetch while the data already prefetched (and not
+    yet released with release()) plus the next beam fits
+    under max_bytes.  If cache (an ArtifactCache) is given, 
+    the files are staged through it, and the files held 
+    only by the cache count against max_bytes too.
+
+    Before a beam copies its own files, it calls claim().
+    If the beam was already prefetched (or is being
+    prefetched) this waits for it and returns True.  If
+    the prefetch never started, the beam is dropped from
+    the queue and claim() returns False, so the beam
+    should copy the files itself.
+    """
+    def __init__(self, jobs, max_bytes, nthreads=COPY_THREADS, cache=None):
+        self.jobs      = jobs
+        self.cache     = cache
+        self.max_bytes = max_bytes
+        self.nthreads  = nthreads
+        self.state     = {}
+        self.sizes     = {}
+        self.used      = 0
+        self.stopped   = False
+        self.cond      = threading.Condition()
+        self.thread    = None
+
+        for beamname, fil_files, dst_dir in jobs:
+            self.state[beamname] = "pending"
+            self.sizes[beamname] = sum([ os.path.getsize(ff)
+                                         for ff in fil_files ])
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return
+
+    def _disk_used(self):
+        """
+        Bytes counted against max_bytes: our prefetched 
+        beams plus whatever only the cache is holding
+        """
+        if self.cache is None:
+            return self.used
+        return self.used + self.cache.unlinked_bytes()
+
+    def _run(self):
+        for beamname, fil_files, dst_dir in self.jobs:
+            nbytes = self.sizes[beamname]
+            with self.cond:
+                # Wait for room on the disk (always allow one
+                # beam, even if it is bigger than the limit).
+                # Other jobs can free up cache space, so check 
+                # again every so often.
+                while not self.stopped and \
+                      self.state[beamname] == "pending" and \
+                      self.used > 0 and \
+                      self._disk_used() + nbytes > self.max_bytes:
+                    self.cond.wait(timeout=60)
+
+                if self.stopped:
+                    return
+
+                if self.state[beamname] != "pending":
+                    continue
+
+                self.state[beamname] = "copying"
+                self.used += nbytes
+
+            print(f"PREFETCHING {beamname} " +\
+                  f"({nbytes/1024**3:.1f} GB) to {dst_dir}")
+            try:
+                if not os.path.exists(dst_dir):
+                    os.makedirs(dst_dir)
+                pairs = [ (ff, dst_dir) for ff in fil_files ]
+                copy_files(pairs, nthreads=self.nthreads,
+                           label=f"prefetch {beamname}", 
+                           cache=self.cache)
+                status = "done"
+            except Exception as err:
+                print(f"Prefetch of {beamname} failed: {err}")
+                status = "failed"
+
+            with self.cond:
+                self.state[beamname] = status
+                self.cond.notify_all()
+
+        return
+
+    def claim(self, beamname):
+        """
+        Wait for the prefetch of beamname (if it has started)
+        and return True if its files are in place
+        """
+        with self.cond:
+            if self.state.get(beamname) is None:
+                return False
+
+            if self.state[beamname] == "pending":
+                self.state[beamname] = "claimed"
+                self.cond.notify_all()
+                return False
+
+            while self.state[beamname] == "copying":
+                self.cond.wait()
+
+            return self.state[beamname] == "done"
+
+    def release(self, beamname):
+        """
+        Let the prefetcher know the files for beamname
+        have been deleted from the work directory
+        """
+        with self.cond:
+            if self.state.get(beamname) in ["done", "failed"]:
+                self.used -= self.sizes[beamname]
+                self.state[beamname] = "released"
+                self.cond.notify_all()
+        return
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        return
+
+
+class ArtifactCache:
+    """
+    A cache of files from the shared filesystem (sif 
+    images and fil files) in a directory on the compute 
+    node, so that rerunning beams on the same node does 
+    not have to read them again.
+
+    Files are stored as cache_dir/objects/<key> and 
+    described in cache_dir/index.json:
+
+        key : {"src", "size", "mtime", "md5", "last_used"}
+
+    An entry is only used if the size and mtime of the 
+    source still match.  When the cache is over max_bytes, 
+    the least recently used files are removed.  The index 
+    is protected by a lock file, so several jobs on the 
+    same node can share the cache.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.obj_dir   = os.path.join(cache_dir, "objects")
+        self.index     = os.path.join(cache_dir, "index.json")
+        self.lock_file = os.path.join(cache_dir, ".lock")
+        self.max_bytes = max_bytes
+        self.tlock     = threading.Lock()
+        self.verified  = set()
+
+        if not os.path.exists(self.obj_dir):
+            os.makedirs(self.obj_dir, exist_ok=True)
+
+    def _locked(self, func, *args):
+        """
+        Run func(idx, *args) with the index locked, where 
+        idx is the index dict.  The index is written back 
+        afterwards.
+        """
+        with self.tlock, open(self.lock_file, 'a') as flock:
+            fcntl.flock(flock, fcntl.LOCK_EX)
+            try:
+                idx = {}
+                if os.path.exists(self.index):
+                    try:
+                        with open(self.index, 'r') as fin:
+                            idx = json.load(fin)
+                    except ValueError:
+                        print(f"Bad cache index {self.index}, starting over")
+                retval = func(idx, *args)
+                with open(f"{self.index}.tmp", 'w') as fout:
+                    json.dump(idx, fout, indent=4)
+                os.replace(f"{self.index}.tmp", self.index)
+            finally:
+                fcntl.flock(flock, fcntl.LOCK_UN)
+        return retval
+
+    def key(self, src):
+        src = os.path.abspath(src)
+        hstr = hashlib.sha256(src.encode()).hexdigest()[:16]
+        return f"{hstr}_{os.path.basename(src)}"
+
+    def _lookup(self, idx, key, src, sstat):
+        """
+        Return the entry for key if it is still good
+        """
+        ent = idx.get(key)
+        obj = os.path.join(self.obj_dir, key)
+        if ent is None or not os.path.exists(obj):
+            idx.pop(key, None)
+            return None
+        if ent["size"] != sstat.st_size or \
+           ent["mtime"] != int(sstat.st_mtime) or \
+           os.path.getsize(obj) != ent["size"]:
+            return None
+        ent["last_used"] = time.time()
+        return dict(ent)
+
+    def unlinked_bytes(self):
+        """
+        Size of the cached files that are not hard linked 
+        anywhere else, ie, the disk space only the cache 
+        is using
+        """
+        nbytes = 0
+        for entry in os.scandir(self.obj_dir):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if st.st_nlink == 1:
+                nbytes += st.st_size
+        return nbytes
+
+    def _add(self, idx, key, ent):
+        """
+        Add an entry and remove the least recently 
+        used files until we are under max_bytes.  Files 
+        that are still linked into a work directory are 
+        left alone, since removing them frees nothing.
+        """
+        idx[key] = ent
+        used = sum([ ee["size"] for ee in idx.values() ])
+        for kk in sorted(idx, key=lambda kk: idx[kk]["last_used"]):
+            if used <= self.max_bytes:
+                break
+            if kk == key:
+                continue
+            obj = os.path.join(self.obj_dir, kk)
+            if os.path.exists(obj):
+                if os.stat(obj).st_nlink > 1:
+                    continue
+                os.remove(obj)
+            print(f"CACHE: removing {idx[kk]['src']}")
+            used -= idx.pop(kk)["size"]
+        if used > self.max_bytes:
+            print(f"CACHE: {used/1024**3:.1f} GB in use, over the " +\
+                  f"{self.max_bytes/1024**3:.1f} GB limit (files in use)")
+        return
+
+    def fetch(self, src, verify=False):
+        """
+        Get the cached copy of src, copying it into the 
+        cache if needed.  Returns (path, md5).  If src is 
+        too big to cache, returns (None, None).
+
+        If verify is True, the md5 of the cached file is 
+        checked against the index (once per process).
+        """
+        sstat = os.stat(src)
+        key = self.key(src)
+        obj = os.path.join(self.obj_dir, key)
+
+        ent = self._locked(self._lookup, key, src, sstat)
+        if ent is not None and verify and key not in self.verified:
+            if file_md5(obj) != ent["md5"]:
+                print(f"CACHE: bad checksum for {obj}")
+                ent = None
+            else:
+                self.verified.add(key)
+
+        if ent is not None:
+            print(f"CACHE: using {obj} for {src}")
+            return obj, ent["md5"]
+
+        if sstat.st_size > self.max_bytes:
+            return None, None
+
+        # Copy to a temporary name so other threads/jobs 
+        # never see a partial file
+        tmp = f"{obj}.{os.getpid()}.{threading.get_ident()}.tmp"
+        md5, nbytes, dt = copy_file(src, tmp)
+        os.replace(tmp, obj)
+        rate = nbytes / max(dt, 1e-6) / 1024**2
+        print(f"CACHE: added {src} ({nbytes/1024**2:.1f} MB " +\
+              f"at {rate:.1f} MB/s)")
+        if verify:
+            self.verified.add(key)
+
+        ent = {"src"       : os.path.abspath(src), 
+               "size"      : sstat.st_size, 
+               "mtime"     : int(sstat.st_mtime), 
+               "md5"       : md5, 
+               "last_used" : time.time()}
+        self._locked(self._add, key, ent)
+
+        return obj, md5
+
+    def stage_file(self, src, dst):
+        """
+        Put src at dst (a file name or a directory) by way 
+        of the cache.  We hard link from the cache if we can 
+        and copy otherwise.  Returns (md5, nbytes, dt) like 
+        copy_file.
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+
+        t_start = time.time()
+        obj, md5 = self.fetch(src)
+        if obj is None:
+            return copy_file(src, dst)
+
+        if os.path.exists(dst):
+            os.remove(dst)
+        try:
+            os.link(obj, dst)
+        except OSError:
+            shutil.copyfile(obj, dst)
+            shutil.copymode(obj, dst)
+
+        return md5, os.path.getsize(dst), time.time() - t_start
@@ -0,0 +1,507 @@
+import os
+import re
+import sys
+import math
+import json
+import subprocess as sp
+from glob import glob
+from datetime import datetime
+from argparse import ArgumentParser
+
+from gcpsr_search2 import read_and_check_json, format_name, \
+                          parse_beam_list
+
+
+SLURM_TEMPLATE = """#!/bin/bash -l
+# NOTE the -l flag!
+#
+# Generated by submit_campaign.py on {date}
+#
+#SBATCH -J {job_name}
+#SBATCH -o {log_dir}/{job_name}_%A_%a.output
+#SBATCH -e {log_dir}/{job_name}_%A_%a.output
+#SBATCH -D ./
+
+#SBATCH -p {partition}
+#SBATCH --gres=gpu:{ngpus}
+
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task={cpus}
+
+#SBATCH -t {walltime}
+#SBATCH --mem={mem_mb}
+
+#SBATCH --array=0-{last_task}%{max_tasks}
+
+{setup_cmds}
+
+# Each line of the beam file is the list of
+# beams for one array task
+BEAMS=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {beam_file})
+
+echo $TMPDIR
+echo $SLURM_ARRAY_JOB_ID $SLURM_ARRAY_TASK_ID
+echo $HOSTNAME
+echo "Beams: $BEAMS"
+echo ""
+
+python -u {src_dir}/gcpsr_search2.py --work_dir $TMPDIR \\
+    --args_json {args_json} --beams $BEAMS \\
+    --beam_slots {beam_slots} --ngpus {ngpus} --ncpus {cpus}
+
+echo "ls ${{TMPDIR}}"
+ls $TMPDIR
+"""
+
+
+def read_beam_file(beam_file):
+    """
+    Read beams from a file.  Each line can be anything
+    parse_beam_list understands (eg, "12" or "2,3,7-12"),
+    and anything after a '#' is ignored
+    """
+    beams = []
+    with open(beam_file, 'r') as fin:
+        for line in fin:
+            line = line.split('#')[0].strip()
+            if line:
+                beams += parse_beam_list(line)
+    return sorted(set(beams))
+
+
+def beam_finished(results_dir, beamname):
+    """
+    Check if the most recent log file for a beam
+    says that it finished
+    """
+    log_files = glob(f"{results_dir}/{beamname}/{beamname}_*.log")
+    if len(log_files) == 0:
+        return False
+
+    log_files.sort()
+    with open(log_files[-1], 'r') as fin:
+        for line in fin:
+            if line.startswith("Status:"):
+                return line.split()[1] == "COMPLETE"
+
+    return False
+
+
+def read_log_times(log_file):
+    """
+    Get the step and total run times (in min)
+    from a log file written by gcpsr_search2.py.
+    Returns None if the beam did not finish.
+    """
+    tdict = {}
+    status = None
+
+    name_map = {"filtool"      : "filtool",
+                "peasoup"      : "peasoup",
+                "fold"         : "fold",
+                "single pulse" : "sp"}
+
+    with open(log_file, 'r') as fin:
+        for line in fin:
+            if line.startswith("Status:"):
+                status = line.split()[1]
+                continue
+
+            mm = re.match(r"Total Runtime = ([\d\.]+) min", line)
+            if mm:
+                tdict["total"] = float(mm.group(1))
+                continue
+
+            for lname, tname in name_map.items():
+                mm = re.match(rf"{lname}\s+([\d\.]+)\s*$", line)
+                if mm:
+                    tdict[tname] = float(mm.group(1))
+
+    if status != "COMPLETE" or tdict.get("total") is None:
+        return None
+
+    return tdict
+
+
+def read_metrics_times(metrics_file):
+    """
+    Get the step and total run times (in min), the peak 
+    memory (in GB), and the peak number of CPUs kept busy 
+    (CPU time over wall time of each step) from the metrics 
+    (.jsonl) file written by gcpsr_search2.py.  Returns 
+    None if the beam did not finish.
+
+    The peaks allow for the two branches of the graph 
+    running at once (filtool alone, then peasoup or fold 
+    alongside the single pulse steps).
+    """
+    tdict = {}
+    rss = {}
+    cores = {}
+    status = None
+
+    with open(metrics_file, 'r') as fin:
+        for line in fin:
+            rec = json.loads(line)
+            stage = rec["stage"]
+            if stage == "total":
+                status = rec.get("status")
+                tdict["total"] = rec["wall_s"] / 60.
+                continue
+            if rec.get("parent") is not None:
+                continue
+            if stage in ["filtool", "peasoup", "fold"]:
+                tdict[stage] = rec["wall_s"] / 60.
+            if stage in ["tx_sp_search", "tx_sp_filter"]:
+                tdict["sp"] = tdict.get("sp", 0.0) + rec["wall_s"] / 60.
+            rss[stage] = max(rss.get(stage, 0.0), rec.get("maxrss_mb", 0.0))
+            cpu_s = rec.get("utime_s", 0.0) + rec.get("stime_s", 0.0)
+            if rec["wall_s"] > 0:
+                cores[stage] = max(cores.get(stage, 0.0), 
+                                   cpu_s / rec["wall_s"])
+
+    if status != "COMPLETE" or tdict.get("total") is None:
+        return None
+
+    peak_mb = max(rss.get("filtool", 0.0),
+                  max(rss.get("peasoup", 0.0), rss.get("fold", 0.0)) +\
+                  max(rss.get("tx_sp_search", 0.0),
+                      rss.get("tx_sp_filter", 0.0)))
+    tdict["peak_rss_gb"] = peak_mb / 1024.
+
+    tdict["peak_cpus"] = max(cores.get("filtool", 0.0),
+                  max(cores.get("peasoup", 0.0), cores.get("fold", 0.0)) +\
+                  max(cores.get("tx_sp_search", 0.0),
+                      cores.get("tx_sp_filter", 0.0)))
+
+    return tdict
+
+
+def get_measured_times(results_dir, max_logs=500):
+    """
+    Collect the run times from the logs of finished
+    beams under results_dir.  If there is a metrics file
+    (.jsonl) next to the log we use that instead, since
+    it also has the memory use.  Returns a list of dicts
+    (see read_log_times and read_metrics_times)
+    """
+    log_files = glob(f"{results_dir}/cfbf*/cfbf*_*.log")
+    log_files.sort(key=os.path.getmtime, reverse=True)
+
+    times = []
+    for log_file in log_files[:max_logs]:
+        metrics_file = log_file.rsplit('.log', 1)[0] + ".jsonl"
+        if os.path.exists(metrics_file):
+            tdict = read_metrics_times(metrics_file)
+        else:
+            tdict = read_log_times(log_file)
+        if tdict is not None:
+            times.append(tdict)
+
+    return times
+
+
+def estimate_beam_mem_gb(times, default_gb=30.0, margin=1.3, pct=90.0):
+    """
+    Estimate the memory needed per beam in flight from the
+    measured peak memory (padded by margin)
+    """
+    peaks = [ tt["peak_rss_gb"] for tt in times if "peak_rss_gb" in tt ]
+    if len(peaks) == 0:
+        print(f"No measured memory use, using {default_gb:.1f} GB/beam")
+        return default_gb
+
+    peak = percentile(peaks, pct)
+    print(f"  peak memory      = {peak:.1f} GB ({len(peaks)} beams)")
+    return max(1.0, peak * margin)
+
+
+def estimate_task_cpus(times, nslots, default_cpus=24, margin=1.2, 
+                       pct=90.0):
+    """
+    Estimate the CPUs for a task with nslots beams in flight 
+    from the measured peak CPU use per beam (padded by margin)
+    """
+    peaks = [ tt["peak_cpus"] for tt in times if tt.get("peak_cpus") ]
+    if len(peaks) == 0:
+        print(f"No measured CPU use, using {default_cpus} CPUs/task")
+        return default_cpus
+
+    peak = percentile(peaks, pct)
+    print(f"  peak CPUs        = {peak:.1f} ({len(peaks)} beams)")
+    return max(1, int(math.ceil(nslots * peak * margin)))
+
+
+def percentile(vals, pct):
+    """
+    Simple percentile (nearest rank) so we do not need numpy
+    """
+    vals = sorted(vals)
+    idx = int(math.ceil(pct / 100.0 * len(vals))) - 1
+    return vals[max(0, min(idx, len(vals) - 1))]
+
+
+def estimate_task_minutes(times, beams_per_task, beam_slots, ngpus,
+                          default_min=90.0, pct=90.0):
+    """
+    Estimate the run time of one array task from the
+    measured per-beam times
+
+    With beam_slots beams in flight, the task takes about
+    beams_per_task / beam_slots beam run times, but it can
+    not be faster than running all the peasoup searches
+    one after the other on ngpus GPUs.
+    """
+    if len(times) == 0:
+        print(f"No finished beams found, using {default_min:.0f} min/beam")
+        t_beam = default_min
+        t_ps   = 0.0
+    else:
+        t_beam = percentile([ tt["total"] for tt in times ], pct)
+        t_ps   = percentile([ tt.get("peasoup", 0.0) for tt in times ], pct)
+        print(f"Measured from {len(times)} finished beams " +\
+              f"({pct:.0f}th percentile):")
+        print(f"  beam run time    = {t_beam:.1f} min")
+        print(f"  peasoup run time = {t_ps:.1f} min")
+
+    nslots = max(1, min(beam_slots, beams_per_task))
+    t_cpu = math.ceil(beams_per_task / nslots) * t_beam
+    t_gpu = beams_per_task * t_ps / max(1, ngpus) + t_beam
+
+    return max(t_cpu, t_gpu)
+
+
+def format_walltime(minutes):
+    """
+    Convert minutes to a slurm H:M:S string
+    """
+    minutes = int(math.ceil(minutes))
+    return f"{minutes // 60}:{minutes % 60:02d}:00"
+
+
+def pack_beams(beam_list, beams_per_task):
+    """
+    Split beam_list into groups of beams_per_task
+    """
+    return [ beam_list[ii : ii + beams_per_task]
+             for ii in range(0, len(beam_list), beams_per_task) ]
+
+
+def write_beam_file(groups, beam_file):
+    """
+    Write one comma separated beam group per line
+    """
+    with open(beam_file, 'w') as fout:
+        for group in groups:
+            fout.write(",".join([ f"{bb}" for bb in group ]) + "\n")
+    return
+
+
+def submit_script(script_file, sbatch_cmd="sbatch"):
+    """
+    Submit script_file with sbatch_cmd and return the job
+    id (or None if we could not find it in the output)
+    """
+    print(f"\n{sbatch_cmd} {script_file}\n")
+    ret = sp.run([sbatch_cmd, script_file], stdout=sp.PIPE,
+                 stderr=sp.PIPE, text=True)
+    print(ret.stdout)
+    if ret.returncode != 0:
+        print(ret.stderr)
+        print(f"{sbatch_cmd} failed with exit status {ret.returncode}")
+        return None
+
+    mm = re.search(r"Submitted batch job (\d+)", ret.stdout)
+    if mm is None:
+        return None
+
+    return mm.group(1)
+
+
+def parse_input():
+    """
+    Parse arguments to the campaign submitter
+    """
+    prog_desc = "Submit GC search beams as slurm array jobs"
+    parser = ArgumentParser(description=prog_desc)
+
+    parser.add_argument('--args_json',
+                        help='JSON file containing pipeline args',
+                        required=True)
+    beam_group = parser.add_mutually_exclusive_group(required=True)
+    beam_group.add_argument('--beams',
+                            help='Beams to run (e.g., 2,3,7-12)',
+                            type=str, default=None)
+    beam_group.add_argument('--beam_file',
+                            help='File with beams to run',
+                            type=str, default=None)
+    parser.add_argument('--out_dir',
+                        help='Where to put the slurm script, '+\
+                             'beam file, and slurm output '+\
+                             '(default: current directory)',
+                        default=os.getcwd())
+    parser.add_argument('--job_name',
+                        help='Slurm job name (default: gcpsr)',
+                        default='gcpsr')
+    parser.add_argument('--beams_per_task',
+                        help='Beams packed into each array task '+\
+                             '(default: 4)',
+                        type=int, default=4)
+    parser.add_argument('--beam_slots',
+                        help='Beams in flight in each task (default: 2)',
+                        type=int, default=2)
+    parser.add_argument('--ngpus',
+                        help='GPUs per task (default: 1)',
+                        type=int, default=1)
+    parser.add_argument('--cpus_per_task',
+                        help='CPUs per task (default: from the '+\
+                             'measured CPU use, or 24 if there are '+\
+                             'no finished beams to measure)',
+                        type=int, default=None)
+    parser.add_argument('--cpu_margin',
+                        help='Factor to pad the measured CPU use by '+\
+                             '(default: 1.2)',
+                        type=float, default=1.2)
+    parser.add_argument('--mem_per_beam_gb',
+                        help='Memory per beam in flight if there are '+\
+                             'no finished beams to measure (default: 30)',
+                        type=float, default=30.0)
+    parser.add_argument('--mem_margin',
+                        help='Factor to pad the measured memory by '+\
+                             '(default: 1.3)',
+                        type=float, default=1.3)
+    parser.add_argument('--default_beam_min',
+                        help='Beam run time to use if there are no '+\
+                             'finished beams to measure (default: 90)',
+                        type=float, default=90.0)
+    parser.add_argument('--time_margin',
+                        help='Factor to pad the walltime by '+\
+                             '(default: 1.5)',
+                        type=float, default=1.5)
+    parser.add_argument('--max_tasks',
+                        help='Max array tasks running at once '+\
+                             '(default: 20)',
+                        type=int, default=20)
+    parser.add_argument('--partition',
+                        help='Slurm partition (default: gpu.q)',
+                        default='gpu.q')
+    parser.add_argument('--setup_cmds',
+                        help='Commands to run before the search '+\
+                             '(default: module load anaconda/3/2023.03)',
+                        default='module load anaconda/3/2023.03')
+    parser.add_argument('--sbatch',
+                        help='sbatch command (or a stand-in for '+\
+                             'testing) (default: sbatch)',
+                        default='sbatch')
+    parser.add_argument('--no_submit',
+                        help='Only write the script, do not submit it',
+                        action='store_true')
+    parser.add_argument('--rerun',
+                        help='Also run beams that already finished',
+                        action='store_true')
+    args = parser.parse_args()
+
+    return args
+
+
+####################
+##     MAIN       ##
+####################
+
+if __name__ == "__main__":
+    args = parse_input()
+
+    jsonfile = os.path.abspath(args.args_json)
+    jd = read_and_check_json(jsonfile)
+    if jd is None:
+        sys.exit(1)
+
+    results_dir = format_name( jd["dirs"]["results_dir"] )
+    src_dir     = format_name( jd["dirs"]["src_dir"] )
+
+    # Get beams and drop the ones that are already done
+    if args.beams is not None:
+        beam_list = parse_beam_list(args.beams)
+    else:
+        beam_list = read_beam_file(args.beam_file)
+
+    if not args.rerun:
+        done_beams = [ bb for bb in beam_list if
+                       beam_finished(results_dir, f"cfbf{bb:05d}") ]
+        if len(done_beams):
+            print(f"Skipping {len(done_beams)} finished beams:")
+            print(f"  {done_beams}")
+        beam_list = [ bb for bb in beam_list if bb not in done_beams ]
+
+    if len(beam_list) == 0:
+        print("No beams left to run")
+        sys.exit(0)
+
+    groups = pack_beams(beam_list, args.beams_per_task)
+    print(f"Packing {len(beam_list)} beams into {len(groups)} tasks")
+
+    # Size the tasks from previous runs
+    times = get_measured_times(results_dir)
+    t_task = estimate_task_minutes(times, args.beams_per_task,
+                                   args.beam_slots, args.ngpus,
+                                   default_min=args.default_beam_min)
+    walltime = format_walltime(t_task * args.time_margin)
+
+    beam_mem_gb = estimate_beam_mem_gb(times, 
+                                       default_gb=args.mem_per_beam_gb, 
+                                       margin=args.mem_margin)
+    nslots = max(1, min(args.beam_slots, args.beams_per_task))
+    # slurm --mem is in MiB
+    mem_mb = int(math.ceil(nslots * beam_mem_gb * 1024))
+
+    cpus = args.cpus_per_task
+    if cpus is None:
+        cpus = estimate_task_cpus(times, nslots, margin=args.cpu_margin)
+
+    print(f"Walltime per task: {walltime}")
+    print(f"Memory per task:   {mem_mb} MB")
+    print(f"CPUs per task:     {cpus}")
+
+    # Write beam and slurm files
+    out_dir = format_name( os.path.abspath(args.out_dir) )
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    dstr = datetime.now().strftime('%Y%m%dT%H%M%S')
+    beam_file   = f"{out_dir}/{args.job_name}_{dstr}.beams"
+    script_file = f"{out_dir}/{args.job_name}_{dstr}.slurm"
+
+    write_beam_file(groups, beam_file)
+
+    script = SLURM_TEMPLATE.format(
+        date       = dstr,
+        job_name   = args.job_name,
+        log_dir    = out_dir,
+        partition  = args.partition,
+        ngpus      = args.ngpus,
+        cpus       = cpus,
+        walltime   = walltime,
+        mem_mb     = mem_mb,
+        last_task  = len(groups) - 1,
+        max_tasks  = args.max_tasks,
+        setup_cmds = args.setup_cmds,
+        beam_file  = beam_file,
+        src_dir    = src_dir,
+        args_json  = jsonfile,
+        beam_slots = args.beam_slots)
+
+    with open(script_file, 'w') as fout:
+        fout.write(script)
+
+    print(f"\nWrote beam file:   {beam_file}")
+    print(f"Wrote slurm script: {script_file}")
+
+    if args.no_submit:
+        sys.exit(0)
+
+    job_id = submit_script(script_file, sbatch_cmd=args.sbatch)
+    if job_id is None:
+        sys.exit(1)
+
+    print(f"Submitted array job {job_id}")
@@ -0,0 +1,98 @@
+"""
+Merge TransientX candidate (.cands) files from a single
+pulse search that was split up by DM and/or time (used by
+gcpsr_search2.py)
+
+Each line of a .cands file is one candidate with
+whitespace separated columns.  We only need the MJD, DM,
+and S/N, the rest of the line is kept as is.  A pulse near
+the edge of a DM or time piece can be found in both of the
+neighboring pieces, so candidates from different pieces
+that are close in time and DM are treated as the same
+pulse and only the brightest is kept.
+"""
+import os
+import bisect
+
+
+# Columns of the .cands file that we use
+COL_MJD = 1
+COL_DM  = 2
+COL_SNR = 4
+
+
+def read_cands(cand_file, shard=0):
+    """
+    Read a .cands file.  Returns a list of
+    (mjd, dm, snr, shard, line) with the comment and
+    blank lines left out.
+    """
+    cands = []
+    with open(cand_file, 'r') as fin:
+        for line in fin:
+            cols = line.split()
+            if len(cols) <= COL_SNR or line.startswith('#'):
+                continue
+            try:
+                cands.append( (float(cols[COL_MJD]), float(cols[COL_DM]),
+                               float(cols[COL_SNR]), shard,
+                               line.rstrip('\n')) )
+            except ValueError:
+                continue
+    return cands
+
+
+def dedup_cands(cands, dt_tol, dm_frac=0.05):
+    """
+    Drop candidates from one piece that are within dt_tol
+    seconds and a fraction dm_frac in DM of a brighter
+    candidate from a different piece.  Candidates from the
+    same piece were already sifted by TransientX, so they
+    are left alone.
+
+    We go from the brightest down and only compare with the
+    candidates already kept, so nothing is dropped because 
+    of a candidate that was itself dropped.
+    """
+    dmjd_tol = dt_tol / 86400.
+    kept_mjds = []
+    kept = []
+
+    for cc in sorted(cands, key=lambda cc: cc[2], reverse=True):
+        lo = bisect.bisect_left(kept_mjds, cc[0] - dmjd_tol)
+        hi = bisect.bisect_right(kept_mjds, cc[0] + dmjd_tol)
+        dup = False
+        for kk in kept[lo:hi]:
+            dm_tol = dm_frac * max(cc[1], kk[1])
+            if kk[3] != cc[3] and abs(cc[1] - kk[1]) <= dm_tol:
+                dup = True
+                break
+        if not dup:
+            ii = bisect.bisect_right(kept_mjds, cc[0])
+            kept_mjds.insert(ii, cc[0])
+            kept.insert(ii, cc)
+
+    return kept
+
+
+def merge_cands(cand_files, outfile, dt_tol, dm_frac=0.05):
+    """
+    Merge .cands files (one per piece of the search) into
+    outfile, removing the duplicates at the boundaries.
+    Returns the number of candidates written.
+    """
+    cands = []
+    for ii, cfile in enumerate(cand_files):
+        cands += read_cands(cfile, shard=ii)
+
+    ntot = len(cands)
+    cands = dedup_cands(cands, dt_tol, dm_frac)
+    print(f"Merged {len(cand_files)} cands files: kept {len(cands)} " +\
+          f"of {ntot} candidates")
+
+    with open(f"{outfile}.tmp", 'w') as fout:
+        for cc in cands:
+            fout.write(cc[4] + "\n")
+    os.replace(f"{outfile}.tmp", outfile)
+
+    return len(cands)